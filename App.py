@@ -1,11 +1,18 @@
 import dash
-from dash import dcc, html, ctx
+from dash import dcc, html, ctx, Patch
 import dash_bootstrap_components as dbc
 import dash_daq as daq
 import plotly.graph_objects as go
-import pandas as pd
+import numpy as np
 import time
+import json
+import os
+import sys
 import logging
+import base64
+import functools
+import tempfile
+from flask import Response, request, stream_with_context, abort
 from dash.dependencies import Input, Output, State, ClientsideFunction
 
 # =================================================================
@@ -13,16 +20,32 @@ from dash.dependencies import Input, Output, State, ClientsideFunction
 # =================================================================
 try:
     # Intentamos importar el manager de MQTT
-    from mqtt_manager import get_sensor_buffer, send_tcp_command, is_esp_connected, purge_buffer
+    from mqtt_manager import get_sensor_buffer, send_tcp_command, is_esp_connected, purge_buffer, wait_sensor_data, get_sample_stream, submit_command, command_status, send_setpoint, list_devices, get_phase_timeline, get_command_channels
     print("[SISTEMA] Conectado al Gestor MQTT (Nube).")
 except ImportError:
     print("[ERROR] No se encuentra mqtt_manager.py. Usando modo simulado.")
-    def get_sensor_buffer(): return [], (0,0,0,0,0)
-    def send_tcp_command(msg): return False
-    def is_esp_connected(): return False
-    def purge_buffer(): pass
+    def get_sensor_buffer(consumer=None, device=None): return [], (0,0,0,0,0)
+    def send_tcp_command(msg, device=None): return False
+    def is_esp_connected(device=None): return False
+    def purge_buffer(consumer=None, device=None): pass
+    def wait_sensor_data(consumer, timeout=None, device=None): time.sleep(timeout or 0)
+    def get_sample_stream(device=None): return None
+    def submit_command(msg, device=None): return None
+    def command_status(cid, device=None): return None
+    def send_setpoint(msg, key='pwm', force=False, device=None): return False
+    def list_devices(): return {}
+    def get_phase_timeline(device=None): return None
+    def get_command_channels(device=None): return None, None
     # Nota: set_target_ip ya no es necesaria en MQTT
 
+from session_store import store, CHANNELS
+from downsampling import downsample
+from recorder import new_recording, recover_all, open_recording, list_recordings
+from replay import start_replay, stop_replay, get_player, import_table, MIN_SPEED, MAX_SPEED
+from sequencer import PROTOCOLS, pid_steps, start_protocol, stop_protocol, get_run
+from exporter import EXPORTERS, FORMATS, available as export_available, parse_columns
+import metrics
+
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
 
@@ -47,15 +70,33 @@ card_red_style = {**card_style, 'border': f'3px solid {COLOR_RED}'}
 input_style = {'backgroundColor': 'white', 'color': COLOR_TEXT_DARK, 'borderColor': '#ccc', 'textAlign': 'center'}
 sidebar_label = {'color': '#f8f9fa', 'fontWeight': '600', 'fontSize': '0.85rem', 'textTransform': 'uppercase', 'letterSpacing': '1px'}
 
-def create_chart(x, y, title, xl, yl, color):
-    fig = go.Figure()
-    if x and len(x) > 0:
-        fig.add_trace(go.Scattergl(
-            x=x, y=y, mode='lines',
-            line=dict(color=color, width=2)
-        ))
-    
-    fig.update_layout(
+# Gráficas en streaming: (id, canal x, canal y, título, eje x, eje y, color)
+CHARTS = [
+    ('graph-iso-f-t', 't', 'f', "Fuerza (N) vs Tiempo (s)", "Tiempo (s)", "Fuerza (N)", COLOR_BLUE),
+    ('graph-isot-p-t', 't', 'p', "Presión (PSI) vs Tiempo (s)", "Tiempo (s)", "Presión (PSI)", COLOR_RED),
+    ('graph-isot-p-l', 'p', 'l', "Longitud (cm) vs Presión (PSI)", "Presión (PSI)", "Longitud (cm)", COLOR_GREEN),
+    ('graph-isot-l-t', 't', 'l', "Longitud (cm) vs Tiempo (s)", "Tiempo (s)", "Longitud (cm)", COLOR_BLUE),
+    ('graph-isot-contr-t', 't', 'contr', "Contracción vs Tiempo (s)", "Tiempo (s)", "Contracción (L0-L)/L0", COLOR_RED),
+]
+CHART_KEYS = sorted({k for c in CHARTS for k in c[1:3]})  # Canales que viajan al navegador
+STREAM_WINDOW = 10000  # maxPoints de extendData (puntos visibles por traza)
+
+# Push por SSE (/stream/<sid>); con MCKIBBEN_PUSH=0 se vuelve al sondeo de 500 ms
+PUSH_ENABLED = os.environ.get('MCKIBBEN_PUSH', '1') != '0'
+PUSH_MIN_PERIOD = 0.05   # Agrupa ráfagas: como mucho 20 eventos de muestras por segundo
+PUSH_IDLE_CHECK = 1.0    # Revisión del estado de conexión sin datos
+PUSH_HEARTBEAT = 15.0
+
+# Perilla de presión: antirrebote en el navegador (0 = enviar cada cambio);
+# el gestor además agrupa consignas y limita la tasa (MCKIBBEN_SETPOINT_HZ)
+KNOB_DEBOUNCE_MS = int(os.environ.get('MCKIBBEN_KNOB_DEBOUNCE_MS', '150'))
+
+# Plantillas: el layout (con el template de plotly ya expandido) y el estilo
+# de traza se construyen una vez y se reutilizan como dicts; cada figura solo
+# agrega los datos. No modificar lo que devuelven (es compartido).
+@functools.lru_cache(maxsize=None)
+def chart_layout(title, xl, yl):
+    return go.Layout(
         title=dict(text=title, font=dict(color=COLOR_BLUE, size=16, family="Arial"), x=0.5),
         template='plotly_white', paper_bgcolor='white', plot_bgcolor='white',
         margin=dict(l=50, r=20, t=50, b=50),
@@ -63,20 +104,66 @@ def create_chart(x, y, title, xl, yl, color):
         yaxis=dict(title=yl, showgrid=True, gridcolor='#eee', zeroline=False),
         font=dict(family="Arial, sans-serif", color=COLOR_TEXT_DARK),
         hovermode="x unified"
-    )
-    if not x: 
-        fig.update_layout(xaxis=dict(range=[0, 10]), yaxis=dict(range=[0, 10]))
-    return fig
+    ).to_plotly_json()
+
+@functools.lru_cache(maxsize=None)
+def trace_style(color):
+    return {'type': 'scattergl', 'mode': 'lines', 'line': {'color': color, 'width': 2}}
+
+def with_ranges(layout, xr=None, yr=None):
+    if xr is not None: layout = {**layout, 'xaxis': {**layout['xaxis'], 'range': list(xr)}}
+    if yr is not None: layout = {**layout, 'yaxis': {**layout['yaxis'], 'range': list(yr)}}
+    return layout
+
+def create_chart(x, y, title, xl, yl, color):
+    # Siempre hay una traza (aunque vacía) para que extendData tenga dónde anexar
+    trace = {**trace_style(color), 'x': x if x is not None else [], 'y': y if y is not None else []}
+    return {'data': [trace], 'layout': chart_layout(title, xl, yl)}
+
+REPLAY_SPEEDS = (1, 2, 5, 10, 25, 50, 100)
+
+# Vista de comparación: varias fuentes (equipos en vivo o grabaciones) sobre
+# los mismos ejes. Cada traza se reduce con M4 a COMPARE_WIDTH columnas; al
+# sumar fuentes solo crece la carga de datos, no el layout.
+COMPARE_COLORS = (COLOR_BLUE, COLOR_RED, COLOR_GREEN, '#ff7f0e', '#9467bd', '#8c564b', '#17becf', '#7f7f7f')
+COMPARE_WIDTH = 1200
+COMPARE_LIVE_ROWS = 1 << 15   # Ventana de cada fuente en vivo (últimas muestras del registro)
+COMPARE_POLL_MS = 1000
+CHART_BY_ID = {c[0]: c for c in CHARTS}
+
+# Layout de cada gráfica construido una sola vez; luego solo se anexan muestras
+INITIAL_FIGURES = {c[0]: create_chart(None, None, *c[3:]) for c in CHARTS}
+
+@functools.lru_cache(maxsize=None)
+def compare_layout(gid):
+    chart = CHART_BY_ID[gid]
+    base = chart_layout(*chart[3:6])
+    return {**base, 'showlegend': True, 'legend': {'orientation': 'h', 'y': -0.15}, 'hovermode': 'closest'}
+
+def compare_figure(gid, traces=()):
+    return {'data': list(traces), 'layout': compare_layout(gid)}
+
+def extend_payload(chunk, xk, yk):
+    return dict(x=[chunk[xk].tolist()], y=[chunk[yk].tolist()]), [0], STREAM_WINDOW
 
 # =================================================================
 #                           LAYOUT
 # =================================================================
-app.layout = dbc.Container([
+main_layout = dbc.Container([
     dcc.Store(id='session-store', data={'running': False, 'start_time': None}),
-    dcc.Store(id='main-store', data={'t': [], 'f': [], 'p': [], 'l': [], 'a': [], 'pwm': []}),
     # Eliminado dcc.Store de IP porque en MQTT no se usa
-    dcc.Interval(id='intervalo-lectura', interval=500, n_intervals=0),
+    dcc.Interval(id='intervalo-lectura', interval=500, n_intervals=0, disabled=PUSH_ENABLED),
+    dcc.Store(id='push-mode'),
     dcc.Download(id="download-excel"),
+    dcc.Store(id='export-trigger'),
+    # Comandos en vuelo {destino: {'cid', 'label'}}; se sondean hasta su ACK
+    dcc.Store(id='cmd-pending', data={}),
+    dcc.Interval(id='cmd-poll', interval=200, n_intervals=0, disabled=True),
+    dcc.Store(id='knob-setpoint'),
+    dcc.Store(id='knob-debounce', data=KNOB_DEBOUNCE_MS),
+    dcc.Interval(id='device-poll', interval=3000, n_intervals=0),
+    dcc.Interval(id='compare-poll', interval=COMPARE_POLL_MS, n_intervals=0, disabled=True),
+    *[dcc.Store(id=f"{c[0]}-view") for c in CHARTS],
 
     dbc.Row([
         # --- SIDEBAR ---
@@ -93,6 +180,21 @@ app.layout = dbc.Container([
                 html.Div(className="mb-4", children=[
                     html.Label("SERVIDOR NUBE", style=sidebar_label, className="mb-2 text-center w-100"),
                     html.Div("HiveMQ Cloud", style={'textAlign': 'center', 'color': '#00ffcc', 'fontSize':'0.9rem', 'fontWeight':'bold', 'marginBottom':'10px'}),
+
+                    html.Label("EQUIPO", style=sidebar_label, className="mb-2 text-center w-100"),
+                    dcc.Dropdown(id='device-select', options=[], placeholder="ESP32 (por defecto)", className="mb-3", style={'color': COLOR_TEXT_DARK}),
+
+                    # Reproducción de grabaciones (aparece como un equipo "replay:<id>")
+                    html.Label("REPRODUCCIÓN", style=sidebar_label, className="mb-2 text-center w-100"),
+                    dcc.Dropdown(id='replay-source', options=[], placeholder="Grabación...", className="mb-2", style={'color': COLOR_TEXT_DARK}),
+                    dcc.Upload(id='replay-upload', children=html.Div("Importar CSV / XLSX"), accept='.csv,.xlsx', className="mb-2",
+                               style={'textAlign': 'center', 'fontSize': '0.8rem', 'padding': '6px', 'border': '1px dashed rgba(255,255,255,0.6)', 'borderRadius': '4px', 'cursor': 'pointer'}),
+                    dbc.Row([
+                        dbc.Col(dbc.Button("▶ / ❚❚", id="btn-replay", color="light", size="sm", className="w-100 fw-bold", style={'color': COLOR_BLUE}, n_clicks=0), width=6),
+                        dbc.Col(dbc.Select(id="replay-speed", value="1", options=[{'label': f"×{v}", 'value': str(v)} for v in REPLAY_SPEEDS], size="sm"), width=6),
+                    ], className="g-2 mb-2"),
+                    dcc.Slider(id='replay-seek', min=0, max=100, step=0.1, value=0, marks=None, updatemode='mouseup'),
+                    html.Div(id='replay-status', style={'textAlign': 'center', 'fontSize': '0.75rem', 'marginBottom': '15px'}),
                     
                     html.Label("ESTADO DEL ESP32", style=sidebar_label, className="mb-2 text-center w-100"),
                     html.Div(id="status-indicator", children="BUSCANDO...", 
@@ -109,8 +211,9 @@ app.layout = dbc.Container([
                 # TIPO PRUEBA Y MANUAL
                 html.Label("TIPO DE PRUEBA", style=sidebar_label, className="mb-2"),
                 dbc.ButtonGroup([
-                    dbc.Button("Isométrica", id="btn-nav-iso", color="light", outline=False, className="w-50 fw-bold", style={'color': COLOR_BLUE}),
-                    dbc.Button("Isotónica", id="btn-nav-isot", color="light", outline=True, className="w-50 fw-bold", style={'color': COLOR_BLUE}),
+                    dbc.Button("Isométrica", id="btn-nav-iso", color="light", outline=False, className="flex-fill fw-bold", style={'color': COLOR_BLUE}),
+                    dbc.Button("Isotónica", id="btn-nav-isot", color="light", outline=True, className="flex-fill fw-bold", style={'color': COLOR_BLUE}),
+                    dbc.Button("Comparar", id="btn-nav-cmp", color="light", outline=True, className="flex-fill fw-bold", style={'color': COLOR_BLUE}),
                 ], className="w-100 mb-4"),
 
                 html.Div([
@@ -134,8 +237,17 @@ app.layout = dbc.Container([
                     dbc.Col(html.Div(style={'backgroundColor': 'white', 'padding': '8px', 'borderRadius': '6px'}, children=[html.Small("Ángulo (°)", className="text-muted", style={'fontSize':'0.7rem'}), html.H5(id="ind-ang", children="0.0", style={'color': COLOR_RED, 'fontWeight':'bold', 'marginBottom':'0'})]), width=6, className="mt-2"),
                     dbc.Col(html.Div(style={'backgroundColor': 'white', 'padding': '8px', 'borderRadius': '6px'}, children=[html.Small("PWM (0-255)", className="text-muted", style={'fontSize':'0.7rem'}), html.H5(id="ind-pwm", children="0", style={'color': COLOR_RED, 'fontWeight':'bold', 'marginBottom':'0'})]), width=6, className="mt-2")
                 ], className="g-2 text-center"),
+                # Métricas derivadas (analytics.py, calculadas en la ingesta)
+                dbc.Row([
+                    dbc.Col(html.Div(style={'backgroundColor': 'white', 'padding': '8px', 'borderRadius': '6px'}, children=[html.Small("Contracción (%)", className="text-muted", style={'fontSize':'0.7rem'}), html.H5(id="ind-contr", children="--", style={'color': COLOR_GREEN, 'fontWeight':'bold', 'marginBottom':'0'})]), width=4),
+                    dbc.Col(html.Div(style={'backgroundColor': 'white', 'padding': '8px', 'borderRadius': '6px'}, children=[html.Small("F/P (N/PSI)", className="text-muted", style={'fontSize':'0.7rem'}), html.H5(id="ind-fpsi", children="--", style={'color': COLOR_GREEN, 'fontWeight':'bold', 'marginBottom':'0'})]), width=4),
+                    dbc.Col(html.Div(style={'backgroundColor': 'white', 'padding': '8px', 'borderRadius': '6px'}, children=[html.Small("Histéresis", className="text-muted", style={'fontSize':'0.7rem'}), html.H5(id="ind-hyst", children="--", style={'color': COLOR_GREEN, 'fontWeight':'bold', 'marginBottom':'0'})]), width=4)
+                ], className="g-2 text-center mt-2"),
                 html.Br(),
-                dbc.Button("Descargar Excel", id="btn-download", color="light", className="w-100 fw-bold", style={'color': COLOR_BLUE})
+                dbc.Row([
+                    dbc.Col(dbc.Select(id="export-format", value="xlsx", options=[{'label': 'Excel', 'value': 'xlsx'}, {'label': 'CSV', 'value': 'csv'}, {'label': 'Parquet', 'value': 'parquet'}], size="sm"), width=5),
+                    dbc.Col(dbc.Button("Descargar", id="btn-download", color="light", className="w-100 fw-bold", style={'color': COLOR_BLUE}), width=7),
+                ], className="g-2")
             ])
         ], width=12, md=4, lg=3, className="p-0"),
 
@@ -144,7 +256,7 @@ app.layout = dbc.Container([
             html.Div(style=content_style, children=[
                 html.Div(id="view-isometrica", children=[
                     html.H2("Análisis Isométrico", style={'color': COLOR_BLUE, 'fontWeight': 'bold'}, className="mb-4 text-center"),
-                    html.Div(style=card_style, children=[html.H5("Fuerza vs Tiempo", className="text-center text-muted mb-3"), dcc.Graph(id='graph-iso-f-t', config={'displayModeBar': False}, style={'height': '700px'})])
+                    html.Div(style=card_style, children=[html.H5("Fuerza vs Tiempo", className="text-center text-muted mb-3"), dcc.Graph(id='graph-iso-f-t', figure=INITIAL_FIGURES['graph-iso-f-t'], config={'displayModeBar': False}, style={'height': '700px'})])
                 ]),
                 html.Div(id="view-isotonica", style={'display': 'none'}, children=[
                     html.H2("Control Isotónico", style={'color': COLOR_BLUE, 'fontWeight': 'bold'}, className="mb-4 text-center"),
@@ -161,17 +273,49 @@ app.layout = dbc.Container([
                         ]),
                         html.Div(id="pid-feedback", className="text-center mt-3 fw-bold", style={'color': COLOR_BLUE})
                     ]),
+                    # Protocolos automáticos (sequencer.py): corren en el servidor y se graban solos
+                    html.Div(style=card_style, children=[
+                        html.H5("Protocolo Automático", style={'color': COLOR_BLUE, 'fontWeight': 'bold'}, className="mb-3"),
+                        dbc.Row([
+                            dbc.Col(dbc.Select(id="protocol-type", value="escalera", options=[
+                                {'label': "Escalera de presión", 'value': 'escalera'},
+                                {'label': "Barrido senoidal", 'value': 'barrido'},
+                                {'label': "Escalones PID (ganancias de arriba)", 'value': 'pid'}]), width=12, lg=6),
+                            dbc.Col(dbc.Button("EJECUTAR", id="btn-protocol-run", color="primary", className="w-100 fw-bold", n_clicks=0), width=6, lg=3, className="pt-2 pt-lg-0"),
+                            dbc.Col(dbc.Button("DETENER", id="btn-protocol-stop", color="danger", outline=True, className="w-100 fw-bold", n_clicks=0), width=6, lg=3, className="pt-2 pt-lg-0"),
+                        ]),
+                        html.Div(id="protocol-status", className="text-center mt-3", style={'color': COLOR_TEXT_DARK})
+                    ]),
                     dbc.Row([
-                        dbc.Col(html.Div(style=card_style, children=[html.H6("Presión vs Tiempo", className="text-center text-muted"), dcc.Graph(id='graph-isot-p-t', config={'displayModeBar': False}, style={'height': '300px'})]), width=12, lg=6),
-                        dbc.Col(html.Div(style=card_style, children=[html.H6("Longitud vs Presión", className="text-center text-muted"), dcc.Graph(id='graph-isot-p-l', config={'displayModeBar': False}, style={'height': '300px'})]), width=12, lg=6),
+                        dbc.Col(html.Div(style=card_style, children=[html.H6("Presión vs Tiempo", className="text-center text-muted"), dcc.Graph(id='graph-isot-p-t', figure=INITIAL_FIGURES['graph-isot-p-t'], config={'displayModeBar': False}, style={'height': '300px'})]), width=12, lg=6),
+                        dbc.Col(html.Div(style=card_style, children=[html.H6("Longitud vs Presión", className="text-center text-muted"), dcc.Graph(id='graph-isot-p-l', figure=INITIAL_FIGURES['graph-isot-p-l'], config={'displayModeBar': False}, style={'height': '300px'})]), width=12, lg=6),
                     ], className="mb-3"),
-                    dbc.Row([dbc.Col(html.Div(style=card_style, children=[html.H6("Longitud vs Tiempo", className="text-center text-muted"), dcc.Graph(id='graph-isot-l-t', config={'displayModeBar': False}, style={'height': '300px'})]), width=12)])
+                    dbc.Row([
+                        dbc.Col(html.Div(style=card_style, children=[html.H6("Longitud vs Tiempo", className="text-center text-muted"), dcc.Graph(id='graph-isot-l-t', figure=INITIAL_FIGURES['graph-isot-l-t'], config={'displayModeBar': False}, style={'height': '300px'})]), width=12, lg=6),
+                        dbc.Col(html.Div(style=card_style, children=[html.H6("Contracción vs Tiempo", className="text-center text-muted"), dcc.Graph(id='graph-isot-contr-t', figure=INITIAL_FIGURES['graph-isot-contr-t'], config={'displayModeBar': False}, style={'height': '300px'})]), width=12, lg=6),
+                    ])
+                ]),
+                html.Div(id="view-comparacion", style={'display': 'none'}, children=[
+                    html.H2("Comparación de Sesiones", style={'color': COLOR_BLUE, 'fontWeight': 'bold'}, className="mb-4 text-center"),
+                    html.Div(style=card_style, children=[
+                        dbc.Row([
+                            dbc.Col(dcc.Dropdown(id='compare-sources', options=[], value=[], multi=True, placeholder="Equipos en vivo o grabaciones..."), width=12, lg=8),
+                            dbc.Col(dbc.Select(id='compare-chart', value=CHARTS[0][0], options=[{'label': c[3], 'value': c[0]} for c in CHARTS]), width=12, lg=4, className="pt-2 pt-lg-0"),
+                        ], className="mb-3"),
+                        dcc.Graph(id='graph-compare', figure=compare_figure(CHARTS[0][0]), config={'displayModeBar': False}, style={'height': '650px'})
+                    ])
                 ])
             ])
         ], width=12, md=8, lg=9, className="p-0")
     ], className="g-0")
 ], fluid=True, style={'padding': '0', 'backgroundColor': COLOR_BG_LIGHT})
 
+def serve_layout():
+    # Cada carga de página recibe su propio token; los datos quedan en el servidor
+    return html.Div([dcc.Store(id='main-store', data={'sid': store.new_id(), 'cursor': 0}), main_layout])
+
+app.layout = serve_layout
+
 # =================================================================
 #               CALLBACKS
 # =================================================================
@@ -179,36 +323,88 @@ app.layout = dbc.Container([
 # --- 1. MAGIC CALLBACK: BORRADO INSTANTÁNEO CLIENT-SIDE ---
 app.clientside_callback(
     """
-    function(n_clicks) {
+    function(n_clicks, store, ...figs) {
         if (n_clicks > 0) {
-            const emptyLayout = {
-                'title': {'text': ''},
-                'template': 'plotly_white',
-                'xaxis': {'range': [0, 10], 'title': 'Tiempo (s)'},
-                'yaxis': {'range': [0, 10], 'title': ''}
-            };
-            const emptyFig = {'data': [], 'layout': emptyLayout};
-            const emptyData = {'t': [], 'f': [], 'p': [], 'l': [], 'a': [], 'pwm': []};
-            return [emptyFig, emptyFig, emptyFig, emptyFig, emptyData];
+            // Se conserva el layout y se vacían las trazas para seguir usando extendData
+            const vaciar = (fig) => ({
+                'data': ((fig && fig.data) || []).map(tr => Object.assign({}, tr, {'x': [], 'y': []})),
+                'layout': Object.assign({}, (fig && fig.layout) || {}, {'xaxis': Object.assign({}, ((fig && fig.layout) || {}).xaxis, {'autorange': true}), 'yaxis': Object.assign({}, ((fig && fig.layout) || {}).yaxis, {'autorange': true})})
+            });
+            const emptyData = {'sid': store ? store.sid : null, 'cursor': 0};
+            return [...figs.map(vaciar), emptyData];
         }
         return window.dash_clientside.no_update;
     }
     """,
-    [Output('graph-iso-f-t', 'figure', allow_duplicate=True), 
-     Output('graph-isot-p-t', 'figure', allow_duplicate=True), 
-     Output('graph-isot-p-l', 'figure', allow_duplicate=True), 
-     Output('graph-isot-l-t', 'figure', allow_duplicate=True),
-     Output('main-store', 'data', allow_duplicate=True)],
+    [Output(c[0], 'figure', allow_duplicate=True) for c in CHARTS] +
+    [Output('main-store', 'data', allow_duplicate=True)],
     [Input('btn-clear', 'n_clicks')],
+    [State('main-store', 'data')] + [State(c[0], 'figure') for c in CHARTS],
     prevent_initial_call=True
 )
 
+# --- 1b. LECTURA COMPARTIDA (SONDEO Y PUSH) ---
+def estado_conexion(conectado, running, start_time):
+    style_base = {'textAlign': 'center', 'marginBottom':'15px', 'fontWeight':'bold', 'fontSize':'0.9rem', 'padding':'6px', 'borderRadius':'4px'}
+    if not conectado:
+        return "ESPERANDO ESP32...", {**style_base, 'backgroundColor': '#ffc107', 'color': 'black'}, True # Amarillo
+    if running:
+        return "GRABANDO...", {**style_base, 'backgroundColor': COLOR_GREEN, 'color': 'white', 'animation': 'pulse 1s infinite'}, False
+    if start_time:
+        return "PAUSADO", {**style_base, 'backgroundColor': COLOR_GREEN_DARK, 'color': COLOR_BG_LIGHT_DARK}, False
+    return "CONECTADO", {**style_base, 'backgroundColor': COLOR_GREEN, 'color': 'white'}, False
+
+def pull_samples(sid, sess, path='poll'):
+    # Lee lo nuevo del gestor (cursor propio de la sesión) y lo graba si corresponde
+    try:
+        buffer_list, latest = get_sensor_buffer(sid, device=sess.device)
+    except Exception:
+        metrics.ERRORS.inc(where='get_buffer')
+        return (0.0, 0.0, 0.0, 0.0, 0.0)
+    if sess.running and sess.start_time and len(buffer_list):
+        # Muestras tomadas antes de pulsar INICIAR no entran al registro
+        rec = buffer_list[buffer_list['t'] >= sess.start_time]
+        sess.append({'t': rec['t'] - sess.start_time, **{k: rec[k] for k in CHANNELS[1:]}})
+    if len(buffer_list):
+        sess.metrics = {k: float(buffer_list[k][-1]) for k in METRICS}
+        metrics.SAMPLE_AGE.observe(time.time() - float(buffer_list['t'][-1]), path=path)
+    return latest
+
+def iniciar_grabacion(sess, sid):
+    # Todo lo que publica el gestor va a disco, sin límite de historial
+    stream = get_sample_stream(sess.device)
+    if stream is None or sess.recording is not None: return
+    try:
+        sess.recording = new_recording({'sid': sid, 'start_time': sess.start_time})
+        stream.add_sink(sess.recording.append)
+    except OSError as e:
+        print(f"[ERROR] No se pudo abrir la grabación: {e}", file=sys.stderr)
+
+def cerrar_grabacion(sess):
+    if sess.recording is not None:
+        try: sess.recording.close()
+        except OSError as e: print(f"[ERROR] No se pudo cerrar la grabación: {e}", file=sys.stderr)
+        sess.recording = None
+
+METRICS = ('contr', 'f_psi', 'hyst')
+
+def _metrica(v, fmt):
+    return "--" if v is None or v != v else fmt.format(v)
+
+def telemetria(latest, start_time, metrics=None):
+    f_disp, l_disp, p_disp, a_disp, pwm_disp = latest
+    m = metrics or {}
+    display_time = f"{time.time() - start_time:.2f}" if start_time else "0.00"
+    return (f"{l_disp:.1f}", f"{p_disp:.1f}", f"{f_disp:.1f}", display_time, f"{a_disp:.1f}", f"{int(pwm_disp)}",
+            _metrica(m['contr'] * 100 if 'contr' in m else None, "{:.1f}"), _metrica(m.get('f_psi'), "{:.2f}"), _metrica(m.get('hyst'), "{:.1f}"))
+
 # --- 2. CALLBACK MAESTRO (YA SIN LÓGICA DE IP) ---
 @app.callback(
     [Output('main-store', 'data'), 
      Output('ind-len', 'children'), Output('ind-pres', 'children'), Output('ind-force', 'children'), 
      Output('ind-time', 'children'), Output('ind-ang', 'children'), Output('ind-pwm', 'children'),
-     Output('graph-iso-f-t', 'figure'), Output('graph-isot-p-t', 'figure'), Output('graph-isot-p-l', 'figure'), Output('graph-isot-l-t', 'figure'),
+     Output('ind-contr', 'children'), Output('ind-fpsi', 'children'), Output('ind-hyst', 'children'),
+     *[Output(c[0], 'extendData') for c in CHARTS],
      Output('status-indicator', 'children'), Output('status-indicator', 'style'), Output('btn-start', 'disabled')],
     [Input('intervalo-lectura', 'n_intervals'), Input('btn-clear', 'n_clicks')], 
     [State('main-store', 'data'), State('session-store', 'data')]
@@ -217,94 +413,223 @@ def ciclo_datos(n, n_clear, data, session):
     
     # 1. PURGA DE BACKEND (Complementa al JS)
     trigger = ctx.triggered_id
+    if data is None or not data.get('sid'): data = {'sid': store.new_id(), 'cursor': 0}
+    sess = store.get(data['sid'])
     if trigger == 'btn-clear':
-        purge_buffer()
+        purge_buffer(data['sid'], device=sess.device)
+        cerrar_grabacion(sess)
+        sess.reset()
         return (
-            {'t': [], 'f': [], 'p': [], 'l': [], 'a': [], 'pwm': []}, 
-            "0.0", "0.0", "0.0", "0.00", "0.0", "0", 
-            dash.no_update, dash.no_update, dash.no_update, dash.no_update,
+            {'sid': data['sid'], 'cursor': 0}, 
+            "0.0", "0.0", "0.0", "0.00", "0.0", "0", "--", "--", "--",
+            *(dash.no_update,) * len(CHARTS),
             "LISTO", {'textAlign': 'center', 'marginBottom':'15px', 'fontWeight':'bold', 'fontSize':'0.9rem', 'padding':'6px', 'borderRadius':'4px', 'backgroundColor': COLOR_GREEN, 'color': 'white'}, False
         )
 
-    # 2. INICIALIZACIÓN
-    if data is None: data = {'t': [], 'f': [], 'p': [], 'l': [], 'a': [], 'pwm': []}
-    if session is None: session = {'running': False, 'start_time': None}
+    # 2. INICIALIZACIÓN (si el servidor se reinició, el navegador trae el estado)
+    if session and session.get('start_time') and sess.start_time is None:
+        sess.running, sess.start_time = session.get('running', False), session['start_time']
     
     # Verificación de conexión MQTT
-    try: conectado = is_esp_connected()
-    except: conectado = False
-    
-    style_base = {'textAlign': 'center', 'marginBottom':'15px', 'fontWeight':'bold', 'fontSize':'0.9rem', 'padding':'6px', 'borderRadius':'4px'}
-    status_txt = "ESPERANDO ESP32..."
-    status_style = {**style_base, 'backgroundColor': '#ffc107', 'color': 'black'} # Amarillo
-    btn_start_disabled = True
-
-    if conectado:
-        btn_start_disabled = False
-        if session.get('running'):
-            status_txt, status_style = "GRABANDO...", {**style_base, 'backgroundColor': COLOR_GREEN, 'color': 'white', 'animation': 'pulse 1s infinite'}
-        elif session.get('start_time'):
-            status_txt, status_style = "PAUSADO", {**style_base, 'backgroundColor': COLOR_GREEN_DARK, 'color': COLOR_BG_LIGHT_DARK}
+    try: conectado = is_esp_connected(sess.device)
+    except Exception:
+        metrics.ERRORS.inc(where='is_connected')
+        conectado = False
+    status_txt, status_style, btn_start_disabled = estado_conexion(conectado, sess.running, sess.start_time)
+
+    # 3. PROCESAMIENTO DE DATOS (TIEMPO DEL ESP32 YA MAPEADO AL SERVIDOR)
+    latest = pull_samples(data['sid'], sess)
+
+    # Solo viajan las muestras posteriores al cursor del navegador
+    chunk, cursor = sess.read(data.get('cursor', 0))
+    if len(chunk['t']):
+        figs = tuple(extend_payload(chunk, c[1], c[2]) for c in CHARTS)
+    else:
+        figs = (dash.no_update,) * len(CHARTS)
+
+    return ({'sid': data['sid'], 'cursor': cursor}, *telemetria(latest, sess.start_time, sess.metrics), 
+            *figs, status_txt, status_style, btn_start_disabled)
+
+# --- 2a. PUSH: SERVER-SENT EVENTS EN LUGAR DEL SONDEO ---
+def _sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+@server.route('/stream/<sid>')
+def stream_sesion(sid):
+    sess = store.get(sid)
+    cursor = int(request.args.get('cursor', 0))
+
+    def eventos():
+        nonlocal cursor
+        epoch, last_status, last_tele, last_beat = sess.epoch, None, None, time.time()
+        yield _sse('config', {'charts': [c[:3] for c in CHARTS], 'window': STREAM_WINDOW})
+        while True:
+            # Bloquea sin costo hasta que el gestor publique algo (o toque revisar estado)
+            wait_sensor_data(sid, PUSH_IDLE_CHECK, device=sess.device)
+            latest = pull_samples(sid, sess, 'push')
+            if sess.epoch != epoch:
+                epoch, cursor = sess.epoch, 0
+            chunk, cursor = sess.read(cursor)
+            if len(chunk['t']):
+                yield _sse('samples', {'cursor': cursor, **{k: chunk[k].tolist() for k in CHART_KEYS}})
+            tele = telemetria(latest, sess.start_time, sess.metrics)
+            if tele != last_tele:
+                yield _sse('telemetry', tele)
+                last_tele = tele
+            try: conectado = is_esp_connected(sess.device)
+            except Exception:
+                metrics.ERRORS.inc(where='is_connected')
+                conectado = False
+            status = estado_conexion(conectado, sess.running, sess.start_time)
+            if status != last_status:
+                yield _sse('status', status)
+                last_status = status
+            if time.time() - last_beat > PUSH_HEARTBEAT:
+                yield ": ping\n\n"
+                last_beat = time.time()
+            time.sleep(PUSH_MIN_PERIOD)
+
+    return Response(stream_with_context(eventos()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+app.clientside_callback(
+    ClientsideFunction(namespace='push', function_name='connect'),
+    Output('push-mode', 'data'), Input('main-store', 'data'), State('intervalo-lectura', 'disabled')
+)
+
+# --- 2b. ZOOM: RE-CONSULTA A RESOLUCIÓN DE PANTALLA ---
+def _axis_range(relayout, axis):
+    if f'{axis}.range[0]' in relayout:
+        return relayout[f'{axis}.range[0]'], relayout[f'{axis}.range[1]']
+    return relayout.get(f'{axis}.range')
+
+def render_view(sid, chart, view):
+    gid, xk, yk = chart[:3]
+    relayout, width = view.get('relayout') or {}, view.get('width')
+    xr, yr = _axis_range(relayout, 'xaxis'), _axis_range(relayout, 'yaxis')
+    if xr is None and not relayout.get('xaxis.autorange'):
+        return dash.no_update  # autosize, hover, etc.
+
+    d = store.get(sid).snapshot()
+    x, y = d[xk], d[yk]
+    if xr is not None:
+        if xk == 't':
+            lo, hi = np.searchsorted(x, xr)
+            x, y = x[max(lo - 1, 0):hi + 1], y[max(lo - 1, 0):hi + 1]
         else:
-            status_txt, status_style = "CONECTADO", {**style_base, 'backgroundColor': COLOR_GREEN, 'color': 'white'}
+            mask = (x >= xr[0]) & (x <= xr[1])
+            if yr is not None: mask &= (y >= yr[0]) & (y <= yr[1])
+            x, y = x[mask], y[mask]
+    # Dentro del rango visible M4 solo recorta si hay más puntos que píxeles
+    x, y = downsample(x, y, width, by_index=(xk != 't'))
+
+    fig = create_chart(x, y, *chart[3:])
+    return {**fig, 'layout': with_ranges(fig['layout'], xr, yr)}
+
+for chart in CHARTS:
+    # El ancho real en píxeles solo se conoce en el navegador
+    app.clientside_callback(
+        f"""
+        function(relayout) {{
+            const el = document.getElementById('{chart[0]}');
+            return {{'relayout': relayout, 'width': el ? el.offsetWidth : null}};
+        }}
+        """,
+        Output(f"{chart[0]}-view", 'data'), Input(chart[0], 'relayoutData'), prevent_initial_call=True
+    )
+    app.callback(
+        Output(chart[0], 'figure', allow_duplicate=True),
+        Input(f"{chart[0]}-view", 'data'), State('main-store', 'data'), prevent_initial_call=True
+    )(lambda view, data, chart=chart: render_view(data['sid'], chart, view) if view and data else dash.no_update)
+
+# --- 2c. SELECTOR DE EQUIPO (VARIOS BANCOS EN EL MISMO BROKER) ---
+def opciones_equipos():
+    try: devs = list_devices()
+    except: devs = {}
+    return [{'label': f"{k} {'●' if activo else '○'}", 'value': k} for k, activo in sorted(devs.items())]
+
+@app.callback(Output('device-select', 'options'), Input('device-poll', 'n_intervals'))
+def listar_equipos(n):
+    return opciones_equipos()
+
+@app.callback(Output('btn-clear', 'n_clicks', allow_duplicate=True), Input('device-select', 'value'), [State('main-store', 'data'), State('btn-clear', 'n_clicks')], prevent_initial_call=True)
+def elegir_equipo(device, data, n_clear):
+    if not data or not data.get('sid'): return dash.no_update
+    sess = store.get(data['sid'])
+    if device == sess.device: return dash.no_update
+    old, sess.device = sess.device, device
+    # Un reproductor que ya no mira ninguna sesión se libera (stream + hilo)
+    if get_player(old) is not None and not any(s.device == old for s in list(store.sessions.values())):
+        stop_replay(old)
+    # Mismo efecto que BORRAR: la sesión empieza de cero con el otro equipo
+    return (n_clear or 0) + 1
+
+# --- 2d. REPRODUCCIÓN DE GRABACIONES ---
+def opciones_grabaciones():
+    return [{'label': f"{m.get('source') or m['id']} ({m.get('rows', 0)} filas)", 'value': m['id']}
+            for m in list_recordings() if m.get('state') != 'recording']
+
+@app.callback(Output('replay-source', 'options'), Input('device-poll', 'n_intervals'))
+def listar_grabaciones(n):
+    return opciones_grabaciones()
 
-    # 3. PROCESAMIENTO DE DATOS CON "CERROJO DE TIEMPO" (MONOTONIC TIME)
+@app.callback(
+    [Output('replay-source', 'value'), Output('replay-source', 'options', allow_duplicate=True)],
+    Input('replay-upload', 'contents'), State('replay-upload', 'filename'), prevent_initial_call=True
+)
+def importar_tabla(contents, filename):
+    # El archivo se pasa a una grabación en disco; de ahí se reproduce por memmap
+    if not contents or not filename: return dash.no_update, dash.no_update
+    ext = os.path.splitext(filename)[1].lower()
+    with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as f:
+        f.write(base64.b64decode(contents.split(',', 1)[1]))
     try:
-        buffer_list, latest = get_sensor_buffer()
-        f_disp, l_disp, p_disp, a_disp, pwm_disp = latest
-    except:
-        buffer_list = []
-        f_disp, l_disp, p_disp, a_disp, pwm_disp = 0.0, 0.0, 0.0, 0.0, 0.0
-
-    display_time = "0.00"
-
-    if trigger != 'btn-clear' and session.get('start_time'):
-        t_now = time.time()
-        start_t = session['start_time']
-        display_time = f"{t_now - start_t:.2f}"
-        
-        if session.get('running') and buffer_list:
-            
-            last_t = data['t'][-1] if len(data['t']) > 0 else 0.0
-            ideal_base_time = (t_now - start_t) - 0.5
-            safe_base_time = max(ideal_base_time, last_t + 0.001)
-            num_points = len(buffer_list)
-            time_step = 0.5 / max(num_points, 1) 
-            
-            for i, vals in enumerate(buffer_list):
-                vf, vl, vp, va, vpwm = vals
-                t_point = safe_base_time + (i * time_step)
-                
-                if len(data['t']) > 0 and t_point <= data['t'][-1]:
-                     t_point = data['t'][-1] + 0.001
-
-                data['t'].append(t_point)
-                data['f'].append(vf)
-                data['p'].append(vp)
-                data['l'].append(vl)
-                if 'a' in data: data['a'].append(va)
-                if 'pwm' in data: data['pwm'].append(vpwm)
-            
-            # Limitar historial
-            MAX_POINTS = 10000 
-            if len(data['t']) > MAX_POINTS:
-                excess = len(data['t']) - MAX_POINTS
-                for k in data: data[k] = data[k][excess:]
-
-    fig1 = create_chart(data['t'], data['f'], "Fuerza (N) vs Tiempo (s)", "Tiempo (s)", "Fuerza (N)", COLOR_BLUE)
-    fig2 = create_chart(data['t'], data['p'], "Presión (PSI) vs Tiempo (s)", "Tiempo (s)", "Presión (PSI)", COLOR_RED)
-    fig3 = create_chart(data['p'], data['l'], "Longitud (cm) vs Presión (PSI)", "Presión (PSI)", "Longitud (cm)", COLOR_GREEN)
-    fig4 = create_chart(data['t'], data['l'], "Longitud (cm) vs Tiempo (s)", "Tiempo (s)", "Longitud (cm)", COLOR_BLUE)
-
-    return (data, f"{l_disp:.1f}", f"{p_disp:.1f}", f"{f_disp:.1f}", display_time, f"{a_disp:.1f}", f"{int(pwm_disp)}", 
-            fig1, fig2, fig3, fig4, status_txt, status_style, btn_start_disabled)
+        rec_id = import_table(f.name)
+    except Exception as e:
+        print(f"[ERROR] Importando {filename}: {e}", file=sys.stderr)
+        return dash.no_update, dash.no_update
+    finally:
+        os.unlink(f.name)
+    return rec_id, opciones_grabaciones()
+
+@app.callback(
+    [Output('device-select', 'value'), Output('device-select', 'options', allow_duplicate=True)],
+    Input('replay-source', 'value'), [State('replay-speed', 'value'), State('device-select', 'value')], prevent_initial_call=True
+)
+def reproducir(rec_id, speed, device):
+    # Sin fuente: se vuelve al equipo por defecto y elegir_equipo suelta el reproductor
+    if not rec_id: return (None, opciones_equipos()) if get_player(device) is not None else (dash.no_update, dash.no_update)
+    try: dev_id = start_replay(rec_id, float(speed or 1))
+    except (FileNotFoundError, ValueError): return dash.no_update, dash.no_update
+    # Al cambiar de equipo, elegir_equipo reinicia la sesión sobre la reproducción
+    return dev_id, opciones_equipos()
+
+@app.callback(
+    Output('replay-status', 'children'),
+    [Input('btn-replay', 'n_clicks'), Input('replay-speed', 'value'), Input('replay-seek', 'value'), Input('device-poll', 'n_intervals')],
+    State('device-select', 'value'), prevent_initial_call=True
+)
+def control_reproduccion(n_play, speed, seek, n_poll, device):
+    player = get_player(device)
+    if player is None: return ""
+    trigger = ctx.triggered_id
+    if trigger == 'btn-replay':
+        if player.paused: player.play()
+        else: player.pause()
+    elif trigger == 'replay-speed':
+        player.set_speed(min(max(float(speed or 1), MIN_SPEED), MAX_SPEED))
+    elif trigger == 'replay-seek':
+        player.seek(player.status()['duration'] * (seek or 0) / 100.0)
+    st = player.status()
+    estado = "FIN" if st['done'] else "PAUSA" if st['paused'] else "REPRODUCIENDO"
+    return f"{st['position']:.1f} / {st['duration']:.1f} s · ×{st['speed']:g} · {estado}"
 
 # --- 3. OTROS BOTONES ---
 @app.callback(
     [Output('session-store', 'data', allow_duplicate=True), Output('btn-start', 'children'), Output('btn-start', 'color'), Output('btn-start', 'style')],
-    [Input('btn-start', 'n_clicks'), Input('btn-clear', 'n_clicks')], [State('session-store', 'data')], prevent_initial_call=True
+    [Input('btn-start', 'n_clicks'), Input('btn-clear', 'n_clicks')], [State('session-store', 'data'), State('main-store', 'data')], prevent_initial_call=True
 )
-def botones_accion(n_start, n_clear, session):
+def botones_accion(n_start, n_clear, session, data):
     trigger = ctx.triggered_id
     if session is None: session = {'running': False, 'start_time': None}
 
@@ -314,6 +639,14 @@ def botones_accion(n_start, n_clear, session):
     if trigger == 'btn-start':
         session['running'] = not session['running']
         if session['running'] and session['start_time'] is None: session['start_time'] = time.time()
+        # El estado de grabación también vive en el servidor (lo usa el canal push)
+        if data and data.get('sid'):
+            sess = store.get(data['sid'])
+            sess.running, sess.start_time = session['running'], session['start_time']
+            iniciar_grabacion(sess, data['sid'])
+            if sess.recording is not None:
+                sess.recording.paused = not sess.running
+                session['recording'] = sess.recording.id
         
         if session['running']:
             return session, "PAUSAR", "warning", {'color': 'black', 'fontWeight':'bold'}
@@ -321,38 +654,240 @@ def botones_accion(n_start, n_clear, session):
             return session, "SEGUIR", "light", {'color': COLOR_BLUE, 'fontWeight':'bold'}
     return dash.no_update, dash.no_update, dash.no_update, dash.no_update
 
-@app.callback(Output("btn-tare", "children"), Input("btn-tare", "n_clicks"), prevent_initial_call=True)
-def tarar_sensores(n):
-    if send_tcp_command("TARA"): return "RESET OK"
-    return "ERROR"
+# Los botones solo encolan el comando; cmd-poll muestra el resultado al llegar el ACK
+def equipo(data):
+    # Equipo elegido en la sesión del navegador (None: el por defecto)
+    return store.get(data['sid']).device if data and data.get('sid') else None
+
+def _pendiente(pending, target, cid, label=None, device=None):
+    pending = dict(pending or {})
+    pending[target] = {'cid': cid, 'label': label, 'device': device}
+    return pending
+
+@app.callback([Output("btn-tare", "children"), Output('cmd-pending', 'data', allow_duplicate=True), Output('cmd-poll', 'disabled', allow_duplicate=True)], Input("btn-tare", "n_clicks"), [State('cmd-pending', 'data'), State('main-store', 'data')], prevent_initial_call=True)
+def tarar_sensores(n, pending, data):
+    device = equipo(data)
+    cid = submit_command("TARA", device=device)
+    if cid is None: return "ERROR", dash.no_update, dash.no_update
+    return "ENVIANDO...", _pendiente(pending, 'tare', cid, device=device), False
+
+@app.callback([Output("pid-feedback", "children"), Output('cmd-pending', 'data', allow_duplicate=True), Output('cmd-poll', 'disabled', allow_duplicate=True)], Input("btn-send-pid", "n_clicks"), [State("pid-setpoint", "value"), State("pid-kp", "value"), State("pid-ki", "value"), State("pid-kd", "value"), State('cmd-pending', 'data'), State('main-store', 'data')], prevent_initial_call=True)
+def send_pid_command(n, sp, kp, ki, kd, pending, data):
+    if sp is None: return "Error", dash.no_update, dash.no_update
+    device = equipo(data)
+    cid = submit_command(f"P:{sp}:{kp}:{ki}:{kd}", device=device)
+    if cid is None: return html.Span("Error", style={'color': COLOR_RED}), dash.no_update, dash.no_update
+    return html.Span("Enviando PID...", style={'color': COLOR_BLUE}), _pendiente(pending, 'pid', cid, sp, device), False
+
+def _latencia(st):
+    return f" ({st['latency_ms']:.0f} ms)" if st.get('latency_ms') is not None else ""
+
+@app.callback([Output("btn-tare", "children", allow_duplicate=True), Output("pid-feedback", "children", allow_duplicate=True), Output('cmd-pending', 'data'), Output('cmd-poll', 'disabled')], Input('cmd-poll', 'n_intervals'), State('cmd-pending', 'data'), prevent_initial_call=True)
+def seguimiento_comandos(n, pending):
+    pending = dict(pending or {})
+    tare = pid = dash.no_update
+    for target, item in list(pending.items()):
+        st = command_status(item['cid'], device=item.get('device'))
+        if st is not None and st['status'] == 'pending': continue
+        ok = st is not None and st['status'] in ('sent', 'ok')
+        if target == 'tare':
+            tare = ("RESET OK" + _latencia(st)) if ok else ("SIN RESPUESTA" if st and st['status'] == 'timeout' else "ERROR")
+        else:
+            pid = html.Span(f"PID Enviado: {item['label']}°" + _latencia(st), style={'color':'#28a745'}) if ok else html.Span("Error", style={'color': COLOR_RED})
+        del pending[target]
+    return tare, pid, pending, not pending
 
-@app.callback(Output("pid-feedback", "children"), Input("btn-send-pid", "n_clicks"), [State("pid-setpoint", "value"), State("pid-kp", "value"), State("pid-ki", "value"), State("pid-kd", "value")], prevent_initial_call=True)
-def send_pid_command(n, sp, kp, ki, kd):
-    if sp is None: return "Error"
-    if send_tcp_command(f"P:{sp}:{kp}:{ki}:{kd}"): return html.Span(f"PID Enviado: {sp}°", style={'color':'#28a745'})
-    return html.Span("Error", style={'color': COLOR_RED})
+VIEWS = (("btn-nav-iso", "view-isometrica"), ("btn-nav-isot", "view-isotonica"), ("btn-nav-cmp", "view-comparacion"))
 
-@app.callback([Output("view-isometrica", "style"), Output("view-isotonica", "style"), Output("btn-nav-iso", "outline"), Output("btn-nav-isot", "outline"), Output("btn-nav-iso", "style"), Output("btn-nav-isot", "style")], [Input("btn-nav-iso", "n_clicks"), Input("btn-nav-isot", "n_clicks")])
-def switch_view(b1, b2):
+@app.callback([Output(v, "style") for _, v in VIEWS] + [Output(b, "outline") for b, _ in VIEWS] + [Output(b, "style") for b, _ in VIEWS] + [Output('compare-poll', 'disabled')],
+              [Input(b, "n_clicks") for b, _ in VIEWS])
+def switch_view(*clicks):
     act, inact = {'color': COLOR_BLUE, 'backgroundColor': 'white', 'borderColor': 'white'}, {'color': 'white', 'backgroundColor': COLOR_BLUE, 'borderColor': 'white'}
-    if ctx.triggered_id == "btn-nav-isot": return {'display': 'none'}, {'display': 'block'}, True, False, inact, act
-    return {'display': 'block'}, {'display': 'none'}, False, True, act, inact
+    sel = ctx.triggered_id or VIEWS[0][0]
+    return ([{'display': 'block' if b == sel else 'none'} for b, _ in VIEWS] + [b != sel for b, _ in VIEWS]
+            + [act if b == sel else inact for b, _ in VIEWS] + [sel != "btn-nav-cmp"])
+
+# --- 3b. PROTOCOLOS AUTOMÁTICOS ---
+def armar_protocolo(kind, sp, kp, ki, kd):
+    if kind != 'pid': return PROTOCOLS[kind]()
+    targets = tuple(round(sp * k / 3.0, 2) for k in (1, 2, 3)) if sp else (10.0, 20.0, 30.0)
+    return pid_steps(targets, ((kp or 0, ki or 0, kd or 0),))
+
+@app.callback(
+    Output('protocol-status', 'children'),
+    [Input('btn-protocol-run', 'n_clicks'), Input('btn-protocol-stop', 'n_clicks'), Input('device-poll', 'n_intervals')],
+    [State('protocol-type', 'value'), State("pid-setpoint", "value"), State("pid-kp", "value"), State("pid-ki", "value"), State("pid-kd", "value"), State('main-store', 'data')],
+    prevent_initial_call=True
+)
+def protocolo(n_run, n_stop, n_poll, kind, sp, kp, ki, kd, data):
+    device = equipo(data)
+    trigger = ctx.triggered_id
+    if trigger == 'btn-protocol-run':
+        if not is_esp_connected(device): return html.Span("Sin conexión con el equipo", style={'color': COLOR_RED})
+        try:
+            start_protocol(device, armar_protocolo(kind, sp, kp, ki, kd), *get_command_channels(device),
+                           get_phase_timeline(device), get_sample_stream(device))
+        except RuntimeError as e:
+            return html.Span(str(e), style={'color': COLOR_RED})
+    elif trigger == 'btn-protocol-stop':
+        stop_protocol(device)
+    run = get_run(device)
+    if run is None: return ""
+    st = run.status()
+    texto = f"{st['protocol']} · {st['state'].upper()} · {st['elapsed']:.0f}/{st['duration']:.0f} s"
+    if st['phase']: texto += f" · {st['phase']}"
+    if st['recording']: texto += f" · grabación {st['recording']}"
+    if st['failed']: texto += f" · {st['failed']} comandos sin confirmar"
+    if st['confirmed']: texto += f" · retraso máx {st['max_late_ms']:.0f} ms"
+    return texto
+
+# --- 4. COMPARACIÓN DE SESIONES / EQUIPOS ---
+@app.callback(Output('compare-sources', 'options'), Input('device-poll', 'n_intervals'))
+def listar_fuentes(n):
+    try: devs = list_devices()
+    except Exception: devs = {}
+    return ([{'label': f"{k} (en vivo)", 'value': f"dev:{k}"} for k in sorted(devs)]
+            + [{'label': o['label'], 'value': f"rec:{o['value']}"} for o in opciones_grabaciones()])
+
+@functools.lru_cache(maxsize=64)
+def serie_grabacion(rec_id, xk, yk, rows):
+    # rows en la clave: una grabación en curso se vuelve a leer al crecer.
+    # Por bloques (memmap) y M4 por bloque: memoria acotada aunque sea larga.
+    reader = open_recording(rec_id)
+    xs, ys = [], []
+    for chunk in reader.iter_chunks([xk, yk]):
+        w = max(1, COMPARE_WIDTH * len(chunk[xk]) // max(rows, 1))
+        x, y = downsample(chunk[xk], chunk[yk], w, by_index=(xk != 't'))
+        xs.append(x); ys.append(y)
+    if not xs: return np.empty(0), np.empty(0)
+    x, y = np.concatenate(xs), np.concatenate(ys)
+    if xk == 't': x = x - (reader.meta.get('start_time') or x[0])
+    return x, y
+
+def serie_en_vivo(device, xk, yk):
+    stream = get_sample_stream(device)
+    if stream is None: return np.empty(0), np.empty(0)
+    log = stream.log
+    d, _, _ = log.read(max(0, log.head - COMPARE_LIVE_ROWS))
+    if not len(d): return np.empty(0), np.empty(0)
+    x, y = downsample(d[xk], d[yk], COMPARE_WIDTH, by_index=(xk != 't'))
+    if xk == 't': x = x - x[0]
+    return x, y
+
+def comparison_trace(src, chart, i):
+    kind, _, ident = src.partition(':')
+    xk, yk = chart[1:3]
+    try:
+        if kind == 'rec':
+            x, y = serie_grabacion(ident, xk, yk, len(open_recording(ident)))
+        else:
+            x, y = serie_en_vivo(ident, xk, yk)
+    except (FileNotFoundError, OSError, ValueError):
+        return None
+    return {**trace_style(COMPARE_COLORS[i % len(COMPARE_COLORS)]), 'name': ident, 'x': x, 'y': y}
+
+@app.callback(
+    Output('graph-compare', 'figure'),
+    [Input('compare-sources', 'value'), Input('compare-chart', 'value'), Input('compare-poll', 'n_intervals')],
+    prevent_initial_call=True
+)
+def comparar(sources, gid, n):
+    sources = sources or []
+    trigger = ctx.triggered_id
+    # El sondeo solo importa si hay fuentes en vivo
+    if trigger == 'compare-poll' and not any(s.startswith('dev:') for s in sources):
+        return dash.no_update
+    chart = CHART_BY_ID.get(gid, CHARTS[0])
+    traces = [t for t in (comparison_trace(src, chart, i) for i, src in enumerate(sources)) if t]
+    if trigger == 'compare-chart':
+        return compare_figure(chart[0], traces)
+    # Mismos ejes: solo viajan las trazas, el layout queda en el navegador
+    patch = Patch()
+    patch['data'] = traces
+    return patch
+
+app.clientside_callback(
+    ClientsideFunction(namespace='control', function_name='debounce'),
+    Output('knob-setpoint', 'data'), Input('knob-presion', 'value'), State('knob-debounce', 'data'), prevent_initial_call=True
+)
 
-@app.callback(Output('btn-set-pressure', 'disabled'), [Input('btn-set-pressure', 'n_clicks'), Input('knob-presion', 'value')], State('input-presion', 'value'), prevent_initial_call=True)
-def set_pressure(n, knob, val):
-    v = val if val is not None else knob
+# La perilla pasa por el agrupador (solo el último valor, tasa limitada);
+# ENVIAR fuerza el reenvío aunque el valor no haya cambiado
+@app.callback(Output('btn-set-pressure', 'disabled'), [Input('btn-set-pressure', 'n_clicks'), Input('knob-setpoint', 'data')], [State('input-presion', 'value'), State('main-store', 'data')], prevent_initial_call=True)
+def set_pressure(n, knob, val, data):
+    v = knob if ctx.triggered_id == 'knob-setpoint' else val
     if v is None: v = 0
     pwm = int((v / 30.0) * 255)
-    send_tcp_command(str(pwm))
+    send_setpoint(str(pwm), force=ctx.triggered_id == 'btn-set-pressure', device=equipo(data))
     return dash.no_update
 
 @app.callback([Output('knob-presion', 'value'), Output('input-presion', 'value')], [Input('knob-presion', 'value'), Input('input-presion', 'value')], prevent_initial_call=True)
 def sync(k, i): return (i, i) if ctx.triggered_id == 'input-presion' else (k, k)
 
-@app.callback(Output("download-excel", "data"), Input("btn-download", "n_clicks"), State('main-store', 'data'), prevent_initial_call=True)
-def download(n, data):
-    if not data or not data.get('t'): return dash.no_update
-    return dcc.send_data_frame(pd.DataFrame(data).to_excel, "Datos_McKibben_ITToluca.xlsx", index=False)
+# Con grabación en disco la descarga va directo al endpoint de streaming
+app.clientside_callback(
+    """
+    function(n, session, fmt) {
+        if (!session || !session.recording) return window.dash_clientside.no_update;
+        const a = document.createElement('a');
+        a.href = '/export/' + session.recording + '.' + (fmt || 'xlsx');
+        document.body.appendChild(a);
+        a.click();
+        a.remove();
+        return a.href;
+    }
+    """,
+    Output('export-trigger', 'data'), Input('btn-download', 'n_clicks'), [State('session-store', 'data'), State('export-format', 'value')], prevent_initial_call=True
+)
+
+@server.route('/export/<rec_id>.<fmt>')
+def exportar(rec_id, fmt):
+    # ?t0=&t1= (s desde INICIAR) y ?cols=f,p,... son opcionales
+    if fmt not in FORMATS: abort(404)
+    if not export_available(fmt): return Response(f"Formato {fmt} no disponible en este servidor", status=501)
+    try: reader = open_recording(rec_id)
+    except FileNotFoundError: abort(404)
+    cols = parse_columns(request.args.get('cols'), reader.columns)
+    body = EXPORTERS[fmt](reader, cols, request.args.get('t0', type=float), request.args.get('t1', type=float))
+    return Response(stream_with_context(body), mimetype=FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename="Datos_McKibben_ITToluca_{reader.id}.{fmt}"'})
+
+# Respaldo sin grabación en disco (p. ej. modo simulado): historial de la sesión
+@app.callback(Output("download-excel", "data"), Input("btn-download", "n_clicks"), [State('main-store', 'data'), State('session-store', 'data')], prevent_initial_call=True)
+def download(n, data, session):
+    if session and session.get('recording'): return dash.no_update
+    if not data or not data.get('sid'): return dash.no_update
+    d = store.get(data['sid']).snapshot()
+    if not len(d['t']): return dash.no_update
+    import pandas as pd   # Solo este respaldo lo usa: los workers no lo cargan al arrancar
+    return dcc.send_data_frame(pd.DataFrame(d, columns=CHANNELS).to_excel, "Datos_McKibben_ITToluca.xlsx", index=False)
+
+# =================================================================
+#            MÉTRICAS (MCKIBBEN_METRICS=1)
+# =================================================================
+@server.route('/metrics')
+def exponer_metricas():
+    if not metrics.ENABLED: abort(404)
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+def _callback_id():
+    # "..main-store.data...ind-f.children.." -> "main-store.data"
+    body = request.get_json(silent=True) or {}
+    return str(body.get('output', '?')).strip('.').split('...')[0]
+
+if metrics.ENABLED:
+    @server.before_request
+    def _inicio_callback():
+        if request.path.endswith('/_dash-update-component'):
+            request.environ['mckibben.t0'] = time.perf_counter()
+
+    @server.after_request
+    def _fin_callback(response):
+        t0 = request.environ.get('mckibben.t0')
+        if t0 is not None:
+            metrics.CALLBACK_TIME.observe(time.perf_counter() - t0, callback=_callback_id())
+        return response
 
 if __name__ == '__main__':
+    recover_all()  # Sella grabaciones que quedaron abiertas por una caída (en gunicorn: on_starting)
     app.run(debug=False)
@@ -0,0 +1,150 @@
+import importlib.util
+import os
+import sys
+
+import numpy as np
+
+# ======================================================
+# ANALÍTICA EN LÍNEA SOBRE CADA BLOQUE INGERIDO
+# ======================================================
+# Se aplica en el gestor, justo después de ClockSync y antes de publicar:
+# los canales derivados viajan con la muestra (gráficas, grabación, export).
+# Todo es por bloque y con estado arrastrado entre bloques; nada recorre el
+# historial completo.
+#   f_filt/p_filt/l_filt  mediana móvil (picos de la celda) + Butterworth 2º orden
+#   dl_dt                 derivada de la longitud filtrada (cm/s)
+#   contr                 contracción (L0 - L) / L0, L0 = última longitud en reposo
+#   f_psi                 fuerza por PSI
+#   hyst                  área del último lazo longitud-presión cerrado (cm·PSI)
+SAMPLE_RATE = float(os.environ.get('MCKIBBEN_SAMPLE_HZ', '100'))
+CUTOFF_HZ = float(os.environ.get('MCKIBBEN_FILTER_HZ', '5'))
+MEDIAN_WINDOW = 5
+P_REST = 0.5      # PSI: por debajo se considera músculo en reposo (L0 y cierre de lazo)
+P_MIN = 0.5       # PSI mínima para calcular f_psi
+FILTERED = ('f', 'p', 'l')
+
+HAS_SCIPY = importlib.util.find_spec('scipy') is not None
+
+
+def butter2(cutoff, fs):
+    # Butterworth pasa-bajos de 2º orden por transformación bilineal
+    k = np.tan(np.pi * min(cutoff, 0.45 * fs) / fs)
+    norm = 1.0 / (1.0 + np.sqrt(2.0) * k + k * k)
+    b0 = k * k * norm
+    b = np.array([b0, 2.0 * b0, b0])
+    a = np.array([1.0, 2.0 * (k * k - 1.0) * norm, (1.0 - np.sqrt(2.0) * k + k * k) * norm])
+    return b, a
+
+
+def _lfilter_np(b, a, x, zi):
+    # Forma directa II transpuesta, todos los canales a la vez (x: canales x n)
+    y = np.empty_like(x)
+    z0, z1 = zi[:, 0].copy(), zi[:, 1].copy()
+    for i in range(x.shape[1]):
+        xi = x[:, i]
+        yi = b[0] * xi + z0
+        z0 = b[1] * xi - a[1] * yi + z1
+        z1 = b[2] * xi - a[2] * yi
+        y[:, i] = yi
+    return y, np.stack((z0, z1), axis=1)
+
+
+if HAS_SCIPY:
+    from scipy.signal import lfilter as _scipy_lfilter
+
+    def lfilter(b, a, x, zi):
+        return _scipy_lfilter(b, a, x, axis=1, zi=zi)
+else:
+    # scipy está en requirements.txt; sin él el filtro recorre muestra a muestra
+    print("[AVISO] scipy no está instalado: el filtro IIR usa el respaldo en Python (lento a alta frecuencia)", file=sys.stderr)
+    lfilter = _lfilter_np
+
+
+class Analytics:
+    def __init__(self, fs=SAMPLE_RATE, cutoff=CUTOFF_HZ, median=MEDIAN_WINDOW):
+        self.b, self.a = butter2(cutoff, fs)
+        self.median = median
+        self.zi = None                               # Estado del IIR (canales x 2)
+        self.tail = np.empty((len(FILTERED), 0))     # Últimas muestras crudas para la mediana
+        self.prev_t = np.nan
+        self.prev_l = np.nan
+        self.l0 = np.nan
+        self.loop = 0.0          # Suma de shoelace del lazo en curso
+        self.loop_prev = None    # Último punto (p, l) del lazo
+        self.loop_active = False
+        self.last_area = np.nan
+
+    def reset(self):
+        self.__init__()
+
+    def _median(self, raw):
+        if self.median <= 1: return raw
+        ext = np.concatenate((self.tail, raw), axis=1)
+        self.tail = ext[:, -(self.median - 1):]
+        if ext.shape[1] < self.median: return raw
+        win = np.lib.stride_tricks.sliding_window_view(ext, self.median, axis=1)
+        med = np.median(win, axis=2)
+        # Al inicio (sin historia suficiente) se deja la muestra cruda
+        return np.concatenate((raw[:, :raw.shape[1] - med.shape[1]], med), axis=1)
+
+    def _iir(self, x):
+        if self.zi is None:
+            # Estado estacionario con la primera muestra: sin transitorio desde cero
+            b, a = self.b, self.a
+            self.zi = np.stack(((b[1] - a[1] + b[2] - a[2]) * x[:, 0], (b[2] - a[2]) * x[:, 0]), axis=1)
+        y, self.zi = lfilter(self.b, self.a, x, self.zi)
+        return y
+
+    def _hysteresis(self, p, l):
+        # Área del lazo L-P por shoelace acumulado; un lazo cierra al volver a reposo
+        n = len(p)
+        pp = np.concatenate(([self.loop_prev[0]], p)) if self.loop_prev else p
+        ll = np.concatenate(([self.loop_prev[1]], l)) if self.loop_prev else l
+        cross = np.zeros(n)
+        cross[n - (len(pp) - 1):] = pp[:-1] * ll[1:] - pp[1:] * ll[:-1]
+        rest = p < P_REST
+        out = np.empty(n)
+        start = 0
+        # Solo se itera sobre los cambios reposo <-> presurizado (pocos por bloque)
+        edges = np.flatnonzero(np.diff(np.concatenate(([not self.loop_active], rest)).astype(np.int8)))
+        for i in list(edges) + [n]:
+            out[start:i] = self.last_area
+            if self.loop_active: self.loop += cross[start:i].sum()
+            if i == n: break
+            if rest[i] and self.loop_active:
+                self.last_area = abs(0.5 * (self.loop + cross[i]))
+                self.loop = 0.0
+            self.loop_active = not rest[i]
+            start = i
+        self.loop_prev = (p[-1], l[-1])
+        return out
+
+    def process(self, chunk):
+        # Rellena los campos derivados del bloque (in place) y lo devuelve
+        n = len(chunk)
+        if not n: return chunk
+        raw = np.vstack([chunk[k] for k in FILTERED]).astype(np.float64)
+        filt = self._iir(self._median(raw))
+        f, p, l = filt
+        chunk['f_filt'], chunk['p_filt'], chunk['l_filt'] = f, p, l
+
+        t = chunk['t']
+        dt = np.diff(np.concatenate(([self.prev_t], t)))
+        dl = np.diff(np.concatenate(([self.prev_l], l)))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            chunk['dl_dt'] = np.where(dt > 0, dl / dt, np.nan)
+        self.prev_t, self.prev_l = t[-1], l[-1]
+
+        # L0: última longitud filtrada en reposo (hacia adelante por índice)
+        rest = p < P_REST
+        idx = np.maximum.accumulate(np.where(rest, np.arange(n), -1))
+        l0 = np.where(idx >= 0, l[np.maximum(idx, 0)], self.l0)
+        if rest.any(): self.l0 = l[idx[-1]]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            chunk['contr'] = np.where(l0 > 0, (l0 - l) / l0, np.nan)
+            chunk['f_psi'] = np.where(p > P_MIN, f / p, np.nan)
+        chunk['hyst'] = self._hysteresis(p, l)
+        return chunk
+
+    def summary(self):
+        return {'l0': float(self.l0), 'hyst': float(self.last_area), 'scipy': HAS_SCIPY}
@@ -0,0 +1,18 @@
+/* assets/control.js */
+
+/* Antirrebote de la perilla de presión: mientras el operador la arrastra
+   solo se reprograma el temporizador; al soltar (ms sin cambios) se publica
+   el último valor en knob-setpoint, que es lo que dispara el envío. */
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    control: {
+        debounce: function (value, ms) {
+            if (!ms) return value;
+            const st = window._mckKnob = window._mckKnob || {};
+            clearTimeout(st.timer);
+            st.timer = setTimeout(function () {
+                window.dash_clientside.set_props('knob-setpoint', {data: value});
+            }, ms);
+            return window.dash_clientside.no_update;
+        }
+    }
+});
@@ -0,0 +1,62 @@
+/* assets/push.js */
+
+/* Canal push (SSE): las muestras nuevas llegan en cuanto el gestor las
+   publica y se anexan a las gráficas sin pasar por un callback de Dash. */
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    push: {
+        connect: function (store, intervalDisabled) {
+            const nu = window.dash_clientside.no_update;
+            // Sondeo activo (MCKIBBEN_PUSH=0 o respaldo tras fallos): nada que hacer
+            if (!intervalDisabled || !store || !store.sid || !window.EventSource) return nu;
+            const st = window._mckPush = window._mckPush || {};
+            if (st.sid === store.sid) {
+                if (store.cursor === 0) st.cursor = 0;  // BORRAR
+                return nu;
+            }
+            if (st.source) st.source.close();
+            Object.assign(st, {sid: store.sid, cursor: store.cursor || 0, charts: [], window: 10000, errors: 0});
+
+            const set = window.dash_clientside.set_props;
+            const labels = ['ind-len', 'ind-pres', 'ind-force', 'ind-time', 'ind-ang', 'ind-pwm', 'ind-contr', 'ind-fpsi', 'ind-hyst'];
+
+            const abrir = function () {
+                const es = st.source = new EventSource('/stream/' + st.sid + '?cursor=' + st.cursor);
+                es.addEventListener('config', function (e) {
+                    const cfg = JSON.parse(e.data);
+                    st.charts = cfg.charts;
+                    st.window = cfg.window;
+                    st.errors = 0;
+                });
+                es.addEventListener('samples', function (e) {
+                    const d = JSON.parse(e.data);
+                    st.cursor = d.cursor;
+                    st.charts.forEach(function (c) {
+                        set(c[0], {extendData: [{x: [d[c[1]]], y: [d[c[2]]]}, [0], st.window]});
+                    });
+                });
+                es.addEventListener('telemetry', function (e) {
+                    JSON.parse(e.data).forEach(function (v, i) { set(labels[i], {children: v}); });
+                });
+                es.addEventListener('status', function (e) {
+                    const s = JSON.parse(e.data);
+                    set('status-indicator', {children: s[0], style: s[1]});
+                    set('btn-start', {disabled: s[2]});
+                });
+                es.onerror = function () {
+                    // Reconexión manual para retomar desde el último cursor recibido
+                    es.close();
+                    if (st.source !== es) return;
+                    st.errors += 1;
+                    if (st.errors >= 3) {
+                        st.source = null;
+                        set('intervalo-lectura', {disabled: false});
+                        return;
+                    }
+                    setTimeout(abrir, 1000 * st.errors);
+                };
+            };
+            abrir();
+            return 'push';
+        }
+    }
+});
@@ -0,0 +1,372 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import types
+
+import numpy as np
+
+# ======================================================
+# BENCHMARKS DE LAS RUTAS CALIENTES (INGESTA, CALLBACKS, RENDER, EXPORT)
+# ======================================================
+#   python benchmark.py                    corre todo y guarda benchmarks/<versión>.json
+#   python benchmark.py ingest_mqtt ciclo  solo esos
+#   python benchmark.py --quick            tamaños reducidos (humo)
+#   python benchmark.py --compare          tabla de todas las versiones guardadas
+#   python benchmark.py ingest_paced --rates 1000,20000 --seconds 30
+#                                          telemetría a ritmo fijo con un lector concurrente
+# Cada caso reporta rendimiento (ops/s y muestras/s), latencia p50/p99 por
+# operación y pico de memoria (tracemalloc; numpy le informa sus buffers).
+# Los gestores no se conectan a nada: se les inyectan mensajes sintéticos.
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+SEED = 1234
+# Modo a ritmo controlado: muestras/s objetivo, duración, mensajes/s del equipo y periodo del lector
+PACED_RATES = (1000, 5000, 20000)
+PACED_SECONDS = 10.0
+PACED_MSG_HZ = 100
+PACED_READ_EVERY = 0.05
+
+# Sin broker ni ESP32 reales (fallan rápido); ni grabar en el árbol del repo
+os.environ.setdefault('MCKIBBEN_MQTT_BROKER', '127.0.0.1')
+os.environ.setdefault('MCKIBBEN_MQTT_PORT', '1')
+os.environ.setdefault('MCKIBBEN_ESP_IP', '127.0.0.1')
+os.environ.setdefault('MCKIBBEN_ESP_PORT', '1')
+os.environ.setdefault('MCKIBBEN_PUSH', '0')
+os.environ.pop('MCKIBBEN_INGEST_ADDR', None)
+
+
+def synthetic(n, t0=0.0, rate=1000.0, seed=SEED):
+    # Telemetría sintética reproducible (ciclos de presión con ruido)
+    from wire_format import empty_samples
+    rng = np.random.default_rng(seed)
+    s = empty_samples(n)
+    t = t0 + np.arange(n) / rate
+    p = np.clip(15 * np.sin(2 * np.pi * 0.5 * t), 0, None)
+    s['seq'] = np.arange(n)
+    s['t_dev'] = t
+    s['p'] = p + rng.normal(0, 0.05, n)
+    s['l'] = 20 - 0.2 * p
+    s['f'] = 3 * p + rng.normal(0, 0.5, n)
+    s['a'] = 9 * p
+    s['pwm'] = p * 8.5
+    return s
+
+
+def timed(fn, repeat, warmup=1):
+    for _ in range(warmup): fn()
+    lat = np.empty(repeat)
+    t_start = time.perf_counter()
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        lat[i] = time.perf_counter() - t0
+    total = time.perf_counter() - t_start
+    # Memoria en una pasada aparte: tracemalloc distorsiona los tiempos
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'ops_s': repeat / total, 'p50_ms': float(np.percentile(lat, 50) * 1e3),
+            'p99_ms': float(np.percentile(lat, 99) * 1e3), 'peak_mb': peak / 2**20, 'repeat': repeat}
+
+
+# ------------------------------------------------------
+# CASOS
+# ------------------------------------------------------
+def bench_ingest_mqtt(q):
+    # on_message completo: ruteo por tópico, decodificación, reloj, analítica, publicación
+    import mqtt_manager
+    from wire_format import encode_frames
+    h = mqtt_manager.start()
+    out = {}
+    for batch in (1, 10, 100, 1000):
+        data = synthetic(batch * (50 if q else 400))
+        msgs = [types.SimpleNamespace(topic='mckibben/bench/datos', payload=encode_frames(data[i:i + batch]))
+                for i in range(0, len(data), batch)]
+        it = iter(msgs * 1000)
+        r = timed(lambda: h.on_message(None, None, next(it)), len(msgs))
+        r['samples_s'] = r['ops_s'] * batch
+        out[f'bin_x{batch}'] = r
+    rows = synthetic(50 if q else 400)
+    msgs = [types.SimpleNamespace(topic='mckibben/bench/datos', payload=json.dumps(
+        {'ts': float(r['t_dev']) * 1e3, 'f': float(r['f']), 'l': float(r['l']), 'p': float(r['p']), 'a': float(r['a']), 'pwm': float(r['pwm'])}).encode())
+        for r in rows]
+    it = iter(msgs * 1000)
+    r = timed(lambda: h.on_message(None, None, next(it)), len(msgs))
+    r['samples_s'] = r['ops_s']
+    out['json_x1'] = r
+    h.device('bench').stream.purge()
+    return out
+
+
+def bench_ingest_tcp(q):
+    # recv de 64 KB -> StreamDecoder.feed -> _parse_data (reloj, analítica, publicación)
+    import tcp_manager
+    from wire_format import StreamDecoder, encode_frames
+    dev = tcp_manager.DeviceConnection(None, 'bench', '127.0.0.1')
+    out = {}
+    for fmt in ('bin', 'json'):
+        data = synthetic(20000 if q else 200000)
+        if fmt == 'bin':
+            raw = b''.join(encode_frames(data[i:i + 100]) for i in range(0, len(data), 100))
+        else:
+            raw = ''.join(json.dumps({'ts': float(r['t_dev']) * 1e3, 'f': float(r['f']), 'l': float(r['l']), 'p': float(r['p']),
+                                      'a': float(r['a']), 'pwm': float(r['pwm'])}) + '\n' for r in data).encode()
+        reads = [raw[i:i + 65536] for i in range(0, len(raw), 65536)]
+        decoder = StreamDecoder()
+        it = iter(reads * 1000)
+        r = timed(lambda: dev._parse_data(decoder.feed(next(it)), time.time()), len(reads))
+        r['samples_s'] = r['ops_s'] * len(data) / len(reads)
+        out[fmt] = r
+    return out
+
+
+def bench_ingest_paced(q):
+    # Reproduce telemetría a un ritmo fijo (no "lo más rápido posible") mientras
+    # un lector con cursor propio drena como lo haría una pestaña. Reporta el
+    # ritmo logrado, cuánto se atrasó el emisor respecto al horario, el atraso
+    # del lector (SampleLog) y lo que perdió por desborde.
+    import threading
+    import mqtt_manager
+    from wire_format import encode_frames
+    h = mqtt_manager.start()
+    seconds = PACED_SECONDS / 5 if q else PACED_SECONDS
+    out = {}
+    for rate in PACED_RATES:
+        dev_id = f"paced{rate}"
+        per_msg = max(1, int(rate // PACED_MSG_HZ))
+        data = synthetic(int(rate * seconds), rate=float(rate))
+        msgs = [types.SimpleNamespace(topic=f'mckibben/{dev_id}/datos', payload=encode_frames(data[i:i + per_msg]))
+                for i in range(0, len(data), per_msg)]
+        h.on_message(None, None, msgs[0])       # Crea el equipo antes de medir
+        stream = h.device(dev_id).stream
+        consumer, stop = 'bench-reader', threading.Event()
+        stream.purge(consumer)
+        reader = {'rows': 0, 'max_lag': 0}
+
+        def leer():
+            while not stop.is_set():
+                stream.wait(consumer, PACED_READ_EVERY)
+                lag = stream.log.stats()['consumers'].get(consumer, {}).get('lag', 0)   # Pendiente al leer
+                reader['max_lag'] = max(reader['max_lag'], lag)
+                reader['rows'] += len(stream.get_buffer(consumer)[0])
+                time.sleep(PACED_READ_EVERY)
+
+        th = threading.Thread(target=leer, daemon=True)
+        th.start()
+        lat, behind = np.empty(len(msgs) - 1), 0.0
+        start = time.monotonic()
+        for i, m in enumerate(msgs[1:]):
+            due = start + (i + 1) / (rate / per_msg)
+            wait = due - time.monotonic()
+            if wait > 0: time.sleep(wait)
+            else: behind = max(behind, -wait)
+            t0 = time.perf_counter()
+            h.on_message(None, None, m)
+            lat[i] = time.perf_counter() - t0
+        elapsed = time.monotonic() - start
+        time.sleep(2 * PACED_READ_EVERY)
+        stop.set()
+        th.join()
+        st = stream.log.stats()['consumers'].get(consumer, {})
+        sent = (len(msgs) - 1) * per_msg
+        out[f'r{rate}'] = {'ops_s': (len(msgs) - 1) / elapsed, 'p50_ms': float(np.percentile(lat, 50) * 1e3),
+                           'p99_ms': float(np.percentile(lat, 99) * 1e3), 'target_s': rate, 'samples_s': sent / elapsed,
+                           'behind_ms': behind * 1e3, 'max_lag': reader['max_lag'], 'lost': st.get('lost', 0),
+                           'read': reader['rows'], 'seconds': elapsed}
+    return out
+
+
+def _dash_call(client, dep, values, changed):
+    # POST a /_dash-update-component como lo hace el navegador
+    spec = dep['output']
+    outs = spec[2:-2].split('...') if spec.startswith('..') else [spec]
+    outputs = [dict(zip(('id', 'property'), o.rsplit('.', 1))) for o in outs]
+    body = {'output': spec, 'outputs': outputs if len(outputs) > 1 else outputs[0],
+            'inputs': [{**i, 'value': values.get(f"{i['id']}.{i['property']}")} for i in dep['inputs']],
+            'state': [{**s, 'value': values.get(f"{s['id']}.{s['property']}")} for s in dep['state']],
+            'changedPropIds': [changed]}
+    resp = client.post('/_dash-update-component', json=body)
+    if resp.status_code not in (200, 204): raise RuntimeError(resp.status_code)
+    return resp
+
+
+def _app():
+    import App
+    client = App.server.test_client()
+    deps = client.get('/_dash-dependencies').get_json()
+    return App, client, deps
+
+
+def bench_ciclo(q):
+    # ciclo_datos por HTTP con historial creciente en la sesión: incremental
+    # (50 muestras nuevas por tick) y recarga completa (cursor 0)
+    App, client, deps = _app()
+    dep = next(d for d in deps if any(i['id'] == 'intervalo-lectura' for i in d['inputs']))
+    out = {}
+    for size in ((1000, 10000) if q else (1000, 10000, 100000, 200000)):
+        sid = f"bench-{size}"
+        sess = App.store.get(sid)
+        sess.reset()
+        s = synthetic(size)
+        sess.append({'t': s['t_dev'], **{k: s[k] for k in App.CHANNELS[1:]}})
+        tick = synthetic(50, t0=size / 1000.0)
+        cols = {'t': tick['t_dev'], **{k: tick[k] for k in App.CHANNELS[1:]}}
+        state = {'sid': sid, 'cursor': sess.total}
+
+        def incremental():
+            sess.append(cols)
+            _dash_call(client, dep, {'intervalo-lectura.n_intervals': 1, 'btn-clear.n_clicks': 0,
+                                     'main-store.data': dict(state, cursor=sess.total - 50),
+                                     'session-store.data': {'running': False, 'start_time': None}}, 'intervalo-lectura.n_intervals')
+
+        def full():
+            _dash_call(client, dep, {'intervalo-lectura.n_intervals': 1, 'btn-clear.n_clicks': 0,
+                                     'main-store.data': dict(state, cursor=0),
+                                     'session-store.data': {'running': False, 'start_time': None}}, 'intervalo-lectura.n_intervals')
+
+        out[f'incremental_{size}'] = timed(incremental, 20 if q else 100)
+        out[f'full_{size}'] = timed(full, 3 if q else 10)
+        App.store.drop(sid)
+    return out
+
+
+def bench_render(q):
+    # create_chart x4 (figuras base) y render_view (zoom con M4) sobre el historial
+    App, client, deps = _app()
+    from plotly.io.json import to_json_plotly
+    out = {'create_chart_x4': timed(lambda: [to_json_plotly(App.create_chart([], [], *c[3:])) for c in App.CHARTS], 20 if q else 100)}
+    for size in ((10000,) if q else (10000, 200000)):
+        sid = f"bench-render-{size}"
+        sess = App.store.get(sid)
+        s = synthetic(size)
+        sess.append({'t': s['t_dev'], **{k: s[k] for k in App.CHANNELS[1:]}})
+        out[f'render_view_{size}'] = timed(lambda: App.render_view(sid, App.CHARTS[0], {'width': 700, 'relayout': {'xaxis.autorange': True}}), 10 if q else 50)
+        App.store.drop(sid)
+    from downsampling import downsample
+    x = np.arange(1_000_000, dtype=np.float64)
+    y = np.sin(x / 1000.0)
+    out['m4_1M'] = timed(lambda: downsample(x, y, 700), 5 if q else 20)
+    return out
+
+
+def bench_export(q):
+    # Grabación en disco de N filas -> CSV/XLSX/Parquet en streaming; y el
+    # respaldo anterior (pandas.to_excel de todo el historial) como referencia
+    import tempfile
+    import recorder
+    import exporter
+    out = {}
+    n = 20000 if q else 200000
+    with tempfile.TemporaryDirectory() as root:
+        rec = recorder.new_recording({'start_time': 0.0}, root)
+        s = synthetic(n)
+        s['t'] = s['t_dev']
+        rec.append(s)
+        rec.close()
+        reader = recorder.open_recording(rec.id, root)
+        cols = exporter.parse_columns(None, reader.columns)
+        for fmt in ('csv', 'xlsx', 'parquet'):
+            if not exporter.available(fmt): continue
+            r = timed(lambda: sum(len(b) for b in exporter.EXPORTERS[fmt](reader, cols)), 1, warmup=0)
+            r['rows_s'] = r['ops_s'] * n
+            out[fmt] = r
+        try:
+            import pandas as pd
+            df = pd.DataFrame({c: s[c] for c in ('t', 'f', 'p', 'l', 'a', 'pwm')})
+            r = timed(lambda: df.to_excel(os.path.join(root, 'legacy.xlsx'), index=False), 1, warmup=0)
+            r['rows_s'] = r['ops_s'] * n
+            out['pandas_xlsx'] = r
+        except ImportError:
+            pass
+    return out
+
+
+BENCHES = {'ingest_mqtt': bench_ingest_mqtt, 'ingest_tcp': bench_ingest_tcp, 'ingest_paced': bench_ingest_paced,
+           'ciclo': bench_ciclo, 'render': bench_render, 'export': bench_export}
+
+
+# ------------------------------------------------------
+# RESULTADOS POR VERSIÓN
+# ------------------------------------------------------
+def version():
+    try:
+        rev = subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        rev = ''
+    return rev or time.strftime('%Y%m%d-%H%M%S')
+
+
+def environment():
+    env = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+           'platform': platform.platform(), 'cpus': os.cpu_count()}
+    for mod in ('dash', 'plotly', 'pandas', 'scipy', 'pyarrow', 'openpyxl'):
+        try: env[mod] = __import__(mod).__version__
+        except ImportError: pass
+    return env
+
+
+def compare(root=RESULTS_DIR):
+    runs = []
+    for path in sorted(glob.glob(os.path.join(root, '*.json')), key=os.path.getmtime):
+        with open(path) as f:
+            runs.append(json.load(f))
+    if not runs:
+        print("Sin resultados guardados en", root)
+        return
+    keys = sorted({(b, c, m) for r in runs for b, cases in r['results'].items() for c, v in cases.items()
+                   for m in v if m in ('samples_s', 'rows_s', 'ops_s', 'p99_ms', 'peak_mb', 'behind_ms', 'max_lag', 'lost')})
+    print("caso".ljust(44) + "".join(r['version'][:14].rjust(16) for r in runs))
+    for b, c, m in keys:
+        vals = [r['results'].get(b, {}).get(c, {}).get(m) for r in runs]
+        print(f"{b}.{c}.{m}"[:44].ljust(44) + "".join(("-" if v is None else f"{v:.4g}").rjust(16) for v in vals))
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Benchmarks McKibben")
+    ap.add_argument('benches', nargs='*', help=', '.join(BENCHES))
+    ap.add_argument('--quick', action='store_true')
+    ap.add_argument('--compare', action='store_true')
+    ap.add_argument('--tag', help="Nombre del resultado (por defecto git describe)")
+    ap.add_argument('--no-save', action='store_true')
+    ap.add_argument('--rates', help=f"ingest_paced: muestras/s separadas por coma (por defecto {','.join(map(str, PACED_RATES))})")
+    ap.add_argument('--seconds', type=float, help=f"ingest_paced: duración por ritmo (por defecto {PACED_SECONDS:g})")
+    args = ap.parse_args()
+    if args.rates: PACED_RATES = tuple(int(r) for r in args.rates.split(','))
+    if args.seconds: PACED_SECONDS = args.seconds
+    if args.compare:
+        compare()
+        sys.exit(0)
+    unknown = set(args.benches) - set(BENCHES)
+    if unknown: ap.error(f"casos desconocidos: {', '.join(sorted(unknown))}")
+    import tempfile
+    os.environ.setdefault('MCKIBBEN_RECORDINGS', tempfile.mkdtemp(prefix='mck-bench-'))
+    results = {}
+    for name in args.benches or list(BENCHES):
+        t0 = time.perf_counter()
+        results[name] = BENCHES[name](args.quick)
+        for case, r in results[name].items():
+            rate = r.get('samples_s') or r.get('rows_s')
+            extra = f"  {rate:,.0f}/s" if rate else ""
+            if 'target_s' in r:
+                extra += (f" de {r['target_s']:,}/s  atraso emisor {r['behind_ms']:.1f} ms  lector: atraso máx {r['max_lag']}"
+                          f"  perdidas {r['lost']}")
+            pico = f"pico {r['peak_mb']:7.1f} MB" if 'peak_mb' in r else ""
+            print(f"{name}.{case:<22} {r['ops_s']:10.1f} op/s  p50 {r['p50_ms']:8.3f} ms  p99 {r['p99_ms']:8.3f} ms  "
+                  f"{pico}{extra}")
+        print(f"[{name}] {time.perf_counter() - t0:.1f}s", file=sys.stderr)
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        tag = args.tag or version()
+        doc = {'version': tag, 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'quick': args.quick,
+               'env': environment(), 'results': results}
+        path = os.path.join(RESULTS_DIR, f"{tag}{'-quick' if args.quick else ''}.json")
+        with open(path, 'w') as f:
+            json.dump(doc, f, indent=1)
+        print("Guardado en", path, file=sys.stderr)
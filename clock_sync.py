@@ -0,0 +1,87 @@
+from collections import deque
+
+import numpy as np
+
+# ======================================================
+# SINCRONÍA DE RELOJ ESP32 -> SERVIDOR
+# ======================================================
+# Cada lote trae el tiempo del dispositivo (t_dev). El retardo observado
+# (t_rx - t_dev) = desfase + deriva * t_dev + latencia de red >= 0; la
+# envolvente inferior de esos puntos (mínimo por tramo) elimina la latencia
+# y un ajuste lineal sobre ella da desfase y deriva.
+WINDOW = 120.0         # Segundos de historia (reloj del dispositivo) para el ajuste
+BUCKETS = 12           # Tramos de la envolvente inferior
+MIN_SPAN = 5.0         # Con menos historia solo se estima el desfase
+REFIT_EVERY = 1.0      # Reajuste de la recta como máximo una vez por segundo
+REBOOT_JUMP = 1.0      # t_dev que retrocede más que esto = reinicio del ESP32
+SAMPLE_PERIOD = None   # Firmware sin 'ts' pero con 'seq': periodo de muestreo (s)
+
+
+class ClockSync:
+    def __init__(self, window=WINDOW, sample_period=SAMPLE_PERIOD):
+        self.window = window
+        self.sample_period = sample_period
+        self.pairs = deque()
+        self.offset = None
+        self.drift = 0.0
+        self.ref = 0.0
+        self.last_dev = None
+        self.last_fit = -np.inf
+        self.last_out = -np.inf
+
+    def reset(self):
+        self.pairs.clear()
+        self.offset = None
+        self.drift = 0.0
+        self.last_dev = None
+        self.last_fit = -np.inf
+
+    def update(self, t_dev, t_rx):
+        if self.last_dev is not None and t_dev < self.last_dev - REBOOT_JUMP:
+            self.reset()
+        self.last_dev = t_dev
+        self.pairs.append((t_dev, t_rx - t_dev))
+        while self.pairs and self.pairs[0][0] < t_dev - self.window:
+            self.pairs.popleft()
+        if t_dev - self.last_fit >= REFIT_EVERY or self.offset is None:
+            self.last_fit = t_dev
+            self._fit()
+        else:
+            # Un retardo menor que la recta actual la baja de inmediato
+            resid = (t_rx - t_dev) - (self.offset + self.drift * (t_dev - self.ref))
+            if resid < 0: self.offset += resid
+
+    def _fit(self):
+        dev, delay = np.array(self.pairs).T
+        span = dev[-1] - dev[0]
+        if span < MIN_SPAN or len(dev) < BUCKETS:
+            self.offset, self.drift, self.ref = float(delay.min()), 0.0, float(dev[-1])
+            return
+        # Mínimo por tramo (envolvente inferior) y recta sobre esos puntos
+        bucket = np.minimum(((dev - dev[0]) / span * BUCKETS).astype(int), BUCKETS - 1)
+        order = np.lexsort((delay, bucket))
+        first = order[np.r_[True, bucket[order][1:] != bucket[order][:-1]]]
+        if len(first) < 2:
+            return
+        self.ref = float(dev[-1])
+        self.drift, self.offset = np.polyfit(dev[first] - self.ref, delay[first], 1)
+
+    def to_server(self, t_dev):
+        return t_dev + self.offset + self.drift * (t_dev - self.ref)
+
+    def stamp(self, samples, t_rx):
+        # Rellena samples['t'] (tiempo de servidor) para un lote recién llegado
+        t_dev = samples['t_dev']
+        if self.sample_period:
+            t_dev = np.where(np.isnan(t_dev), samples['seq'] * self.sample_period, t_dev)
+        known = ~np.isnan(t_dev)
+        out = np.full(len(samples), float(t_rx))
+        if known.any():
+            # La muestra más reciente del lote es la de menor latencia
+            self.update(float(t_dev[known][-1]), t_rx)
+            out[known] = self.to_server(t_dev[known])
+        # Monótono por flujo aunque el ajuste se corrija entre lotes
+        out = np.maximum.accumulate(np.maximum(out, self.last_out))
+        self.last_out = out[-1] if len(out) else self.last_out
+        samples['t'] = out
+        return samples
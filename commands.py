@@ -0,0 +1,218 @@
+import itertools
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+# ======================================================
+# CANAL DE COMANDOS CON CONFIRMACIÓN (ACK), REINTENTOS Y LATENCIA
+# ======================================================
+# Los callbacks solo encolan; un hilo propio transmite, espera el ACK y
+# reintenta. Con acuses activos el comando viaja como "<cmd>#<id>" y el
+# firmware responde "ACK:<id>:OK" (o ":ERR") por el tópico/línea de retorno.
+# Sin acuses (firmware anterior) el éxito es la entrega al broker/socket.
+ACKS_ENABLED = os.environ.get('MCKIBBEN_CMD_ACKS', '0') == '1'
+CMD_TIMEOUT = 1.0      # Espera de ACK (o de PUBACK) por intento
+CMD_RETRIES = 2
+MAX_TICKETS = 256      # Historial de comandos consultables por id
+SETPOINT_MAX_RATE = float(os.environ.get('MCKIBBEN_SETPOINT_HZ', '10'))  # Consignas por segundo, máximo
+
+PENDING, SENT, OK, REJECTED, TIMEOUT, ERROR = 'pending', 'sent', 'ok', 'rejected', 'timeout', 'error'
+SUCCESS = (SENT, OK)
+
+
+def command_kind(msg):
+    msg = str(msg)
+    if msg == 'TARA': return 'tara'
+    if msg.startswith('P:'): return 'pid'
+    if msg.isdigit(): return 'pwm'
+    return 'otro'
+
+
+def parse_ack(text):
+    # "ACK:<id>:<OK|ERR>" -> (id, ok) o None
+    parts = text.strip().split(':')
+    if len(parts) < 2 or parts[0] != 'ACK' or not parts[1].isdigit(): return None
+    return int(parts[1]), (len(parts) < 3 or parts[2] == 'OK')
+
+
+class Ticket:
+    def __init__(self, cid, msg):
+        self.id = cid
+        self.msg = str(msg)
+        self.kind = command_kind(msg)
+        self.status = PENDING
+        self.attempts = 0
+        self.latency_ms = None
+        self.created = time.time()
+        self.finished = None        # time.monotonic() al quedar resuelto
+        self.done = threading.Event()
+        self.acked = threading.Event()
+        self.ack_ok = False
+
+    def as_dict(self):
+        return {'id': self.id, 'msg': self.msg, 'kind': self.kind, 'status': self.status,
+                'attempts': self.attempts, 'latency_ms': self.latency_ms}
+
+
+class CommandDispatcher:
+    def __init__(self, transmit, is_connected=lambda: True, acks=ACKS_ENABLED,
+                 timeout=CMD_TIMEOUT, retries=CMD_RETRIES):
+        self.transmit = transmit          # transmit(texto) -> bool, puede bloquear
+        self.is_connected = is_connected
+        self.acks = acks
+        self.timeout = timeout
+        self.retries = retries
+        self.ids = itertools.count(1)
+        self.tickets = OrderedDict()
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.listeners = []               # fn(ticket) al encolar (SetpointCoalescer)
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def submit(self, msg):
+        # No bloquea: devuelve el Ticket, o None si no hay conexión con el dispositivo
+        if not self.is_connected(): return None
+        ticket = Ticket(next(self.ids), msg)
+        with self.lock:
+            self.tickets[ticket.id] = ticket
+            while len(self.tickets) > MAX_TICKETS:
+                self.tickets.popitem(last=False)
+        for fn in self.listeners:
+            fn(ticket)
+        self.queue.put(ticket)
+        return ticket
+
+    def send_and_wait(self, msg, timeout=None):
+        ticket = self.submit(msg)
+        if ticket is None: return False
+        ticket.done.wait(timeout if timeout is not None else self.timeout * (self.retries + 2))
+        return ticket.status in SUCCESS
+
+    def status(self, cid):
+        with self.lock:
+            ticket = self.tickets.get(cid)
+        return ticket.as_dict() if ticket else None
+
+    def on_ack(self, cid, ok=True):
+        with self.lock:
+            ticket = self.tickets.get(cid)
+        if ticket:
+            ticket.ack_ok = ok
+            ticket.acked.set()
+
+    def on_text(self, text):
+        # Para transportes por líneas: acepta cualquier línea y filtra los ACK
+        ack = parse_ack(text)
+        if ack: self.on_ack(*ack)
+
+    def _observe(self, ticket, ms):
+        # Por ticket (lo muestra la UI) y agregado por tipo en /metrics
+        ticket.latency_ms = ms
+        metrics.COMMAND_LATENCY.observe(ms / 1000.0, kind=ticket.kind)
+
+    def _worker(self):
+        while True:
+            ticket = self.queue.get()
+            wire = f"{ticket.msg}#{ticket.id}" if self.acks else ticket.msg
+            t0 = time.perf_counter()
+            # El estado se publica una sola vez al final: mientras queden
+            # reintentos el ticket sigue PENDING para quien lo consulta
+            for _ in range(self.retries + 1):
+                ticket.attempts += 1
+                try: sent = self.transmit(wire)
+                except Exception: sent = False
+                if sent and not self.acks:
+                    status = SENT
+                    break
+                if sent and ticket.acked.wait(self.timeout):
+                    status = OK if ticket.ack_ok else REJECTED
+                    break
+                status = TIMEOUT if sent else ERROR
+            if status in (SENT, OK, REJECTED):
+                self._observe(ticket, (time.perf_counter() - t0) * 1000.0)
+            ticket.status = status
+            ticket.finished = time.monotonic()
+            ticket.done.set()
+
+
+class SetpointCoalescer:
+    # Consignas continuas (perilla de presión): solo importa el último valor.
+    # offer() sobrescribe lo pendiente y un hilo envía a lo sumo max_rate por
+    # segundo, sin repetir el valor ya enviado para la misma clave. Hay a lo
+    # sumo un valor en vuelo por clave: hasta que el despachador resuelve el
+    # anterior (PUBACK/ACK) no se encola otro, así un enlace lento no acumula
+    # consignas viejas. on_ticket recibe el Ticket (o None sin conexión) solo
+    # si ese valor llega a salir.
+    # "Ya enviado" solo vale si se confirmó y si desde entonces no salió otro
+    # comando por el despachador (TARA, P:..., PWM directo): esos cambian el
+    # modo del equipo y la misma consigna tiene que volver a enviarse.
+    def __init__(self, commands, max_rate=SETPOINT_MAX_RATE):
+        self.commands = commands
+        self.period = 1.0 / max_rate if max_rate > 0 else 0.0
+        self.latest = {}
+        self.sent = {}
+        self.inflight = {}
+        self.last_tx = 0.0
+        self.offered = 0
+        self.dispatched = 0
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+        commands.listeners.append(self._on_command)
+
+    def _on_command(self, ticket):
+        if threading.current_thread() is self.thread: return   # Enviado por este coalescedor
+        with self.cond:
+            self.sent.clear()
+
+    def offer(self, key, msg, force=False, on_ticket=None):
+        # force: reenviar aunque coincida con lo último enviado (botón ENVIAR)
+        with self.cond:
+            if force: self.sent.pop(key, None)
+            self.latest[key] = (str(msg), on_ticket)
+            self.offered += 1
+            self.cond.notify()
+        return True
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.latest:
+                    self.cond.wait()
+                wait = self.last_tx + self.period - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)   # Lo que llegue mientras tanto reemplaza al pendiente
+                    continue
+                batch, self.latest = self.latest, {}
+            busy = None
+            for key, item in batch.items():
+                msg, on_ticket = item
+                prev = self.inflight.get(key)
+                if prev is not None and not prev.done.is_set():
+                    with self.cond:
+                        self.latest.setdefault(key, item)   # Sigue pendiente salvo que ya haya uno más nuevo
+                    busy = prev
+                    continue
+                with self.cond:
+                    if prev is not None and prev.status not in SUCCESS and self.sent.get(key) == prev.msg:
+                        del self.sent[key]   # Falló: el mismo valor se puede volver a enviar
+                    if self.sent.get(key) == msg: continue
+                ticket = self.commands.submit(msg)
+                if ticket is not None:
+                    with self.cond:
+                        self.sent[key] = msg
+                    self.inflight[key] = ticket
+                    self.dispatched += 1
+                if on_ticket: on_ticket(ticket)
+            self.last_tx = time.monotonic()
+            if busy is not None: busy.done.wait(self.period or None)
+
+    def stats(self):
+        with self.cond:
+            return {'offered': self.offered, 'sent': self.dispatched,
+                    'coalesced': self.offered - self.dispatched - len(self.latest), 'max_rate': 1.0 / self.period if self.period else None}
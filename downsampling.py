@@ -0,0 +1,73 @@
+import numpy as np
+
+# ======================================================
+# REDUCCIÓN DE PUNTOS PARA GRÁFICAS (M4 / LTTB)
+# ======================================================
+# Ambos conservan picos de fuerza y transitorios de presión; M4 es
+# totalmente vectorizado y se usa por defecto.
+POINTS_PER_PX = 4   # M4 entrega hasta 4 puntos por columna de píxeles
+DEFAULT_WIDTH = 700
+
+
+def _bucket_starts(x, n_buckets, by_index):
+    n = len(x)
+    if by_index or n < 2 or not x[-1] > x[0]:
+        edges = np.linspace(0, n, n_buckets + 1).astype(np.int64)[:-1]
+    else:
+        edges = np.searchsorted(x, np.linspace(x[0], x[-1], n_buckets + 1)[:-1])
+    return np.unique(edges)
+
+
+def _segment_arg(v, starts, counts, reducer):
+    # Primer índice de cada segmento donde se alcanza su mínimo/máximo
+    pos = np.arange(len(v))
+    extreme = np.repeat(reducer.reduceat(v, starts), counts)
+    cand = np.where(v == extreme, pos, len(v))
+    return np.minimum.reduceat(cand, starts)
+
+
+def m4_indices(x, y, n_buckets, by_index=False):
+    n = len(y)
+    if n <= POINTS_PER_PX * n_buckets:
+        return np.arange(n)
+    starts = _bucket_starts(x, n_buckets, by_index)
+    counts = np.diff(np.append(starts, n))
+    keep = [starts, starts + counts - 1,
+            _segment_arg(y, starts, counts, np.minimum),
+            _segment_arg(y, starts, counts, np.maximum)]
+    if by_index:
+        # En curvas x-y (histéresis) también importan los extremos de x
+        keep += [_segment_arg(x, starts, counts, np.minimum),
+                 _segment_arg(x, starts, counts, np.maximum)]
+    idx = np.unique(np.concatenate(keep))
+    return idx[idx < n]
+
+
+def lttb_indices(x, y, n_out):
+    n = len(y)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nxt_hi = edges[i + 2] if i + 2 < len(edges) else n
+        cx, cy = x[hi:nxt_hi].mean(), y[hi:nxt_hi].mean()
+        # Área del triángulo (a, candidato, centroide del siguiente bucket)
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+
+def downsample(x, y, width=DEFAULT_WIDTH, method='m4', by_index=False):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    width = max(int(width or DEFAULT_WIDTH), 1)
+    if method == 'lttb':
+        idx = lttb_indices(x, y, POINTS_PER_PX * width)
+    else:
+        idx = m4_indices(x, y, width, by_index)
+    return x[idx], y[idx]
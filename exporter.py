@@ -0,0 +1,110 @@
+import importlib.util
+import io
+import os
+import tempfile
+
+import numpy as np
+
+from wire_format import DERIVED, TAGS
+
+# ======================================================
+# EXPORTACIÓN EN STREAMING DESDE LA GRABACIÓN EN DISCO
+# ======================================================
+# Se lee la grabación por bloques (memmap) y se emite la salida en trozos:
+# ni el navegador ni la RAM del worker tienen que contener la sesión entera.
+EXPORT_COLUMNS = ('t', 'f', 'l', 'p', 'a', 'pwm') + DERIVED + TAGS
+CHUNK_ROWS = 65536
+FILE_CHUNK = 1 << 20
+XLSX_MAX_ROWS = 1048575   # Límite de Excel por hoja (sin contar el encabezado)
+# CSV: 6 cifras significativas bastan para los sensores, pero no para el tiempo
+# (época en s): se escribe con precisión fija de microsegundos.
+CSV_FMT = '%.6g'
+CSV_FMT_COLUMNS = {'t': '%.6f', 't_dev': '%.6f', 'seq': '%.0f'}
+FORMATS = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+def available(fmt):
+    # Parquet y XLSX dependen de paquetes opcionales
+    mod = {'parquet': 'pyarrow', 'xlsx': 'openpyxl'}.get(fmt)
+    return fmt in FORMATS and (mod is None or importlib.util.find_spec(mod) is not None)
+
+
+def parse_columns(cols, available=EXPORT_COLUMNS):
+    # available: columnas que tiene la grabación (las antiguas no traen derivados)
+    if not cols: return [c for c in EXPORT_COLUMNS if c in available]
+    wanted = [c for c in cols.split(',') if c in EXPORT_COLUMNS and c in available]
+    if 't' not in wanted: wanted.insert(0, 't')
+    return wanted
+
+
+def _chunks(reader, columns, t0, t1):
+    # t0/t1 relativos al inicio de la sesión, como en la gráfica
+    origin = reader.meta.get('start_time') or 0.0
+    lo, hi = reader.row_range(None if t0 is None else origin + t0, None if t1 is None else origin + t1)
+    for chunk in reader.iter_chunks(columns, lo, hi, CHUNK_ROWS):
+        if 't' in chunk: chunk['t'] = chunk['t'] - origin
+        yield chunk
+
+
+def _stream_file(f):
+    # Devuelve el archivo temporal por trozos y lo borra al terminar
+    try:
+        f.seek(0)
+        while True:
+            block = f.read(FILE_CHUNK)
+            if not block: break
+            yield block
+    finally:
+        f.close()
+
+
+def iter_csv(reader, columns, t0=None, t1=None):
+    yield (','.join(columns) + '\n').encode()
+    fmt = [CSV_FMT_COLUMNS.get(c, CSV_FMT) for c in columns]
+    for chunk in _chunks(reader, columns, t0, t1):
+        buf = io.StringIO()
+        np.savetxt(buf, np.column_stack([chunk[c] for c in columns]), delimiter=',', fmt=fmt)
+        yield buf.getvalue().encode()
+
+
+def iter_parquet(reader, columns, t0=None, t1=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    f = tempfile.TemporaryFile()
+    schema = pa.schema([(c, pa.float64()) for c in columns])
+    with pq.ParquetWriter(f, schema) as writer:
+        for chunk in _chunks(reader, columns, t0, t1):
+            # Un row group por bloque leído
+            writer.write_table(pa.table({c: chunk[c].astype(np.float64) for c in columns}, schema=schema))
+    yield from _stream_file(f)
+
+
+def iter_xlsx(reader, columns, t0=None, t1=None):
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)   # Modo de memoria constante de openpyxl
+    ws, rows, sheet = None, XLSX_MAX_ROWS, 0
+    for chunk in _chunks(reader, columns, t0, t1):
+        for row in np.column_stack([chunk[c] for c in columns]).tolist():
+            if rows >= XLSX_MAX_ROWS:
+                sheet += 1
+                ws = wb.create_sheet(f"Datos_{sheet}")
+                ws.append(list(columns))
+                rows = 0
+            ws.append(row)
+            rows += 1
+    if ws is None:
+        wb.create_sheet("Datos_1").append(list(columns))
+    f = tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False)
+    try:
+        f.close()
+        wb.save(f.name)
+        yield from _stream_file(open(f.name, 'rb'))
+    finally:
+        os.unlink(f.name)
+
+
+EXPORTERS = {'csv': iter_csv, 'parquet': iter_parquet, 'xlsx': iter_xlsx}
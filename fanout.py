@@ -0,0 +1,348 @@
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+from wire_format import SAMPLE_DTYPE, latest_tuple
+from ingest_buffer import IngestRing, CAPACITY, POLICIES, DROP_OLDEST, DROP_NEWEST, DECIMATE
+from commands import CommandDispatcher, SetpointCoalescer, CMD_TIMEOUT as ACK_TIMEOUT, CMD_RETRIES
+import metrics
+from sequencer import PhaseTimeline
+
+# ======================================================
+# DIFUSIÓN DE MUESTRAS A VARIOS CONSUMIDORES
+# ======================================================
+# SampleLog: registro compartido con posiciones absolutas; cada consumidor
+# (pestaña, worker, grabador) lleva su propio cursor y nadie le quita
+# muestras a otro. Cada consumidor tiene además un atraso máximo
+# (consumer_capacity); si lo supera se aplica la política de desborde del
+# gestor (ingest_buffer.POLICIES) y lo descartado suma en su 'lost'.
+# LogServer/RemoteHandler permiten que un solo proceso
+# tenga la conexión MQTT/TCP y los workers web lean por un socket local.
+LOG_CAPACITY = 1 << 18
+CONSUMER_TTL = 600      # Segundos sin leer antes de olvidar un consumidor
+STATUS_EVERY = 1.0      # Periodo del mensaje de estado hacia los workers
+CMD_TIMEOUT = ACK_TIMEOUT * (CMD_RETRIES + 1) + 1.0  # Cubre los reintentos del proceso de ingesta
+
+INGEST_ADDR = os.environ.get('MCKIBBEN_INGEST_ADDR')  # "host:puerto" o "unix:/ruta"
+
+
+class SampleLog:
+    def __init__(self, capacity=LOG_CAPACITY, dtype=SAMPLE_DTYPE, consumer_capacity=None, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"política de desborde desconocida: {policy}")
+        self.capacity = capacity
+        self.consumer_capacity = min(consumer_capacity or capacity, capacity)
+        self.policy = policy
+        self.buf = np.empty(capacity, dtype=dtype)
+        self.head = 0
+        self.cond = threading.Condition()
+        self.cursors = {}   # consumidor -> [cursor, última lectura, perdidas]
+
+    def append(self, chunk):
+        n = len(chunk)
+        if not n: return
+        with self.cond:
+            if n > self.capacity:
+                self.head += n - self.capacity
+                chunk = chunk[-self.capacity:]
+                n = self.capacity
+            pos = self.head % self.capacity
+            first = min(n, self.capacity - pos)
+            self.buf[pos:pos + first] = chunk[:first]
+            self.buf[:n - first] = chunk[first:]
+            self.head += n
+            self.cond.notify_all()
+
+    def read(self, cursor, max_n=None):
+        # Devuelve (muestras, nuevo cursor, perdidas); la copia es sin cerrojo
+        with self.cond:
+            head = self.head
+        start = max(cursor, head - self.capacity, 0)
+        end = head if max_n is None else min(head, start + max_n)
+        lost = start - cursor
+        pos, n = start % self.capacity, end - start
+        if pos + n <= self.capacity:
+            out = self.buf[pos:pos + n].copy()
+        else:
+            out = np.concatenate((self.buf[pos:], self.buf[:pos + n - self.capacity]))
+        # Si un escritor dio la vuelta durante la copia, lo pisado se descarta
+        with self.cond:
+            oldest = self.head - self.capacity
+        if oldest > start:
+            cut = min(oldest - start, n)
+            out, lost = out[cut:], lost + cut
+        return out, end, lost
+
+    def wait(self, cursor, timeout=None):
+        with self.cond:
+            self.cond.wait_for(lambda: self.head > cursor, timeout)
+            return self.head
+
+    def _entry(self, consumer):
+        with self.cond:
+            entry = self.cursors.get(consumer)
+            if entry is None:
+                limit = time.time() - CONSUMER_TTL
+                for old in [c for c, e in self.cursors.items() if e[1] < limit]:
+                    del self.cursors[old]
+                entry = self.cursors[consumer] = [self.head, time.time(), 0]
+            return entry
+
+    def consume(self, consumer, max_n=None):
+        entry = self._entry(consumer)
+        cursor, dropped = entry[0], 0
+        with self.cond:
+            head = self.head
+        limit = self.consumer_capacity
+        over = head - max(cursor, head - self.capacity) - limit
+        if over > 0 and self.policy == DROP_OLDEST:
+            cursor, dropped = head - limit, max(0, head - limit - cursor)
+        elif over > 0 and self.policy == DROP_NEWEST:
+            # Se entrega lo más viejo que cabe y lo que llegó después se salta
+            max_n = limit if max_n is None else min(max_n, limit)
+        out, end, lost = self.read(cursor, max_n)
+        if over > 0 and self.policy == DROP_NEWEST and end < head:
+            dropped, end = head - end, head
+        elif self.policy == DECIMATE and len(out) > limit:
+            stride = 1 << int(np.ceil(np.log2(len(out) / limit)))   # 1 de cada 2, 4, ...
+            dropped, out = len(out) - len(out[::stride]), out[::stride]
+        entry[0] = end
+        entry[1] = time.time()
+        entry[2] += lost + dropped
+        return out
+
+    def seek_head(self, consumer):
+        entry = self._entry(consumer)
+        with self.cond:
+            entry[0] = self.head
+
+    def stats(self):
+        with self.cond:
+            return {'head': self.head, 'capacity': self.capacity, 'consumer_capacity': self.consumer_capacity, 'policy': self.policy,
+                    'consumers': {str(c): {'lag': self.head - e[0], 'lost': e[2]} for c, e in self.cursors.items()}}
+
+
+class SampleStream:
+    # Un flujo de sensores: registro compartido + buffer acotado de un lector.
+    # capacity/policy valen para cada consumidor del registro (atraso máximo y
+    # qué hacer al superarlo). El buffer de drenado destructivo (compatibilidad)
+    # se crea recién cuando alguien lee sin consumidor y usa los mismos valores.
+    def __init__(self, capacity=CAPACITY, policy=DROP_OLDEST, log_capacity=LOG_CAPACITY):
+        self.capacity = capacity
+        self.policy = policy
+        self.ring = None
+        self.log = SampleLog(log_capacity, consumer_capacity=capacity, policy=policy)
+        self.latest_vals = (0.0, 0.0, 0.0, 0.0, 0.0)
+        self.sinks = []     # Consumidores en línea (grabador...); False = soltar
+
+    def add_sink(self, sink):
+        self.sinks = self.sinks + [sink]
+
+    def publish(self, chunk):
+        if not len(chunk): return
+        self.latest_vals = latest_tuple(chunk)
+        if self.ring is not None: self.ring.push(chunk)
+        self.log.append(chunk)
+        if self.sinks:
+            done = [s for s in self.sinks if s(chunk) is False]
+            if done: self.sinks = [s for s in self.sinks if s not in done]
+
+    def get_buffer(self, consumer=None):
+        # Sin consumidor: drenado destructivo (compatibilidad); con él, cursor propio
+        t0 = time.perf_counter()
+        if consumer is None:
+            if self.ring is None: self.ring = IngestRing(self.capacity, self.policy)
+            chunk = self.ring.drain()
+        else:
+            chunk = self.log.consume(consumer)
+        if metrics.ENABLED:
+            metrics.DRAIN_TIME.observe(time.perf_counter() - t0)
+            metrics.DRAIN_SIZE.observe(len(chunk))
+        return chunk, self.latest_vals
+
+    def wait(self, consumer, timeout=None):
+        # Bloquea hasta que haya muestras nuevas para `consumer` (o timeout)
+        return self.log.wait(self.log._entry(consumer)[0], timeout)
+
+    def purge(self, consumer=None):
+        if consumer is None:
+            if self.ring is not None: self.ring.clear()
+        else: self.log.seek_head(consumer)
+
+    def stats(self):
+        return {**(self.ring.stats() if self.ring is not None else {}), 'log': self.log.stats()}
+
+
+# ======================================================
+# MODO PROCESO DE INGESTA ÚNICO (SOCKET LOCAL)
+# ======================================================
+# Mensajes: tipo (1 byte) | longitud u32 | cuerpo
+#   D: muestras SAMPLE_DTYPE crudas   S: estado JSON
+#   C: comando JSON (worker->ingesta) R: respuesta JSON
+MSG = struct.Struct('<cI')
+
+
+def _socket_for(address):
+    if address.startswith('unix:'):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM), address[5:]
+    host, port = address.rsplit(':', 1)
+    return socket.socket(socket.AF_INET, socket.SOCK_STREAM), (host, int(port))
+
+
+def _send(sock, kind, body, lock):
+    with lock:
+        sock.sendall(MSG.pack(kind, len(body)) + body)
+
+
+def _recv_exact(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        part = sock.recv(n - len(data))
+        if not part: raise ConnectionError("socket cerrado")
+        data += part
+    return bytes(data)
+
+
+def _recv(sock):
+    kind, n = MSG.unpack(_recv_exact(sock, MSG.size))
+    return kind, _recv_exact(sock, n)
+
+
+class LogServer:
+    # Corre en el proceso dueño de la conexión; sirve el log a cada worker
+    def __init__(self, stream, is_connected, send, address):
+        self.stream = stream
+        self.is_connected = is_connected
+        self.send = send
+        self.address = address
+
+    def serve_forever(self):
+        srv, addr = _socket_for(self.address)
+        if srv.family == socket.AF_UNIX and os.path.exists(addr):
+            os.unlink(addr)
+        else:
+            srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        srv.bind(addr)
+        srv.listen()
+        print(f"[INGESTA] Sirviendo muestras en {self.address}", file=sys.stderr)
+        while True:
+            conn, _ = srv.accept()
+            threading.Thread(target=self._serve_client, args=(conn,), daemon=True).start()
+
+    def _status(self):
+        return json.dumps({'connected': bool(self.is_connected()),
+                           'latest': list(self.stream.latest_vals)}).encode()
+
+    def _commands(self, conn, lock):
+        try:
+            while True:
+                kind, body = _recv(conn)
+                if kind == b'C':
+                    req = json.loads(body)
+                    ok = bool(self.send(req['msg']))
+                    _send(conn, b'R', json.dumps({'id': req['id'], 'ok': ok}).encode(), lock)
+        except (OSError, ConnectionError, ValueError):
+            pass
+
+    def _serve_client(self, conn):
+        lock = threading.Lock()
+        log = self.stream.log
+        cursor = log.head
+        threading.Thread(target=self._commands, args=(conn, lock), daemon=True).start()
+        try:
+            last_status = 0.0
+            while True:
+                log.wait(cursor, STATUS_EVERY)
+                out, cursor, _ = log.read(cursor)
+                if len(out): _send(conn, b'D', out.tobytes(), lock)
+                if time.time() - last_status >= STATUS_EVERY:
+                    _send(conn, b'S', self._status(), lock)
+                    last_status = time.time()
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+
+class RemoteHandler:
+    # Lado del worker web: misma interfaz que los gestores MQTT/TCP
+    def __init__(self, address):
+        self.address = address
+        self.stream = SampleStream()
+        self.phases = PhaseTimeline()   # Protocolos lanzados desde este worker
+        self.connected = False
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.pending = {}
+        self.next_id = 0
+        # El proceso de ingesta ya espera el ACK y reintenta: aquí un solo intento
+        self.commands = CommandDispatcher(self.send_cmd, lambda: self.sock is not None, acks=False, retries=0)
+        self.setpoints = SetpointCoalescer(self.commands)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.sock, addr = _socket_for(self.address)
+                self.sock.connect(addr)
+                while True:
+                    kind, body = _recv(self.sock)
+                    if kind == b'D':
+                        chunk = np.frombuffer(body, dtype=SAMPLE_DTYPE).copy()
+                        metrics.MESSAGES.inc(transport='ingest')
+                        metrics.SAMPLES.inc(len(chunk), transport='ingest')
+                        self.stream.publish(self.phases.tag(chunk))
+                    elif kind == b'S':
+                        st = json.loads(body)
+                        self.connected = st['connected']
+                        self.stream.latest_vals = tuple(st['latest'])
+                    elif kind == b'R':
+                        rep = json.loads(body)
+                        waiter = self.pending.get(rep['id'])
+                        if waiter: waiter[1] = rep['ok']; waiter[0].set()
+            except (OSError, ConnectionError, ValueError):
+                pass
+            self.connected = False
+            if self.sock:
+                try: self.sock.close()
+                except OSError: pass
+            self.sock = None
+            time.sleep(1)
+
+    def send_cmd(self, msg):
+        if self.sock is None: return False
+        with self.send_lock:
+            self.next_id += 1
+            cid = self.next_id
+        waiter = self.pending[cid] = [threading.Event(), False]
+        try:
+            _send(self.sock, b'C', json.dumps({'id': cid, 'msg': str(msg)}).encode(), self.send_lock)
+            waiter[0].wait(CMD_TIMEOUT)
+            return waiter[1]
+        except (OSError, AttributeError):
+            return False
+        finally:
+            self.pending.pop(cid, None)
+
+    send_command = send_cmd  # Nombre que usa tcp_manager
+
+
+if __name__ == '__main__':
+    # Proceso de ingesta: python fanout.py [mqtt|tcp] [dirección]
+    backend = sys.argv[1] if len(sys.argv) > 1 else 'mqtt'
+    address = sys.argv[2] if len(sys.argv) > 2 else (INGEST_ADDR or '127.0.0.1:7700')
+    os.environ.pop('MCKIBBEN_INGEST_ADDR', None)  # Este proceso sí abre la conexión real
+    if backend == 'tcp':
+        import tcp_manager as manager
+        stream = manager.start().stream
+    else:
+        import mqtt_manager as manager
+        stream = manager.start().stream
+    LogServer(stream, manager.is_esp_connected, lambda msg: manager.send_command_sync(msg, CMD_TIMEOUT - 0.5), address).serve_forever()
@@ -0,0 +1,32 @@
+import os
+
+# ======================================================
+# GUNICORN (RENDER): "gunicorn App:server" lee este archivo solo
+# ======================================================
+# La app se importa una vez en el maestro (preload) y los workers la heredan
+# por fork. Importar App no abre conexiones ni hilos; cada worker arranca la
+# suya después del fork y la cierra limpia al salir. La recuperación de
+# grabaciones corre una sola vez, en el maestro, antes de crear workers.
+wsgi_app = 'App:server'
+preload_app = os.environ.get('MCKIBBEN_PRELOAD', '1') == '1'
+# El push por SSE (/stream/<sid>) ocupa un hilo por pestaña abierta: con el
+# worker síncrono una sola pestaña bloquea el tablero y el timeout la corta.
+# gthread atiende cada conexión en su hilo y el latido del worker no depende
+# de cuánto dure una respuesta.
+worker_class = 'gthread'
+threads = int(os.environ.get('MCKIBBEN_THREADS', '32'))
+
+
+def on_starting(server):
+    from recorder import recover_all
+    recover_all()
+
+
+def post_worker_init(worker):
+    import mqtt_manager
+    mqtt_manager.start()
+
+
+def worker_exit(server, worker):
+    import mqtt_manager
+    mqtt_manager.stop()
@@ -0,0 +1,115 @@
+import threading
+
+import numpy as np
+
+from wire_format import SAMPLE_DTYPE
+
+# ======================================================
+# BUFFER DE INGESTA ACOTADO (RING BUFFER DOBLE)
+# ======================================================
+# Capacidad fija: si nadie drena (ninguna pestaña abierta) la memoria no
+# crece. Dos arreglos preasignados: drain() solo intercambia el activo bajo
+# el cerrojo y copia fuera de él mientras el escritor usa el otro.
+DROP_OLDEST = 'drop-oldest'     # Se pierde lo más viejo (por defecto)
+DROP_NEWEST = 'drop-newest'     # Se rechaza lo que llega con el buffer lleno
+DECIMATE = 'decimate'           # Se conserva 1 de cada 2, 4, ... hasta el drenado
+POLICIES = (DROP_OLDEST, DROP_NEWEST, DECIMATE)
+CAPACITY = 1 << 16
+
+
+class IngestRing:
+    def __init__(self, capacity=CAPACITY, policy=DROP_OLDEST, dtype=SAMPLE_DTYPE):
+        if policy not in POLICIES:
+            raise ValueError(f"política de desborde desconocida: {policy}")
+        self.capacity = capacity
+        self.policy = policy
+        self._bufs = [np.empty(capacity, dtype=dtype), np.empty(capacity, dtype=dtype)]
+        self._active = 0
+        self._start = 0
+        self._count = 0
+        self._stride = 1
+        self._phase = 0
+        self.received = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def _write(self, chunk):
+        buf, cap = self._bufs[self._active], self.capacity
+        pos = (self._start + self._count) % cap
+        first = min(len(chunk), cap - pos)
+        buf[pos:pos + first] = chunk[:first]
+        buf[:len(chunk) - first] = chunk[first:]
+        self._count += len(chunk)
+
+    def _ordered(self, buf, start, count):
+        end = start + count
+        if end <= self.capacity:
+            return buf[start:end].copy()
+        return np.concatenate((buf[start:], buf[:end - self.capacity]))
+
+    def _halve(self):
+        # Solo ocurre al desbordar en modo DECIMATE
+        buf = self._bufs[self._active]
+        kept = self._ordered(buf, self._start, self._count)[::2]
+        self.dropped += self._count - len(kept)
+        buf[:len(kept)] = kept
+        self._start, self._count = 0, len(kept)
+        self._stride *= 2
+
+    def push(self, chunk):
+        n = len(chunk)
+        if not n: return
+        with self._lock:
+            self.received += n
+            if self._stride > 1:
+                keep = (np.arange(n) + self._phase) % self._stride == 0
+                self._phase = (self._phase + n) % self._stride
+                self.dropped += n - int(keep.sum())
+                chunk = chunk[keep]
+            free = self.capacity - self._count
+            if len(chunk) > free:
+                if self.policy == DROP_NEWEST:
+                    self.dropped += len(chunk) - free
+                    chunk = chunk[:free]
+                elif self.policy == DECIMATE:
+                    while len(chunk) > self.capacity - self._count:
+                        self._halve()
+                        kept = chunk[::2]
+                        self.dropped += len(chunk) - len(kept)
+                        chunk = kept
+                else:
+                    if len(chunk) >= self.capacity:
+                        self.dropped += self._count + len(chunk) - self.capacity
+                        chunk = chunk[-self.capacity:]
+                        self._start, self._count = 0, 0
+                    else:
+                        over = len(chunk) - free
+                        self.dropped += over
+                        self._start = (self._start + over) % self.capacity
+                        self._count -= over
+            if len(chunk):
+                self._write(chunk)
+
+    def drain(self):
+        with self._drain_lock:
+            with self._lock:
+                buf, start, count = self._bufs[self._active], self._start, self._count
+                self._active ^= 1
+                self._start = self._count = 0
+                self._stride, self._phase = 1, 0
+            # El escritor ya usa el otro arreglo: la copia no bloquea la ingesta
+            return self._ordered(buf, start, count)
+
+    def clear(self):
+        with self._lock:
+            self._start = self._count = 0
+            self._stride, self._phase = 1, 0
+
+    def stats(self):
+        with self._lock:
+            return {'received': self.received, 'dropped': self.dropped, 'depth': self._count,
+                    'capacity': self.capacity, 'policy': self.policy}
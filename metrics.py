@@ -0,0 +1,191 @@
+import os
+import threading
+
+# ======================================================
+# INSTRUMENTACIÓN (FORMATO DE TEXTO DE PROMETHEUS)
+# ======================================================
+# Contadores, medidores e histogramas en memoria del proceso; App.py los
+# expone en /metrics. Apagado (por defecto) cada inc/observe sale en la
+# primera línea y la ruta responde 404. Con MCKIBBEN_METRICS=1 el costo es
+# un cerrojo y una suma por evento; los medidores de buffers se calculan
+# solo al leer /metrics.
+ENABLED = os.environ.get('MCKIBBEN_METRICS', '0') == '1'
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'))
+SIZE_BUCKETS = (0, 1, 10, 50, 100, 500, 1000, 5000, 10000, 65536, float('inf'))
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REGISTRY = []
+
+
+def _escape(v):
+    # Formato de texto: \\, \" y salto de línea escapados dentro de las comillas
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    if not names: return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in zip(names, values)) + '}'
+
+
+def _num(v):
+    if v == float('inf'): return '+Inf'
+    return repr(float(v))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(k, '')) for k in self.labelnames)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, v) for key, v in self.values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for name, key, v in self.samples():
+            lines.append(f'{name}{_labels(self.labelnames, key)} {_num(v)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, n=1, **labels):
+        if not ENABLED: return
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+
+class Gauge(Metric):
+    # Valor fijado con set() o calculado al leer: track(fn), fn() -> {etiquetas: valor}
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.sources = []
+
+    def set(self, value, **labels):
+        if not ENABLED: return
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def track(self, fn):
+        self.sources.append(fn)
+
+    def samples(self):
+        out = super().samples()
+        for fn in self.sources:
+            try: found = fn()
+            except Exception: continue
+            out += [(self.name, self._key(labels), v) for labels, v in found]
+        return out
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, help, labels)
+        self.bounds = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if not ENABLED: return
+        key = self._key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.bounds), 0, 0.0]
+            for i, b in enumerate(self.bounds):
+                if value <= b:
+                    entry[0][i] += 1
+                    break
+            entry[1] += 1
+            entry[2] += value
+
+    def samples(self):
+        # Buckets acumulados (le), _sum y _count como espera Prometheus
+        out = []
+        with self.lock:
+            items = [(key, list(e[0]), e[1], e[2]) for key, e in self.values.items()]
+        for key, counts, total, acc in items:
+            running = 0
+            for b, c in zip(self.bounds, counts):
+                running += c
+                out.append((self.name + '_bucket', key + (_num(b),), running))
+            out.append((self.name + '_sum', key, acc))
+            out.append((self.name + '_count', key, total))
+        return out
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for name, key, v in self.samples():
+            names = self.labelnames + ('le',) if name.endswith('_bucket') else self.labelnames
+            lines.append(f'{name}{_labels(names, key)} {_num(v)}')
+        return lines
+
+
+def render():
+    lines = []
+    for m in REGISTRY:
+        lines += m.render()
+    return '\n'.join(lines) + '\n'
+
+
+# ======================================================
+# MÉTRICAS DEL SISTEMA
+# ======================================================
+MESSAGES = Counter('mckibben_messages_total', 'Mensajes MQTT o lecturas TCP recibidas', ('transport', 'device'))
+SAMPLES = Counter('mckibben_samples_parsed_total', 'Muestras decodificadas', ('transport', 'device'))
+PARSE_FAILURES = Counter('mckibben_parse_failures_total', 'Cargas o líneas que no se pudieron decodificar', ('transport', 'device'))
+ERRORS = Counter('mckibben_errors_total', 'Excepciones atrapadas en la ruta de datos', ('where',))
+BUFFER_DEPTH = Gauge('mckibben_buffer_depth', 'Muestras en el registro compartido', ('transport', 'device'))
+BUFFER_DROPPED = Gauge('mckibben_buffer_dropped', 'Muestras que los lectores activos perdieron por desborde (acumulado)', ('transport', 'device'))
+CONSUMER_LAG = Gauge('mckibben_consumer_lag', 'Muestras pendientes del lector más atrasado', ('transport', 'device'))
+DRAIN_SIZE = Histogram('mckibben_drain_batch_samples', 'Muestras entregadas por get_buffer', buckets=SIZE_BUCKETS)
+DRAIN_TIME = Histogram('mckibben_get_buffer_seconds', 'Duración de get_buffer (incluye espera de cerrojos)')
+SAMPLE_AGE = Histogram('mckibben_sample_age_seconds', 'Edad de la última muestra al llegar al navegador', ('path',))
+CALLBACK_TIME = Histogram('mckibben_callback_seconds', 'Duración de callbacks de Dash', ('callback',))
+COMMAND_LATENCY = Histogram('mckibben_command_latency_seconds', 'Envío -> PUBACK/ACK de comandos (reintentos incluidos)', ('kind',))
+
+
+def track_streams(transport, devices):
+    # devices() -> {id: SampleStream}; se recorre solo al leer /metrics.
+    # Todo sale del registro compartido (cursores por consumidor); el buffer
+    # destructivo de compatibilidad solo suma si alguien lo está usando.
+    def depth():
+        out = []
+        for d, s in devices().items():
+            st = s.log.stats()
+            out.append(({'transport': transport, 'device': d}, min(st['head'], st['capacity'])))
+        return out
+
+    def dropped():
+        out = []
+        for d, s in devices().items():
+            lost = sum(e['lost'] for e in s.log.stats()['consumers'].values())
+            if s.ring is not None: lost += s.ring.dropped
+            out.append(({'transport': transport, 'device': d}, lost))
+        return out
+
+    def lag():
+        out = []
+        for d, s in devices().items():
+            lags = [e['lag'] for e in s.log.stats()['consumers'].values()]
+            if s.ring is not None: lags.append(len(s.ring))
+            out.append(({'transport': transport, 'device': d}, max(lags, default=0)))
+        return out
+
+    BUFFER_DEPTH.track(depth)
+    BUFFER_DROPPED.track(dropped)
+    CONSUMER_LAG.track(lag)
@@ -1,24 +1,116 @@
 import paho.mqtt.client as mqtt
-import json
 import time
 import threading
 import sys
+import os
+import random
+
+from wire_format import decode_payload
+from clock_sync import ClockSync
+from analytics import Analytics
+from ingest_buffer import DROP_OLDEST
+from fanout import SampleStream, RemoteHandler, INGEST_ADDR
+from commands import CommandDispatcher, SetpointCoalescer, parse_ack, CMD_TIMEOUT
+import metrics
+from replay import get_player, players as replays, PREFIX as REPLAY_PREFIX
+from sequencer import PhaseTimeline
 
 # ======================================================
 # CONFIGURACIÓN HIVEMQ (RENDER SÍ PERMITE TCP)
 # ======================================================
-MQTT_BROKER = "e56647093f1949248358d14fc9d9b917.s1.eu.hivemq.cloud"
-MQTT_PORT = 8883   # <--- Usamos 8883 (SSL) porque Render lo permite
+MQTT_BROKER = os.environ.get('MCKIBBEN_MQTT_BROKER', "e56647093f1949248358d14fc9d9b917.s1.eu.hivemq.cloud")
+MQTT_PORT = int(os.environ.get('MCKIBBEN_MQTT_PORT', '8883'))   # <--- Usamos 8883 (SSL) porque Render lo permite
+MQTT_TLS = MQTT_PORT == 8883   # Broker local (p. ej. con simulator.py) en 1883 sin SSL
 MQTT_USER = "esp32"
 MQTT_PASS = "Clave1234"
 
 TOPIC_DATOS = "mckibben/datos"
 TOPIC_CMD   = "mckibben/cmd"
+TOPIC_ACK   = "mckibben/ack"   # Acuses "ACK:<id>:OK" del firmware (MCKIBBEN_CMD_ACKS=1)
+CMD_QOS = 1                    # Al menos una vez hasta el broker (PUBACK)
+
+# Varios bancos en el mismo broker: mckibben/<equipo>/datos|cmd|ack.
+# Los tópicos sin equipo (firmware anterior) son del equipo por defecto.
+DEFAULT_DEVICE = 'esp32'
+TOPIC_DEV_DATOS = "mckibben/+/datos"
+TOPIC_DEV_ACK   = "mckibben/+/ack"
+MAX_DEVICES = 64
+UNKNOWN_DEVICE = '?'   # Etiqueta de métricas para tópicos de equipos no registrados
+DEVICE_STALE = 5.0             # Segundos sin datos antes de mostrar un equipo como inactivo
+
+# Ciclo de vida: importar este módulo no conecta nada. La conexión se crea en
+# el primer uso (o con start(), p. ej. desde gunicorn.conf.py tras el fork) y
+# una sola vez por proceso. El primer intento se retrasa al azar hasta
+# START_JITTER s y los reintentos crecen hasta RECONNECT_MAX: tras un redeploy
+# los workers no llegan todos a la vez al broker.
+START_JITTER = float(os.environ.get('MCKIBBEN_START_JITTER', '2'))
+RECONNECT_MIN, RECONNECT_MAX = 1, 60
+
+# Atraso máximo de cada lector (muestras) y qué hacer cuando lo supera
+INGEST_CAPACITY = 65536
+OVERFLOW_POLICY = DROP_OLDEST
+
+class MQTTDevice:
+    # Flujo, reloj y comandos de un equipo; la conexión al broker es compartida
+    def __init__(self, handler, dev_id):
+        self.handler = handler
+        self.id = dev_id
+        self.topic_cmd = TOPIC_CMD if dev_id == DEFAULT_DEVICE else f"mckibben/{dev_id}/cmd"
+        self.stream = SampleStream(INGEST_CAPACITY, OVERFLOW_POLICY)
+        self.clock = ClockSync()
+        self.analytics = Analytics()
+        self.phases = PhaseTimeline()
+        self.last_seen = 0.0
+        self.lock = threading.Lock()
+        self._commands = None
+        self._setpoints = None
+
+    @property
+    def connected(self): return self.handler.connected
+
+    @property
+    def online(self): return self.handler.connected and time.time() - self.last_seen < DEVICE_STALE
+
+    @property
+    def commands(self):
+        # Se crea con el primer comando: los equipos que solo publican no suman hilos
+        with self.lock:
+            if self._commands is None:
+                self._commands = CommandDispatcher(self._transmit, lambda: self.connected)
+            return self._commands
+
+    @property
+    def setpoints(self):
+        commands = self.commands
+        with self.lock:
+            if self._setpoints is None:
+                self._setpoints = SetpointCoalescer(commands)
+            return self._setpoints
+
+    def ingest(self, chunk, t_rx):
+        with self.lock:
+            self.last_seen = t_rx
+            self.clock.stamp(chunk, t_rx)
+            self.phases.tag(chunk)
+            self.analytics.process(chunk)
+            self.stream.publish(chunk)
+
+    def on_ack(self, payload):
+        ack = parse_ack(payload.decode('utf-8', errors='ignore'))
+        if ack and self._commands: self._commands.on_ack(*ack)
+
+    def _transmit(self, msg):
+        # Corre en el hilo del despachador: puede esperar el PUBACK sin frenar a Dash
+        if not self.connected: return False
+        try:
+            info = self.handler.client.publish(self.topic_cmd, str(msg), qos=CMD_QOS)
+            info.wait_for_publish(CMD_TIMEOUT)
+            return info.is_published()
+        except (RuntimeError, ValueError):
+            return False
 
 class MQTTClientHandler:
     def __init__(self):
-        print("[SISTEMA] Iniciando MQTT para Render...", file=sys.stderr)
-        
         # --- FIX PARA PAHO-MQTT 2.0 ---
         # Usamos VERSION1 para compatibilidad total
         try:
@@ -27,71 +119,153 @@ class MQTTClientHandler:
             self.client = mqtt.Client()
 
         # Configuración SSL (Obligatoria para HiveMQ)
-        self.client.tls_set()
+        if MQTT_TLS: self.client.tls_set()
         self.client.username_pw_set(MQTT_USER, MQTT_PASS)
+        self.client.reconnect_delay_set(RECONNECT_MIN, RECONNECT_MAX)
 
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         
         self.connected = False
-        self.data_buffer = []
-        self.latest_vals = (0.0, 0.0, 0.0, 0.0, 0.0) 
+        self.devices = {}
         self.lock = threading.Lock()
+        self.device(DEFAULT_DEVICE)
 
+    def start(self):
+        print("[SISTEMA] Iniciando MQTT para Render...", file=sys.stderr)
+        # connect_async no bloquea: conexión y reintentos corren en el hilo de paho
         try:
-            self.client.connect(MQTT_BROKER, MQTT_PORT, 60)
-            self.client.loop_start()
+            self.client.connect_async(MQTT_BROKER, MQTT_PORT, 60)
         except Exception as e:
             print(f"[ERROR CRÍTICO] {e}", file=sys.stderr)
+            return
+        timer = threading.Timer(random.uniform(0, START_JITTER), self.client.loop_start)
+        timer.daemon = True
+        timer.start()
+
+    def stop(self):
+        try:
+            self.client.disconnect()
+            self.client.loop_stop()
+        except Exception:
+            pass
+
+    def device(self, dev_id=None, create=True):
+        dev_id = dev_id or DEFAULT_DEVICE
+        dev = self.devices.get(dev_id)
+        if dev is None and create:
+            with self.lock:
+                dev = self.devices.get(dev_id)
+                if dev is None and len(self.devices) < MAX_DEVICES:
+                    dev = self.devices[dev_id] = MQTTDevice(self, dev_id)
+        return dev
+
+    # Interfaz de un solo equipo (fanout, funciones puente): el equipo por defecto
+    @property
+    def stream(self): return self.device().stream
+
+    @property
+    def commands(self): return self.device().commands
+
+    @property
+    def setpoints(self): return self.device().setpoints
 
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             print("[EXITO] ¡CONECTADO A HIVEMQ DESDE RENDER!", file=sys.stderr)
             self.connected = True
-            client.subscribe(TOPIC_DATOS)
+            client.subscribe([(TOPIC_DATOS, 0), (TOPIC_DEV_DATOS, 0), (TOPIC_ACK, 1), (TOPIC_DEV_ACK, 1)])
         else:
             print(f"[ERROR] Código de rechazo: {rc}", file=sys.stderr)
             self.connected = False
 
     def on_message(self, client, userdata, msg):
+        # JSON (firmware anterior) o trama binaria con varias muestras
+        t_rx = time.time()
+        parts = msg.topic.split('/')
+        if len(parts) == 2: dev_id, kind = DEFAULT_DEVICE, parts[1]
+        elif len(parts) == 3: dev_id, kind = parts[1], parts[2]
+        else: return
+        if kind == 'ack':
+            dev = self.device(dev_id, create=False)
+            if dev: dev.on_ack(msg.payload)
+            return
+        # Las etiquetas de métricas salen de equipos ya registrados (tope MAX_DEVICES):
+        # un tópico cualquiera no abre series nuevas
         try:
-            payload = msg.payload.decode()
-            data = json.loads(payload)
-            vals = (
-                float(data.get('f', 0)),
-                float(data.get('l', 0)),
-                float(data.get('p', 0)),
-                float(data.get('a', 0)),
-                float(data.get('pwm', 0))
-            )
-            with self.lock:
-                self.data_buffer.append(vals)
-                self.latest_vals = vals
-        except:
-            pass
-
-    def get_buffer(self):
-        with self.lock:
-            if not self.data_buffer:
-                return [], self.latest_vals
-            chunk = list(self.data_buffer)
-            self.data_buffer.clear()
-            return chunk, self.latest_vals
-    
-    def clear_buffer(self):
-        with self.lock:
-            self.data_buffer.clear()
+            chunk = decode_payload(msg.payload)
+        except Exception:
+            dev = self.device(dev_id, create=False)
+            metrics.PARSE_FAILURES.inc(transport='mqtt', device=dev.id if dev else UNKNOWN_DEVICE)
+            return
+        if not len(chunk): return
+        dev = self.device(dev_id)
+        if dev is None: return
+        metrics.MESSAGES.inc(transport='mqtt', device=dev.id)
+        metrics.SAMPLES.inc(len(chunk), transport='mqtt', device=dev.id)
+        dev.ingest(chunk, t_rx)
 
     def send_cmd(self, msg):
-        if self.connected:
-            self.client.publish(TOPIC_CMD, str(msg))
-            return True
-        return False
+        return self.commands.submit(msg) is not None
+
+mqtt_handler = None
+_owner_pid = None
+_start_lock = threading.Lock()
+
+def start():
+    # Idempotente; si el proceso viene de un fork (preload) crea su propia conexión
+    global mqtt_handler, _owner_pid
+    if mqtt_handler is not None and _owner_pid == os.getpid(): return mqtt_handler
+    with _start_lock:
+        if mqtt_handler is None or _owner_pid != os.getpid():
+            # Con MCKIBBEN_INGEST_ADDR la conexión la tiene otro proceso (fanout.py)
+            handler = RemoteHandler(INGEST_ADDR) if INGEST_ADDR else MQTTClientHandler()
+            if not INGEST_ADDR: handler.start()
+            mqtt_handler, _owner_pid = handler, os.getpid()
+    return mqtt_handler
+
+def stop():
+    global mqtt_handler
+    if mqtt_handler is not None and _owner_pid == os.getpid() and not INGEST_ADDR:
+        mqtt_handler.stop()
+    mqtt_handler = None
+
+def _streams():
+    h = mqtt_handler
+    if h is None or _owner_pid != os.getpid(): return {}
+    if INGEST_ADDR: return {DEFAULT_DEVICE: h.stream}
+    return {k: d.stream for k, d in list(h.devices.items())}
+
+metrics.track_streams('ingest' if INGEST_ADDR else 'mqtt', _streams)
 
-mqtt_handler = MQTTClientHandler()
+# device=None: equipo por defecto (en modo remoto solo hay ese)
+def _dev(device=None):
+    player = get_player(device)
+    if player: return player
+    h = start()
+    # Un reproductor ya liberado no crea un equipo con su id: se vuelve al por defecto
+    return h if device is None or INGEST_ADDR else h.device(device, create=not device.startswith(REPLAY_PREFIX)) or h.device()
 
-def get_sensor_buffer(): return mqtt_handler.get_buffer()
-def send_tcp_command(msg): return mqtt_handler.send_cmd(msg)
-def is_esp_connected(): return mqtt_handler.connected
-def purge_buffer(): mqtt_handler.clear_buffer()
+# consumer: id propio (p. ej. sesión del navegador) para leer sin quitarle muestras a otros
+def get_sensor_buffer(consumer=None, device=None): return _dev(device).stream.get_buffer(consumer)
+def send_tcp_command(msg, device=None): return _dev(device).commands.submit(msg) is not None
+def send_setpoint(msg, key='pwm', force=False, device=None): return _dev(device).setpoints.offer(key, msg, force)
+def submit_command(msg, device=None):
+    ticket = _dev(device).commands.submit(msg)
+    return ticket.id if ticket else None
+def command_status(cid, device=None): return _dev(device).commands.status(cid)
+def send_command_sync(msg, timeout=None, device=None): return _dev(device).commands.send_and_wait(msg, timeout)
+def is_esp_connected(device=None): return _dev(device).connected
+def purge_buffer(consumer=None, device=None): _dev(device).stream.purge(consumer)
+def wait_sensor_data(consumer, timeout=None, device=None): return _dev(device).stream.wait(consumer, timeout)
+def get_ingest_stats(device=None): return _dev(device).stream.stats()
+def get_sample_stream(device=None): return _dev(device).stream
+def get_phase_timeline(device=None): return getattr(_dev(device), 'phases', None)
+def get_command_channels(device=None):
+    dev = _dev(device)
+    return dev.commands, dev.setpoints
+def list_devices():
+    h = start()
+    devs = {DEFAULT_DEVICE: h.connected} if INGEST_ADDR else {k: d.online for k, d in list(h.devices.items())}
+    return {**devs, **{k: p.online for k, p in list(replays.items())}}
 def set_target_ip(ip): pass
@@ -0,0 +1,303 @@
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from wire_format import SAMPLE_DTYPE
+
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+    import msvcrt
+
+# ======================================================
+# GRABACIÓN PERSISTENTE EN DISCO (COLUMNAR POR SEGMENTOS)
+# ======================================================
+# recordings/<id>/
+#   meta.json            datos de la sesión (inicio, estado, filas)
+#   index.json           segmentos sellados y filas selladas
+#   open_<fila>.bin      segmento abierto: registros SAMPLE_DTYPE en append
+#   seg_<n>/<col>.npy    segmento sellado: un .npy por columna (memmap)
+#   lock                 cerrojo del proceso que escribe (lo suelta el SO si muere)
+# El archivo abierto se sincroniza (fsync) en lotes; al llegar a
+# SEGMENT_ROWS se sella. Tras una caída, recover() sella lo que quedó; si el
+# cerrojo está tomado el dueño sigue vivo (otro worker, la CLI del
+# secuenciador...) y la grabación no se toca.
+RECORDINGS_DIR = os.environ.get('MCKIBBEN_RECORDINGS', 'recordings')
+SEGMENT_ROWS = 1 << 18
+FSYNC_EVERY = 1.0
+COLUMNS = SAMPLE_DTYPE.names
+# Grabaciones anteriores a los canales derivados (meta.json sin 'columns')
+LEGACY_COLUMNS = ('t', 'seq', 't_dev', 'f', 'l', 'p', 'a', 'pwm')
+
+
+def record_dtype(columns):
+    return np.dtype([(c, SAMPLE_DTYPE.fields[c][0]) for c in columns])
+
+
+def _meta_columns(path):
+    meta = _read_json(os.path.join(path, 'meta.json'), {})
+    return tuple(meta.get('columns', LEGACY_COLUMNS))
+
+
+def _write_json(path, obj):
+    # Reemplazo atómico: nunca queda un JSON a medias
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _read_json(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def _lock(path):
+    # Cerrojo exclusivo sin espera; None si otro proceso (o escritor) lo tiene
+    f = open(os.path.join(path, 'lock'), 'a+b')
+    try:
+        if fcntl: fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+class Recording:
+    def __init__(self, path, meta=None):
+        self.path = path
+        self.id = os.path.basename(path)
+        os.makedirs(path, exist_ok=True)
+        self.lock_file = _lock(path)
+        if self.lock_file is None:
+            raise OSError(f"grabación en uso por otro proceso: {self.id}")
+        recover(path, owned=True)
+        self.meta = _read_json(os.path.join(path, 'meta.json')) or {'id': self.id, 'created': time.time(), 'columns': list(COLUMNS), **(meta or {})}
+        self.meta['state'] = 'recording'
+        self.index = _read_json(os.path.join(path, 'index.json'), {'rows': 0, 'segments': []})
+        self.open_start = self.index['rows']
+        self.open_rows = 0
+        self.f = open(self._open_path(self.open_start), 'ab')
+        self.pending = []
+        self.paused = False
+        self.lock = threading.Lock()
+        self.io_lock = threading.Lock()
+        self.closed = threading.Event()
+        _write_json(os.path.join(path, 'meta.json'), self.meta)
+        self.thread = threading.Thread(target=self._flusher, daemon=True)
+        self.thread.start()
+
+    def _open_path(self, start):
+        return os.path.join(self.path, f"open_{start:012d}.bin")
+
+    def __len__(self):
+        return self.index['rows'] + self.open_rows + sum(len(c) for c in self.pending)
+
+    def append(self, chunk):
+        # Se llama desde el hilo de ingesta: solo encola, la E/S va en el hilo propio.
+        # Devuelve False cuando ya está cerrada para que el flujo la suelte.
+        if self.closed.is_set(): return False
+        if self.paused or not len(chunk): return True
+        with self.lock:
+            self.pending.append(chunk)
+        return True
+
+    def _flusher(self):
+        while not self.closed.wait(FSYNC_EVERY):
+            self.flush()
+
+    def flush(self):
+        with self.io_lock:
+            with self.lock:
+                chunks, self.pending = self.pending, []
+            if chunks:
+                self.f.write(np.concatenate(chunks).tobytes())
+                self.open_rows += sum(len(c) for c in chunks)
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            if self.open_rows >= SEGMENT_ROWS:
+                self._seal()
+
+    def _seal(self):
+        if not self.open_rows: return
+        old_path, start = self._open_path(self.open_start), self.open_start
+        self.f.close()
+        end = seal_segment(self.path, self.index, old_path, start)
+        self.open_start, self.open_rows = end, 0
+        self.f = open(self._open_path(end), 'ab')
+
+    def close(self):
+        if self.closed.is_set(): return
+        self.closed.set()
+        self.thread.join()
+        self.flush()
+        with self.io_lock:
+            self._seal()
+            self.f.close()
+            try: os.remove(self._open_path(self.open_start))
+            except OSError: pass
+        self.meta.update(state='closed', rows=self.index['rows'], closed=time.time())
+        _write_json(os.path.join(self.path, 'meta.json'), self.meta)
+        self.lock_file.close()
+
+
+def seal_segment(path, index, open_path, start, dtype=SAMPLE_DTYPE):
+    rows = np.fromfile(open_path, dtype=dtype)
+    n = len(index['segments'])
+    seg = os.path.join(path, f"seg_{n:05d}")
+    tmp = seg + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for col in dtype.names:
+        np.save(os.path.join(tmp, f"{col}.npy"), np.ascontiguousarray(rows[col]))
+    os.replace(tmp, seg)
+    end = start + len(rows)
+    t = rows['t'][~np.isnan(rows['t'])]
+    index['segments'].append({'name': os.path.basename(seg), 'start': start, 'rows': len(rows),
+                              't0': float(t[0]) if len(t) else None, 't1': float(t[-1]) if len(t) else None})
+    index['rows'] = end
+    # Orden de escritura: segmento -> índice -> borrar archivo abierto
+    _write_json(os.path.join(path, 'index.json'), index)
+    os.remove(open_path)
+    return end
+
+
+def recover(path, owned=False):
+    # Sella archivos abiertos que dejó una caída y borra segmentos huérfanos.
+    # Devuelve None (sin tocar nada) si la grabación sigue teniendo dueño vivo.
+    lock = None if owned else _lock(path)
+    if not owned and lock is None: return None
+    try:
+        return _recover(path)
+    finally:
+        if lock: lock.close()
+
+
+def _recover(path):
+    index = _read_json(os.path.join(path, 'index.json'), {'rows': 0, 'segments': []})
+    known = {s['name'] for s in index['segments']}
+    dtype = record_dtype(_meta_columns(path))
+    for name in sorted(os.listdir(path)):
+        full = os.path.join(path, name)
+        if name.startswith('seg_') and name not in known:
+            shutil.rmtree(full, ignore_errors=True)
+        elif name.startswith('open_') and name.endswith('.bin'):
+            start = int(name[5:-4])
+            size = os.path.getsize(full)
+            if start < index['rows'] or size < dtype.itemsize:
+                os.remove(full)
+                continue
+            with open(full, 'r+b') as f:
+                f.truncate(size - size % dtype.itemsize)
+            seal_segment(path, index, full, start, dtype)
+    return index
+
+
+class RecordingReader:
+    # Lectura en memoria constante: cada columna de cada segmento es un memmap
+    def __init__(self, path):
+        self.path = path
+        self.id = os.path.basename(path)
+        self.meta = _read_json(os.path.join(path, 'meta.json'), {})
+        self.index = _read_json(os.path.join(path, 'index.json'), {'rows': 0, 'segments': []})
+        self.columns = tuple(self.meta.get('columns', LEGACY_COLUMNS))
+        dtype = record_dtype(self.columns)
+        self._open = None
+        opens = [n for n in os.listdir(path) if n.startswith('open_') and n.endswith('.bin')]
+        if opens and int(max(opens)[5:-4]) == self.index['rows']:
+            # Grabación en curso: también se ve lo ya sincronizado del segmento abierto
+            full = os.path.join(path, max(opens))
+            try:
+                n = os.path.getsize(full) // dtype.itemsize
+                if n: self._open = (self.index['rows'], np.memmap(full, dtype=dtype, mode='r', shape=(n,)))
+            except OSError:
+                pass  # Se selló justo ahora
+
+    def __len__(self):
+        return self.index['rows'] + (len(self._open[1]) if self._open else 0)
+
+    def _segments(self):
+        for seg in self.index['segments']:
+            base = os.path.join(self.path, seg['name'])
+            yield seg['start'], seg['rows'], lambda col, base=base: np.load(os.path.join(base, f"{col}.npy"), mmap_mode='r')
+        if self._open:
+            start, mm = self._open
+            yield start, len(mm), lambda col, mm=mm: mm[col]
+
+    def iter_chunks(self, columns=None, start=0, stop=None, chunk_rows=65536):
+        # Rango de filas [start, stop) en bloques {columna: arreglo}
+        columns = list(columns or self.columns)
+        stop = len(self) if stop is None else min(stop, len(self))
+        for seg_start, rows, col in self._segments():
+            lo, hi = max(start, seg_start), min(stop, seg_start + rows)
+            if lo >= hi: continue
+            cols = {c: col(c) for c in columns}
+            for a in range(lo - seg_start, hi - seg_start, chunk_rows):
+                b = min(a + chunk_rows, hi - seg_start)
+                yield {c: np.asarray(cols[c][a:b]) for c in columns}
+
+    def read(self, columns=None, start=0, stop=None):
+        parts = list(self.iter_chunks(columns, start, stop))
+        columns = list(columns or self.columns)
+        if not parts: return {c: np.empty(0) for c in columns}
+        return {c: np.concatenate([p[c] for p in parts]) for c in columns}
+
+    def row_range(self, t0=None, t1=None):
+        # Filas cuyo tiempo de servidor cae en [t0, t1]; t es monótono entre segmentos
+        if t0 is None and t1 is None: return 0, len(self)
+        lo = hi = 0
+        for _, rows, col in self._segments():
+            t = col('t')
+            lo += int(np.searchsorted(t, t0)) if t0 is not None else 0
+            hi += int(np.searchsorted(t, t1, side='right')) if t1 is not None else rows
+        return lo, hi
+
+
+def new_recording(meta=None, root=RECORDINGS_DIR):
+    rec_id = time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:6]
+    return Recording(os.path.join(root, rec_id), meta)
+
+
+def list_recordings(root=RECORDINGS_DIR):
+    if not os.path.isdir(root): return []
+    out = []
+    for name in sorted(os.listdir(root), reverse=True):
+        meta = _read_json(os.path.join(root, name, 'meta.json'))
+        if meta: out.append(meta)
+    return out
+
+
+def open_recording(rec_id, root=RECORDINGS_DIR):
+    path = os.path.join(root, os.path.basename(rec_id))
+    if not os.path.isfile(os.path.join(path, 'meta.json')):
+        raise FileNotFoundError(rec_id)
+    return RecordingReader(path)
+
+
+def recover_all(root=RECORDINGS_DIR):
+    # Al arrancar: sella lo que dejó una caída y marca esas sesiones como interrumpidas
+    for meta in list_recordings(root):
+        path = os.path.join(root, meta['id'])
+        if meta.get('state') == 'recording':
+            try:
+                index = recover(path)
+                if index is None: continue   # Otro proceso la sigue escribiendo
+                meta.update(state='interrupted', rows=index['rows'])
+                _write_json(os.path.join(path, 'meta.json'), meta)
+            except OSError as e:
+                print(f"[ERROR] Recuperando {meta['id']}: {e}", file=sys.stderr)
@@ -0,0 +1,293 @@
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+
+from wire_format import SAMPLE_DTYPE, DERIVED, empty_samples
+from analytics import Analytics, SAMPLE_RATE
+from fanout import SampleStream
+from commands import CommandDispatcher, SetpointCoalescer
+from recorder import RECORDINGS_DIR, new_recording, open_recording
+
+# ======================================================
+# REPRODUCCIÓN DE SESIONES GRABADAS
+# ======================================================
+# Un ReplayPlayer se comporta como un equipo más: tiene su SampleStream y
+# los gestores lo resuelven por id ("replay:<grabación>") en _dev(), así que
+# get_sensor_buffer/wait_sensor_data/etc. sirven igual que en vivo. La
+# grabación se lee por memmap (recorder.RecordingReader): solo se tocan las
+# páginas que se van reproduciendo. CSV/XLSX se importan una vez a una
+# grabación (por bloques) y desde ahí se reproducen igual.
+# El tiempo de salida conserva el espaciado grabado y es monótono: tras un
+# salto (seek) continúa donde iba, como si la sesión siguiera.
+# Cada reproductor ocupa un SampleStream completo y un hilo: App lo detiene al
+# cambiar de fuente y los que nadie lee (o ya terminaron) se liberan solos.
+PREFIX = 'replay:'
+TICK = 0.02               # Periodo del hilo de reproducción (s)
+MIN_SPEED, MAX_SPEED = 1.0, 100.0
+MAX_TICK_ROWS = 65536     # Tope por tick (100x a alta frecuencia)
+IMPORT_ROWS = 65536
+IDLE_TTL = 300            # Segundos sin lectores ni controles antes de liberar
+FINISHED_TTL = 60         # Igual, para una reproducción que llegó al final
+SWEEP_EVERY = 30
+
+players = {}
+_lock = threading.Lock()
+
+
+class ReplayPlayer:
+    def __init__(self, reader, speed=1.0):
+        self.id = PREFIX + reader.id
+        self.reader = reader
+        self.columns = [c for c in reader.columns if c in SAMPLE_DTYPE.names]
+        self.stream = SampleStream()
+        # Grabaciones sin canales derivados (anteriores o importadas a mano): se calculan al vuelo
+        self.analytics = None if all(c in self.columns for c in DERIVED) else Analytics()
+        # Columna de tiempo de cada segmento (memmap) para buscar por tiempo sin leer el resto
+        self.times = [(start, col('t')) for start, rows, col in reader._segments()]
+        self.rows = len(reader)
+        if not self.rows: raise ValueError(f"grabación vacía: {reader.id}")
+        self.t_first = self._t_at(0)
+        self.t_last = self._t_at(self.rows - 1)
+        self.pos = 0
+        self.speed = min(max(float(speed), MIN_SPEED), MAX_SPEED)
+        self.paused = False
+        self.offset = None        # t_salida - t_grabado
+        self.last_out = None
+        self.closed = False
+        self.last_active = time.time()
+        self._commands = None
+        self._setpoints = None
+        self.cond = threading.Condition()
+        self._anchor()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # Interfaz de equipo (como MQTTDevice/DeviceConnection)
+    @property
+    def connected(self): return not self.closed
+
+    online = connected
+
+    @property
+    def commands(self):
+        # No hay firmware al otro lado: todo comando se rechaza (submit -> None)
+        with self.cond:
+            if self._commands is None:
+                self._commands = CommandDispatcher(lambda msg: False, lambda: False)
+            return self._commands
+
+    @property
+    def setpoints(self):
+        commands = self.commands
+        with self.cond:
+            if self._setpoints is None:
+                self._setpoints = SetpointCoalescer(commands)
+            return self._setpoints
+
+    def _t_at(self, row):
+        for start, t in self.times:
+            if row < start + len(t): return float(t[row - start])
+        return np.nan
+
+    def _row_after(self, t_rec):
+        # Primera fila con t > t_rec
+        for start, t in self.times:
+            if len(t) and t[-1] > t_rec:
+                return start + int(np.searchsorted(t, t_rec, side='right'))
+        return self.rows
+
+    def _anchor(self):
+        # Reloj de reproducción: (pared, grabado) en la posición actual
+        self.wall0 = time.monotonic()
+        self.rec0 = self._t_at(self.pos) if self.pos < self.rows else self.t_last
+
+    def _samples(self, block):
+        n = len(block['t'])
+        out = empty_samples(n)
+        for c in self.columns:
+            out[c] = block[c]
+        if self.offset is None:
+            self.offset = time.time() - out['t'][0]
+        out['t'] += self.offset
+        if self.analytics: self.analytics.process(out)
+        return out
+
+    def _run(self):
+        while not self.closed:
+            with self.cond:
+                while (self.paused or self.pos >= self.rows) and not self.closed:
+                    self.cond.wait()
+                target = self.rec0 + (time.monotonic() - self.wall0) * self.speed
+                lo = self.pos
+                hi = min(self._row_after(target), lo + MAX_TICK_ROWS)
+                self.pos = hi
+            if hi > lo:
+                for block in self.reader.iter_chunks(self.columns, lo, hi):
+                    chunk = self._samples(block)
+                    self.last_out = float(chunk['t'][-1])
+                    self.stream.publish(chunk)
+            with self.cond:
+                if self.pos >= self.rows: self.paused = True
+            time.sleep(TICK)
+
+    def idle_for(self, now=None):
+        # Segundos desde la última lectura de algún consumidor o control del usuario
+        with self.stream.log.cond:
+            reads = [e[1] for e in self.stream.log.cursors.values()]
+        return (now or time.time()) - max(reads + [self.last_active])
+
+    def play(self):
+        self.last_active = time.time()
+        with self.cond:
+            wrap = self.pos >= self.rows
+            if wrap: self.pos = 0
+            self.paused = False
+            self._anchor()
+            if wrap and self.last_out is not None:
+                # Como en seek(): la salida sigue hacia adelante desde donde terminó
+                self.offset = self.last_out + 1.0 / SAMPLE_RATE - self.rec0
+                if self.analytics: self.analytics.reset()
+            self.cond.notify()
+
+    def pause(self):
+        self.last_active = time.time()
+        with self.cond:
+            self.paused = True
+
+    def set_speed(self, speed):
+        self.last_active = time.time()
+        with self.cond:
+            self.speed = min(max(float(speed), MIN_SPEED), MAX_SPEED)
+            self._anchor()
+
+    def seek(self, seconds):
+        # seconds: desde el inicio de la grabación
+        self.last_active = time.time()
+        with self.cond:
+            self.pos = min(self._row_after(self.t_first + max(0.0, float(seconds)) - 1e-9), self.rows)
+            self._anchor()
+            if self.last_out is not None and self.pos < self.rows:
+                # Sigue el tiempo de salida donde iba (gráficas y grabación sin retrocesos)
+                self.offset = self.last_out + 1.0 / SAMPLE_RATE - self.rec0
+            if self.analytics: self.analytics.reset()
+            self.cond.notify()
+
+    def status(self):
+        with self.cond:
+            pos = self._t_at(self.pos) if self.pos < self.rows else self.t_last
+            return {'id': self.id, 'recording': self.reader.id, 'rows': self.rows, 'row': self.pos,
+                    'position': pos - self.t_first, 'duration': self.t_last - self.t_first,
+                    'speed': self.speed, 'paused': self.paused, 'done': self.pos >= self.rows}
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+
+# ======================================================
+# REGISTRO (LO CONSULTAN LOS GESTORES)
+# ======================================================
+_next_sweep = 0.0
+
+
+def expire_players(now=None):
+    # Libera reproductores sin actividad; los finalizados esperan menos
+    now = now or time.time()
+    for dev_id, player in list(players.items()):
+        ttl = FINISHED_TTL if player.status()['done'] else IDLE_TTL
+        if player.idle_for(now) > ttl: stop_replay(dev_id)
+
+
+def start_replay(rec_id, speed=1.0, root=RECORDINGS_DIR):
+    expire_players()
+    reader = open_recording(rec_id, root)
+    player = ReplayPlayer(reader, speed)
+    with _lock:
+        old = players.pop(player.id, None)
+        players[player.id] = player
+    if old: old.close()
+    return player.id
+
+
+def get_player(dev_id):
+    # Lo consultan los gestores en cada llamada: aprovecha para barrer de vez en cuando
+    global _next_sweep
+    if players and time.monotonic() > _next_sweep:
+        _next_sweep = time.monotonic() + SWEEP_EVERY
+        expire_players()
+    return players.get(dev_id) if dev_id else None
+
+
+def stop_replay(dev_id):
+    with _lock:
+        player = players.pop(dev_id, None)
+    if player: player.close()
+
+
+# ======================================================
+# IMPORTACIÓN CSV / XLSX -> GRABACIÓN
+# ======================================================
+def _csv_blocks(path):
+    import pandas as pd
+    for df in pd.read_csv(path, chunksize=IMPORT_ROWS):
+        yield list(df.columns), df.to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def _xlsx_blocks(path):
+    # Modo de solo lectura de openpyxl: filas en streaming, hoja por hoja
+    from openpyxl import load_workbook
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            rows = ws.iter_rows(values_only=True)
+            header = next(rows, None)
+            if not header: continue
+            header, block = [str(h).strip() for h in header], []
+            for row in rows:
+                block.append([np.nan if v is None else v for v in row])
+                if len(block) >= IMPORT_ROWS:
+                    yield header, np.array(block, dtype=np.float64)
+                    block = []
+            if block: yield header, np.array(block, dtype=np.float64)
+    finally:
+        wb.close()
+
+
+def import_table(path, root=RECORDINGS_DIR):
+    # Columnas reconocidas por nombre (las de EXPORT_COLUMNS); sin 't' se asume SAMPLE_RATE
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in ('.csv', '.xlsx'):
+        raise ValueError(f"formato no soportado: {ext}")
+    blocks = _csv_blocks(path) if ext == '.csv' else _xlsx_blocks(path)
+    rec = new_recording({'source': os.path.basename(path), 'imported': True, 'start_time': 0.0}, root)
+    analytics, row = None, 0
+    try:
+        for header, data in blocks:
+            cols = {h: i for i, h in enumerate(header) if h in SAMPLE_DTYPE.names}
+            chunk = empty_samples(len(data))
+            for c, i in cols.items():
+                chunk[c] = data[:, i]
+            if 't' not in cols: chunk['t'] = (row + np.arange(len(data))) / SAMPLE_RATE
+            if not all(c in cols for c in DERIVED):
+                analytics = analytics or Analytics()
+                analytics.process(chunk)
+            row += len(data)
+            rec.append(chunk)
+            rec.flush()
+    finally:
+        rec.close()
+    return rec.id
+
+
+if __name__ == '__main__':
+    # python replay.py archivo.csv|archivo.xlsx  -> importa y muestra el id de la grabación
+    parser = argparse.ArgumentParser(description="Importa CSV/XLSX como grabación reproducible")
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--root', default=RECORDINGS_DIR)
+    args = parser.parse_args()
+    for f in args.files:
+        print(f"{f} -> {import_table(f, args.root)}")
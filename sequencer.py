@@ -0,0 +1,309 @@
+import argparse
+import math
+import sys
+import threading
+import time
+
+import numpy as np
+
+from recorder import new_recording
+from commands import SUCCESS, CMD_TIMEOUT, CMD_RETRIES, command_kind
+
+# ======================================================
+# PROTOCOLOS DE PRUEBA AUTOMÁTICOS (SECUENCIADOR EN SERVIDOR)
+# ======================================================
+# Un Protocol es una lista de pasos (instante desde el inicio, comando, fase)
+# armada de antemano. El Sequencer la ejecuta en un hilo propio contra un
+# reloj absoluto (monotonic del inicio + instante del paso): los retrasos no
+# se acumulan y nada depende de callbacks del navegador. Las consignas PWM
+# van por el SetpointCoalescer del equipo (como la perilla): si el enlace no
+# da abasto se envía el último valor en vez de encolar atrasados. TARA y PID
+# van por el CommandDispatcher. El retraso y los fallos se miden con el
+# resultado de cada Ticket (PUBACK/ACK), no con el encolado.
+# Cada cambio de fase queda marcado en la PhaseTimeline del equipo y el
+# gestor etiqueta las muestras (campo 'phase') por su tiempo de servidor.
+PSI_MAX = 30.0            # Mismo mapeo PSI -> PWM que la perilla
+SWEEP_RATE = 10.0         # Consignas por segundo en el barrido senoidal
+SAFE_CMD = '0'            # Al terminar o detener: válvula cerrada
+MAX_MARKS = 512
+SETPOINT_KEY = 'pwm'      # Misma clave que la perilla: el último que llega manda
+FINAL_WAIT = CMD_TIMEOUT * (CMD_RETRIES + 2)   # Espera de resultados pendientes al terminar
+
+
+def psi_to_pwm(psi):
+    return str(int(min(max(psi, 0.0), PSI_MAX) / PSI_MAX * 255))
+
+
+class PhaseTimeline:
+    # Marcas (t_servidor, fase); tag() pone en cada muestra la última fase con t_marca <= t
+    def __init__(self):
+        self.marks = (np.empty(0), np.empty(0))   # Se reemplaza entera: tag() lee sin cerrojo
+        self.lock = threading.Lock()
+
+    def mark(self, t, phase):
+        with self.lock:
+            ts, ph = self.marks
+            self.marks = (np.append(ts, t)[-MAX_MARKS:], np.append(ph, np.nan if phase is None else phase)[-MAX_MARKS:])
+
+    def tag(self, chunk):
+        t, phase = self.marks
+        if not len(t) or not len(chunk): return chunk
+        idx = np.searchsorted(t, chunk['t'], side='right') - 1
+        chunk['phase'] = np.where(idx >= 0, phase[np.maximum(idx, 0)], np.nan)
+        return chunk
+
+
+class Protocol:
+    def __init__(self, name):
+        self.name = name
+        self.steps = []       # (instante s, comando, índice de fase)
+        self.phases = []      # Etiqueta de cada fase
+        self.duration = 0.0
+
+    def begin(self, label):
+        self.phases.append(label)
+
+    def add(self, cmd, hold):
+        # Envía cmd en el instante actual y lo sostiene `hold` segundos
+        self.steps.append((self.duration, str(cmd), len(self.phases) - 1))
+        self.duration += hold
+
+    def extend(self, other):
+        base, offset = len(self.phases), self.duration
+        self.phases += other.phases
+        self.steps += [(t + offset, cmd, phase + base) for t, cmd, phase in other.steps]
+        self.duration += other.duration
+        return self
+
+
+def staircase(p_max=PSI_MAX, steps=6, hold=5.0, descend=True):
+    pr = Protocol(f"Escalera 0-{p_max:g} PSI ({steps})")
+    levels = list(np.linspace(p_max / steps, p_max, steps))
+    if descend: levels += levels[-2::-1]
+    for p in levels:
+        pr.begin(f"{p:.1f} PSI")
+        pr.add(psi_to_pwm(p), hold)
+    pr.begin("Reposo")
+    pr.add(SAFE_CMD, hold)
+    return pr
+
+
+def sine_sweep(p_mid=15.0, amp=10.0, f0=0.05, f1=1.0, duration=60.0, rate=SWEEP_RATE):
+    # Chirp logarítmico de f0 a f1 Hz alrededor de p_mid
+    pr = Protocol(f"Barrido {f0:g}-{f1:g} Hz ({p_mid:g}±{amp:g} PSI)")
+    pr.begin(pr.name)
+    k = f1 / f0
+    for t in np.arange(0.0, duration, 1.0 / rate):
+        arg = 2 * math.pi * f0 * (t if k == 1 else duration * (k ** (t / duration) - 1) / math.log(k))
+        pr.add(psi_to_pwm(p_mid + amp * math.sin(arg)), 1.0 / rate)
+    pr.begin("Reposo")
+    pr.add(SAFE_CMD, 2.0)
+    return pr
+
+
+def pid_steps(targets=(10.0, 20.0, 30.0), gains=((1.0, 0.0, 0.0),), hold=10.0, rest=5.0):
+    # Respuesta al escalón: cada objetivo con cada juego de ganancias, con reposo entre ellos
+    pr = Protocol(f"Escalones PID ({len(targets)}x{len(gains)})")
+    for kp, ki, kd in gains:
+        for sp in targets:
+            pr.begin(f"PID {sp:g}° Kp={kp:g} Ki={ki:g} Kd={kd:g}")
+            pr.add(f"P:{sp:g}:{kp:g}:{ki:g}:{kd:g}", hold)
+            pr.begin("Reposo")
+            pr.add(SAFE_CMD, rest)
+    return pr
+
+
+class Sequencer:
+    def __init__(self, protocol, commands, setpoints, timeline=None, stream=None, tare=True):
+        self.protocol = protocol
+        self.commands = commands       # CommandDispatcher del equipo (get_command_channels)
+        self.setpoints = setpoints     # SetpointCoalescer del equipo
+        self.timeline = timeline
+        self.stream = stream           # Si se da, la corrida se graba a disco
+        self.tare = tare
+        self.recording = None
+        self.index = 0
+        self.phase = None
+        self.failed = 0
+        self.done = 0                  # Comandos confirmados
+        self.offered = 0
+        self.max_late = 0.0            # Mayor retraso programado -> confirmado (s)
+        self.pending = []              # (instante programado monotonic, Ticket)
+        self.pending_lock = threading.Lock()
+        self.t0 = None
+        self.state = 'listo'
+        self.stop_evt = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_evt.set()
+
+    def _track(self, due, ticket):
+        # Llega desde el hilo del coalescer o del propio secuenciador
+        if ticket is None:
+            self.failed += 1
+            return
+        with self.pending_lock:
+            self.pending.append((due, ticket))
+
+    def _collect(self, timeout=0.0):
+        # Cuenta los tickets resueltos; con timeout espera a los que falten
+        limit = time.monotonic() + timeout
+        with self.pending_lock:
+            pending, self.pending = self.pending, []
+        left = []
+        for due, ticket in pending:
+            if not ticket.done.wait(max(0.0, limit - time.monotonic())):
+                left.append((due, ticket))
+            elif ticket.status in SUCCESS:
+                self.done += 1
+                self.max_late = max(self.max_late, ticket.finished - due)
+            else:
+                self.failed += 1
+        with self.pending_lock:
+            self.pending = left + self.pending
+        return not left
+
+    def _emit(self, cmd, due, force=False, on_sent=None):
+        self.offered += 1
+        if command_kind(cmd) == 'pwm':
+            def on_ticket(ticket, due=due):
+                self._track(due, ticket)
+                if on_sent: on_sent.set()
+            self.setpoints.offer(SETPOINT_KEY, cmd, force, on_ticket)
+            return
+        try: ticket = self.commands.submit(cmd)
+        except Exception: ticket = None
+        self._track(due, ticket)
+        if on_sent: on_sent.set()
+
+    def _set_phase(self, phase):
+        if phase == self.phase: return
+        self.phase = phase
+        if self.timeline is not None: self.timeline.mark(time.time(), phase)
+
+    def _run(self):
+        self.state = 'corriendo'
+        if self.stream is not None:
+            try:
+                self.recording = new_recording({'start_time': time.time(), 'protocol': self.protocol.name,
+                                                'phases': self.protocol.phases})
+                self.stream.add_sink(self.recording.append)
+            except OSError as e:
+                print(f"[ERROR] No se pudo abrir la grabación del protocolo: {e}", file=sys.stderr)
+        if self.tare:
+            self._emit('TARA', time.monotonic())
+            self.stop_evt.wait(0.5)
+        self.t0 = time.time()
+        start = time.monotonic()
+        try:
+            for i, (at, cmd, phase) in enumerate(self.protocol.steps):
+                wait = start + at - time.monotonic()
+                if wait > 0 and self.stop_evt.wait(wait): break
+                if self.stop_evt.is_set(): break
+                # El primer paso de cada fase sale siempre, aunque iguale a la consigna vigente
+                first = phase != self.phase
+                self._set_phase(phase)
+                self._emit(cmd, start + at, force=first)
+                self.index = i + 1
+                self._collect()
+            else:
+                self.stop_evt.wait(max(0.0, start + self.protocol.duration - time.monotonic()))
+        finally:
+            # Válvula cerrada por la misma vía que las consignas: reemplaza cualquier valor pendiente
+            sent = threading.Event()
+            self._emit(SAFE_CMD, time.monotonic(), force=True, on_sent=sent)
+            self._set_phase(None)
+            sent.wait(FINAL_WAIT)
+            self._collect(FINAL_WAIT)
+            self.state = 'detenido' if self.stop_evt.is_set() else 'terminado'
+            if self.recording is not None: self.recording.close()
+
+    def status(self):
+        elapsed = time.time() - self.t0 if self.t0 else 0.0
+        phase = self.protocol.phases[self.phase] if self.phase is not None else None
+        with self.pending_lock:
+            waiting = len(self.pending)
+        # coalesced: consignas reemplazadas por una más nueva (o iguales a la vigente) antes de salir
+        return {'protocol': self.protocol.name, 'state': self.state, 'phase': phase,
+                'step': self.index, 'steps': len(self.protocol.steps),
+                'elapsed': min(elapsed, self.protocol.duration), 'duration': self.protocol.duration,
+                'confirmed': self.done, 'failed': self.failed, 'waiting': waiting,
+                'coalesced': max(0, self.offered - self.done - self.failed - waiting),
+                'max_late_ms': self.max_late * 1000.0,
+                'recording': self.recording.id if self.recording is not None else None}
+
+
+# ======================================================
+# REGISTRO (UNA CORRIDA POR EQUIPO)
+# ======================================================
+runs = {}
+_lock = threading.Lock()
+
+
+def start_protocol(key, protocol, commands, setpoints, timeline=None, stream=None, tare=True):
+    seq = Sequencer(protocol, commands, setpoints, timeline, stream, tare)
+    with _lock:
+        old = runs.get(key)
+        if old and old.thread.is_alive(): raise RuntimeError("ya hay un protocolo en curso")
+        runs[key] = seq
+    return seq.start()
+
+
+def stop_protocol(key):
+    seq = runs.get(key)
+    if seq: seq.stop()
+
+
+def get_run(key):
+    return runs.get(key)
+
+
+PROTOCOLS = {'escalera': staircase, 'barrido': sine_sweep, 'pid': pid_steps}
+
+
+if __name__ == '__main__':
+    # Lote desatendido: python sequencer.py escalera barrido pid --kp 1.2 --transport tcp
+    parser = argparse.ArgumentParser(description="Ejecuta protocolos de caracterización y los graba")
+    parser.add_argument('protocols', nargs='+')
+    parser.add_argument('--transport', choices=('mqtt', 'tcp'), default='mqtt')
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--p-max', type=float, default=PSI_MAX)
+    parser.add_argument('--targets', default='10,20,30', help="objetivos PID (°)")
+    parser.add_argument('--kp', type=float, default=1.0)
+    parser.add_argument('--ki', type=float, default=0.0)
+    parser.add_argument('--kd', type=float, default=0.0)
+    parser.add_argument('--no-tare', action='store_true')
+    args = parser.parse_args()
+    unknown = [p for p in args.protocols if p not in PROTOCOLS]
+    if unknown: parser.error(f"protocolos desconocidos: {', '.join(unknown)} (opciones: {', '.join(PROTOCOLS)})")
+
+    if args.transport == 'tcp': import tcp_manager as manager
+    else: import mqtt_manager as manager
+    batch = Protocol("Lote: " + ", ".join(args.protocols))
+    for name in args.protocols:
+        if name == 'escalera': batch.extend(staircase(args.p_max))
+        elif name == 'barrido': batch.extend(sine_sweep(args.p_max / 2, args.p_max / 3))
+        else: batch.extend(pid_steps(tuple(float(v) for v in args.targets.split(',')), ((args.kp, args.ki, args.kd),)))
+    deadline = time.time() + 30
+    while not manager.is_esp_connected(args.device):
+        if time.time() > deadline: sys.exit("[ERROR] Sin conexión con el equipo")
+        time.sleep(0.5)
+    seq = start_protocol(args.device, batch, *manager.get_command_channels(args.device),
+                         manager.get_phase_timeline(args.device), manager.get_sample_stream(args.device), not args.no_tare)
+    print(f"[PROTOCOLO] {batch.name}: {len(batch.steps)} pasos, {batch.duration:.0f} s", file=sys.stderr)
+    try:
+        while seq.thread.is_alive():
+            st = seq.status()
+            print(f"  {st['elapsed']:6.1f}/{st['duration']:.0f} s  {st['phase'] or '-'}", file=sys.stderr)
+            seq.thread.join(5.0)
+    except KeyboardInterrupt:
+        seq.stop()
+        seq.thread.join()
+    st = seq.status()
+    print(f"[PROTOCOLO] {st['state']}: grabación {st['recording']}, confirmados {st['confirmed']}, fallidos {st['failed']}, "
+          f"reemplazados {st['coalesced']}, retraso máx {st['max_late_ms']:.1f} ms")
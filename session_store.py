@@ -0,0 +1,126 @@
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from wire_format import DERIVED, TAGS
+
+# ======================================================
+# ALMACÉN DE SESIONES EN SERVIDOR (RING BUFFERS NUMPY)
+# ======================================================
+# El navegador solo guarda {'sid', 'cursor'}; el historial vive aquí.
+CHANNELS = ('t', 'f', 'p', 'l', 'a', 'pwm') + DERIVED + TAGS
+MAX_POINTS = 200000     # Historial por sesión (antes 10k en el navegador)
+SESSION_TTL = 3600      # Segundos sin actividad antes de liberar una sesión
+
+
+class RingSession:
+    def __init__(self, capacity=MAX_POINTS):
+        self.capacity = capacity
+        self.buf = np.zeros((len(CHANNELS), capacity), dtype=np.float64)
+        self.total = 0  # Muestras escritas desde el último reset (cursor absoluto)
+        self.epoch = 0  # Cambia con cada BORRAR: los cursores viejos dejan de valer
+        self.running = False
+        self.start_time = None
+        self.recording = None  # Grabación en disco asociada (recorder.Recording)
+        self.device = None     # Equipo del que lee la sesión (None: el por defecto)
+        self.metrics = {}      # Últimas métricas derivadas para la telemetría
+        self.lock = threading.Lock()
+        self.last_access = time.time()
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def append(self, cols):
+        n = len(cols['t'])
+        if n == 0: return self.total
+        block = np.empty((len(CHANNELS), n), dtype=np.float64)
+        for i, k in enumerate(CHANNELS):
+            block[i] = cols.get(k, 0.0)
+        # Si llega más de lo que cabe, solo importa la cola
+        if n > self.capacity:
+            skip = n - self.capacity
+            block = block[:, skip:]
+        with self.lock:
+            if n > self.capacity:
+                self.total += skip
+                n = self.capacity
+            pos = self.total % self.capacity
+            first = min(n, self.capacity - pos)
+            self.buf[:, pos:pos + first] = block[:, :first]
+            if first < n:
+                self.buf[:, :n - first] = block[:, first:]
+            self.total += n
+            self.last_access = time.time()
+            return self.total
+
+    def _window(self, start, end):
+        # Copia ordenada de las muestras absolutas [start, end)
+        n = end - start
+        if n <= 0:
+            return np.empty((len(CHANNELS), 0), dtype=np.float64)
+        pos = start % self.capacity
+        first = min(n, self.capacity - pos)
+        if first == n:
+            return self.buf[:, pos:pos + n].copy()
+        return np.concatenate((self.buf[:, pos:], self.buf[:, :n - first]), axis=1)
+
+    def read(self, cursor=0):
+        # Devuelve las muestras posteriores a `cursor` y el nuevo cursor
+        with self.lock:
+            self.last_access = time.time()
+            oldest = max(0, self.total - self.capacity)
+            start = min(max(cursor or 0, oldest), self.total)
+            block = self._window(start, self.total)
+            return dict(zip(CHANNELS, block)), self.total
+
+    def snapshot(self):
+        return self.read(0)[0]
+
+    def last(self, key, default=0.0):
+        with self.lock:
+            if self.total == 0: return default
+            return float(self.buf[CHANNELS.index(key), (self.total - 1) % self.capacity])
+
+    def reset(self):
+        with self.lock:
+            self.total = 0
+            self.epoch += 1
+            self.running = False
+            self.start_time = None
+            self.last_access = time.time()
+
+
+class SessionStore:
+    def __init__(self, capacity=MAX_POINTS, ttl=SESSION_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def new_id():
+        return uuid.uuid4().hex
+
+    def get(self, sid):
+        # Crea la sesión bajo demanda (p. ej. tras reiniciar el servidor)
+        with self.lock:
+            sess = self.sessions.get(sid)
+            if sess is None:
+                self._evict()
+                sess = self.sessions[sid] = RingSession(self.capacity)
+            return sess
+
+    def drop(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+    def _evict(self):
+        limit = time.time() - self.ttl
+        for sid in [s for s, v in self.sessions.items() if v.last_access < limit]:
+            sess = self.sessions.pop(sid)
+            if sess.recording: sess.recording.close()
+
+
+store = SessionStore()
@@ -0,0 +1,296 @@
+import argparse
+import json
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+
+from wire_format import empty_samples, encode_frames
+
+# ======================================================
+# SIMULADOR: MÚSCULO MCKIBBEN + FIRMWARE (PID) SIN HARDWARE
+# ======================================================
+# Responde a los mismos comandos que el ESP32 (PWM "128", "TARA",
+# "P:sp:kp:ki:kd", con "#id" -> "ACK:id:OK") y publica en el mismo formato
+# (tramas binarias o JSON por línea) que parsean los gestores.
+#   python simulator.py tcp  [--port 5000] [--rate 1000] [--format bin|json]
+#       MCKIBBEN_ESP_IP=127.0.0.1 python fanout.py tcp   (o tcp_manager directo)
+#   python simulator.py mqtt --broker localhost [--device sim1]
+#       MCKIBBEN_MQTT_BROKER=localhost MCKIBBEN_MQTT_PORT=1883 python App.py
+#   python simulator.py sweep --kp 0.5:5:10 --ki 0:2:5 --kd 0 --sp 90
+# El modelo es vectorial: n plantas a la vez (barridos de ganancias en bloque,
+# más rápido que tiempo real).
+SIM_RATE = 1000        # Muestras por segundo
+BATCH_PERIOD = 0.02    # Cada cuánto se publica un bloque de muestras
+PSI_TO_PA = 6894.76
+G = 9.81
+
+
+class McKibbenPlant:
+    # Modelo estático de Tondu-Lopez + carga isotónica (masa colgada) y
+    # presión de primer orden respecto al PWM de la válvula
+    def __init__(self, n=1, L0=0.20, r0=0.006, theta0=23.0, mass=2.0, damping=60.0,
+                 tau_p=0.15, p_max=30.0, pulley=0.02, noise=0.05, seed=None):
+        th = np.radians(theta0)
+        self.a = 3.0 / np.tan(th) ** 2
+        self.b = 1.0 / np.sin(th) ** 2
+        self.area = np.pi * r0 ** 2
+        self.eps_max = 1.0 - np.sqrt(self.b / self.a)   # Contracción con fuerza nula
+        self.L0, self.mass, self.damping = L0, mass, damping
+        self.tau_p, self.p_max, self.pulley, self.noise = tau_p, p_max, pulley, noise
+        self.rng = np.random.default_rng(seed)
+        self.eps = np.zeros(n)    # Contracción (0..eps_max)
+        self.vel = np.zeros(n)    # d(eps)/dt
+        self.p = np.zeros(n)      # PSI
+
+    def force(self):
+        return np.maximum(self.p * PSI_TO_PA * self.area * (self.a * (1.0 - self.eps) ** 2 - self.b), 0.0)
+
+    def angle(self):
+        return np.degrees(self.eps * self.L0 / self.pulley)
+
+    def step(self, pwm, dt):
+        self.p += (self.p_max * np.clip(pwm, 0, 255) / 255.0 - self.p) * min(dt / self.tau_p, 1.0)
+        # m x'' = F - m g - c x'   con x = eps * L0 (Euler semi-implícito)
+        acc = (self.force() - self.mass * G - self.damping * self.vel * self.L0) / (self.mass * self.L0)
+        self.vel += acc * dt
+        self.eps += self.vel * dt
+        low, high = self.eps < 0, self.eps > self.eps_max
+        self.eps = np.clip(self.eps, 0.0, self.eps_max)
+        self.vel[low | high] = 0.0
+
+    def read(self, noise=(0.0, 0.0, 0.0)):
+        # Lecturas de sensores (f N, l cm, p PSI, a °); noise: ruido ya muestreado
+        return (self.force() + noise[0], self.L0 * (1.0 - self.eps) * 100.0, self.p + noise[1],
+                self.angle() + noise[2])
+
+    def sample_noise(self, n):
+        # Ruido de n pasos de una vez (celda de carga, transductor, encoder)
+        if not self.noise: return np.zeros((n, 3))
+        return self.rng.normal(0.0, self.noise, (n, 3)) * (1.0, 0.1, 1.0)
+
+
+class FirmwareController:
+    # Lo que hace el ESP32: PWM manual o PID de ángulo, con anti-windup
+    def __init__(self, n=1):
+        self.pid_on = np.zeros(n, dtype=bool)
+        self.pwm_manual = np.zeros(n)
+        self.sp = np.zeros(n)
+        self.kp, self.ki, self.kd = np.zeros(n), np.zeros(n), np.zeros(n)
+        self.integ = np.zeros(n)
+        self.prev = None
+        self.pwm = np.zeros(n)
+
+    def set_pid(self, sp, kp, ki, kd):
+        self.sp[:], self.kp[:], self.ki[:], self.kd[:] = sp, kp, ki, kd
+        self.integ[:] = 0.0
+        self.pid_on[:] = True
+
+    def set_pwm(self, pwm):
+        self.pwm_manual[:] = pwm
+        self.pid_on[:] = False
+
+    def update(self, angle, dt):
+        err = self.sp - angle
+        deriv = np.zeros_like(angle) if self.prev is None else -(angle - self.prev) / dt
+        self.prev = angle.copy()
+        out = self.kp * err + self.ki * (self.integ + err * dt) + self.kd * deriv
+        # Integración condicional: no se acumula error mientras el PWM está saturado
+        sat = ((out >= 255) & (err > 0)) | ((out <= 0) & (err < 0))
+        self.integ += np.where(sat, 0.0, err * dt)
+        self.pwm = np.where(self.pid_on, np.clip(out, 0, 255), self.pwm_manual)
+        return self.pwm
+
+
+class SimDevice:
+    def __init__(self, rate=SIM_RATE, seed=None, **plant):
+        self.rate = rate
+        self.dt = 1.0 / rate
+        self.plant = McKibbenPlant(1, seed=seed, **plant)
+        self.ctrl = FirmwareController(1)
+        self.t_dev = 0.0
+        self.seq = 0
+        self.f_off = 0.0
+        self.a_off = 0.0
+        self.last = (0.0, 0.0)
+        self.lock = threading.Lock()
+
+    def handle(self, line):
+        # Un comando del dashboard; devuelve el ACK si traía "#id"
+        msg, _, cid = line.strip().partition('#')
+        ok = True
+        with self.lock:
+            try:
+                if msg == 'TARA':
+                    self.f_off, self.a_off = self.last
+                elif msg.startswith('P:'):
+                    sp, kp, ki, kd = (float(v) for v in msg[2:].split(':'))
+                    self.ctrl.set_pid(sp, kp, ki, kd)
+                else:
+                    self.ctrl.set_pwm(float(msg))
+            except ValueError:
+                ok = False
+        return f"ACK:{cid}:{'OK' if ok else 'ERR'}" if cid else None
+
+    def generate(self, n):
+        out = empty_samples(n)
+        rows = np.empty((n, 5))
+        with self.lock:
+            noise = self.plant.sample_noise(n)
+            for i in range(n):
+                f, l, p, a = self.plant.read(noise[i])
+                pwm = self.ctrl.update(a - self.a_off, self.dt)   # El PID trabaja sobre el ángulo tarado
+                self.plant.step(pwm, self.dt)
+                rows[i] = (f[0], l[0], p[0], a[0], pwm[0])
+            self.t_dev += n * self.dt
+            self.last = (rows[-1, 0], rows[-1, 3])
+            out['f'], out['a'] = rows[:, 0] - self.f_off, rows[:, 3] - self.a_off
+        out['l'], out['p'], out['pwm'] = rows[:, 1], rows[:, 2], rows[:, 4]
+        out['t_dev'] = self.t_dev - self.dt * np.arange(n - 1, -1, -1)
+        out['seq'] = np.arange(self.seq, self.seq + n)
+        self.seq += n
+        return out
+
+    def payload(self, samples, fmt='bin'):
+        if fmt == 'bin': return encode_frames(samples)
+        rows = [{'ts': int(r['t_dev'] * 1000), 'seq': int(r['seq']), **{k: round(float(r[k]), 4) for k in ('f', 'l', 'p', 'a', 'pwm')}}
+                for r in samples]
+        return rows
+
+    def batches(self, period=BATCH_PERIOD, stop=None):
+        # Bloques en tiempo real: n muestras cada `period` segundos
+        n = max(1, int(round(self.rate * period)))
+        deadline = time.monotonic()
+        while stop is None or not stop.is_set():
+            yield self.generate(n)
+            deadline += n * self.dt
+            delay = deadline - time.monotonic()
+            if delay > 0: time.sleep(delay)
+            elif delay < -1.0: deadline = time.monotonic()   # No alcanza la tasa: no acumular atraso
+
+
+def serve_tcp(device, host='0.0.0.0', port=5000, fmt='bin', period=BATCH_PERIOD):
+    # Como el ESP32: un cliente a la vez, datos hacia él y comandos por líneas
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind((host, port))
+    srv.listen(1)
+    print(f"[SIM] TCP en {host}:{port} a {device.rate} Hz ({fmt})", file=sys.stderr)
+    while True:
+        conn, addr = srv.accept()
+        print(f"[SIM] Cliente {addr}", file=sys.stderr)
+        stop = threading.Event()
+        lock = threading.Lock()
+
+        def commands():
+            buf = b''
+            try:
+                while not stop.is_set():
+                    data = conn.recv(4096)
+                    if not data: break
+                    buf += data
+                    while b'\n' in buf:
+                        line, buf = buf.split(b'\n', 1)
+                        ack = device.handle(line.decode('utf-8', errors='ignore'))
+                        if ack:
+                            with lock: conn.sendall(f"{ack}\n".encode())
+            except OSError:
+                pass
+            stop.set()
+
+        threading.Thread(target=commands, daemon=True).start()
+        try:
+            for chunk in device.batches(period, stop):
+                body = device.payload(chunk, fmt)
+                if fmt != 'bin': body = ''.join(json.dumps(r) + '\n' for r in body).encode()
+                with lock: conn.sendall(body)
+        except OSError:
+            pass
+        stop.set()
+        conn.close()
+
+
+def run_mqtt(device, broker='localhost', port=1883, dev_id=None, fmt='bin', period=BATCH_PERIOD):
+    # dev_id None: tópicos del firmware anterior (mckibben/datos, mckibben/cmd)
+    import paho.mqtt.client as mqtt
+    base = f"mckibben/{dev_id}" if dev_id else "mckibben"
+    try:
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+    except AttributeError:
+        client = mqtt.Client()
+
+    def on_message(c, userdata, msg):
+        ack = device.handle(msg.payload.decode('utf-8', errors='ignore'))
+        if ack: c.publish(f"{base}/ack", ack, qos=1)
+
+    client.on_connect = lambda c, u, f, rc: c.subscribe(f"{base}/cmd", qos=1)
+    client.on_message = on_message
+    client.connect(broker, port, 60)
+    client.loop_start()
+    print(f"[SIM] MQTT {broker}:{port} -> {base}/datos a {device.rate} Hz ({fmt})", file=sys.stderr)
+    for chunk in device.batches(period):
+        body = device.payload(chunk, fmt)
+        client.publish(f"{base}/datos", body if fmt == 'bin' else json.dumps(body))
+
+
+def sweep(kp, ki, kd, sp=90.0, duration=5.0, rate=SIM_RATE, band=0.02, **plant):
+    # Todas las combinaciones de ganancias a la vez, sin tiempo real.
+    # Devuelve por combinación: IAE, sobrepaso (%), tiempo de subida y de
+    # establecimiento (s, NaN si no ocurre) y error final.
+    K = np.array(np.meshgrid(np.atleast_1d(kp), np.atleast_1d(ki), np.atleast_1d(kd), indexing='ij')).reshape(3, -1)
+    n = K.shape[1]
+    p = McKibbenPlant(n, noise=0.0, **plant)
+    c = FirmwareController(n)
+    c.set_pid(sp, *K)
+    dt = 1.0 / rate
+    steps = int(duration * rate)
+    iae = np.zeros(n)
+    peak = np.full(n, -np.inf)
+    rise = np.full(n, np.nan)
+    settle = np.zeros(n)   # Último instante fuera de la banda
+    for i in range(steps):
+        a = p.angle()
+        p.step(c.update(a, dt), dt)
+        err = sp - a
+        iae += np.abs(err) * dt
+        peak = np.maximum(peak, a)
+        rise = np.where(np.isnan(rise) & (a >= 0.9 * sp), i * dt, rise)
+        settle = np.where(np.abs(err) > band * abs(sp), (i + 1) * dt, settle)
+    final = sp - p.angle()
+    return {'kp': K[0], 'ki': K[1], 'kd': K[2], 'iae': iae,
+            'overshoot': np.maximum(peak - sp, 0.0) / abs(sp) * 100.0, 'rise': rise,
+            'settling': np.where(settle < duration, settle, np.nan), 'final_error': final}
+
+
+def _grid(text):
+    # "a:b:n" -> linspace(a, b, n); "x" -> [x]
+    parts = [float(v) for v in text.split(':')]
+    return np.linspace(parts[0], parts[1], int(parts[2])) if len(parts) == 3 else np.array(parts[:1])
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Simulador de banco McKibben")
+    ap.add_argument('mode', choices=('tcp', 'mqtt', 'sweep'))
+    ap.add_argument('--rate', type=float, default=SIM_RATE)
+    ap.add_argument('--format', default='bin', choices=('bin', 'json'))
+    ap.add_argument('--port', type=int)
+    ap.add_argument('--broker', default='localhost')
+    ap.add_argument('--device', default=None)
+    ap.add_argument('--kp', default='1'), ap.add_argument('--ki', default='0'), ap.add_argument('--kd', default='0')
+    ap.add_argument('--sp', type=float, default=90.0)
+    ap.add_argument('--duration', type=float, default=5.0)
+    args = ap.parse_args()
+    if args.mode == 'sweep':
+        t0 = time.perf_counter()
+        res = sweep(_grid(args.kp), _grid(args.ki), _grid(args.kd), args.sp, args.duration, args.rate)
+        order = np.argsort(res['iae'])
+        print("kp\tki\tkd\tIAE\tsobrepaso%\tsubida_s\testab_s")
+        for i in order[:20]:
+            print("\t".join(f"{res[k][i]:.3g}" for k in ('kp', 'ki', 'kd', 'iae', 'overshoot', 'rise', 'settling')))
+        print(f"[SIM] {len(order)} combinaciones, {args.duration}s simulados en {time.perf_counter() - t0:.2f}s", file=sys.stderr)
+    else:
+        dev = SimDevice(args.rate)
+        if args.mode == 'tcp': serve_tcp(dev, port=args.port or 5000, fmt=args.format)
+        else: run_mqtt(dev, args.broker, args.port or 1883, args.device, args.format)
@@ -1,117 +1,285 @@
-import socket
+import asyncio
+import os
+import random
 import threading
 import time
-import json 
+
+from wire_format import StreamDecoder
+from clock_sync import ClockSync
+from analytics import Analytics
+from ingest_buffer import DROP_OLDEST
+from fanout import SampleStream, RemoteHandler, INGEST_ADDR
+from commands import CommandDispatcher, SetpointCoalescer
+import metrics
+from replay import get_player, players as replays, PREFIX as REPLAY_PREFIX
+from sequencer import PhaseTimeline
 
 # Configuración Inicial
-ESP_IP = "192.168.1.x" 
-ESP_PORT = 5000
+ESP_IP = os.environ.get('MCKIBBEN_ESP_IP', "192.168.1.x")
+ESP_PORT = int(os.environ.get('MCKIBBEN_ESP_PORT', '5000'))
+DEFAULT_DEVICE = 'esp32'
+# Más bancos: MCKIBBEN_DEVICES="rig1=192.168.1.20:5000,rig2=192.168.1.21"
+DEVICES = os.environ.get('MCKIBBEN_DEVICES', '')
 
-class ESP32Client:
-    def __init__(self):
-        self.sock = None
-        self.running = False
-        self.lock = threading.Lock()
-        self.data_buffer = []  
-        self.latest_vals = (0.0, 0.0, 0.0, 0.0, 0.0)
-        self.connected = False
-        self.thread = threading.Thread(target=self._background_listener)
-        self.thread.daemon = True 
-        self.thread.start()
+# Atraso máximo de cada lector (muestras) y qué hacer cuando lo supera
+INGEST_CAPACITY = 65536
+OVERFLOW_POLICY = DROP_OLDEST
 
-    def set_ip(self, ip):
-        global ESP_IP
-        if ESP_IP != ip:
-            ESP_IP = ip
-            self.disconnect() 
+# Reconexión: espera exponencial con jitter entre intentos fallidos
+CONNECT_TIMEOUT = 2.0
+BACKOFF_MIN = 0.5
+BACKOFF_MAX = 30.0
+WRITE_TIMEOUT = 2.0
 
-    def connect(self):
-        try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.settimeout(2) 
-            self.sock.connect((ESP_IP, ESP_PORT))
-            self.sock.settimeout(None) 
-            self.connected = True
-        except:
-            self.connected = False
-
-    def disconnect(self):
-        if self.sock:
-            try: self.sock.close()
-            except: pass
-        self.sock = None
+# ======================================================
+# MOTOR ASYNCIO: N EQUIPOS EN UN SOLO HILO / EVENT LOOP
+# ======================================================
+class DeviceConnection:
+    def __init__(self, engine, dev_id, host, port=ESP_PORT):
+        self.engine = engine
+        self.id = dev_id
+        self.host = host
+        self.port = port
+        self.stream = SampleStream(INGEST_CAPACITY, OVERFLOW_POLICY)
+        self.clock = ClockSync()
+        self.analytics = Analytics()
+        self.phases = PhaseTimeline()
         self.connected = False
+        self.writer = None
+        self.task = None
+        self.failures = 0
+        self.lock = threading.Lock()
+        self._commands = None
+        self._setpoints = None
 
-    def _background_listener(self):
-        self.running = True
-        while self.running:
-            if not self.connected:
-                self.connect()
-                time.sleep(2)
+    @property
+    def commands(self):
+        # Se crea con el primer comando: los equipos que solo transmiten no suman hilos
+        with self.lock:
+            if self._commands is None:
+                self._commands = CommandDispatcher(self.send_command, lambda: self.connected)
+            return self._commands
+
+    @property
+    def setpoints(self):
+        commands = self.commands
+        with self.lock:
+            if self._setpoints is None:
+                self._setpoints = SetpointCoalescer(commands)
+            return self._setpoints
+
+    def _backoff(self):
+        delay = min(BACKOFF_MAX, BACKOFF_MIN * 2 ** min(self.failures, 16))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def run(self):
+        while True:
+            try:
+                reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError):
+                self.failures += 1
+                await asyncio.sleep(self._backoff())
                 continue
+            self.connected = True
+            self.failures = 0
+            # Lecturas en bloque: varias líneas JSON o tramas binarias por read
+            decoder = StreamDecoder(self._on_text)
             try:
-                f = self.sock.makefile('r', encoding='utf-8', errors='ignore')
-                while self.connected:
-                    line = f.readline()
-                    if not line: break 
-                    self._parse_data(line)
-            except: pass
+                while True:
+                    data = await reader.read(65536)
+                    if not data: break
+                    metrics.MESSAGES.inc(transport='tcp', device=self.id)
+                    # Una lectura corrupta se descarta entera; la conexión sigue
+                    try: self._parse_data(decoder.feed(data), time.time())
+                    except Exception:
+                        decoder.pending.clear()
+                        decoder.errors += 1
+                    if decoder.errors:
+                        metrics.PARSE_FAILURES.inc(decoder.errors, transport='tcp', device=self.id)
+                        decoder.errors = 0
+            except OSError:
+                pass
             finally:
-                self.disconnect()
-                time.sleep(1)
+                self._close()
+            await asyncio.sleep(BACKOFF_MIN)
 
-    def _parse_data(self, line):
-        line = line.strip()
-        if not line: return
+    def _on_text(self, text):
+        if self._commands: self._commands.on_text(text)
+
+    def _parse_data(self, chunk, t_rx):
+        if not len(chunk): return
+        metrics.SAMPLES.inc(len(chunk), transport='tcp', device=self.id)
+        self.clock.stamp(chunk, t_rx)
+        self.phases.tag(chunk)
+        self.analytics.process(chunk)
+        self.stream.publish(chunk)
+
+    def _close(self):
+        self.connected = False
+        if self.writer:
+            try: self.writer.close()
+            except Exception: pass
+        self.writer = None
+
+    async def _write(self, data):
+        try:
+            self.writer.write(data)
+            await self.writer.drain()
+            return True
+        except (OSError, AttributeError):
+            self._close()
+            return False
+
+    def send_command(self, message):
+        # Desde el hilo del despachador: la escritura la hace el event loop
+        if not self.connected or self.writer is None: return False
+        fut = asyncio.run_coroutine_threadsafe(self._write(f"{message}\n".encode()), self.engine.loop)
         try:
-            if line.startswith("{") and line.endswith("}"):
-                data = json.loads(line)
-                with self.lock:
-                    vals = (
-                        float(data.get('f', 0)),
-                        float(data.get('l', 0)),
-                        float(data.get('p', 0)),
-                        float(data.get('a', 0)),
-                        float(data.get('pwm', 0))
-                    )
-                    self.data_buffer.append(vals)
-                    self.latest_vals = vals
-        except: pass
-
-    def get_buffer(self):
+            return fut.result(WRITE_TIMEOUT)
+        except Exception:
+            fut.cancel()
+            return False
+
+
+class TCPEngine:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.devices = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True 
+
+    def start(self):
+        self.thread.start()
+        self.add_device(DEFAULT_DEVICE, ESP_IP, ESP_PORT)
+        for item in filter(None, DEVICES.split(',')):
+            dev_id, _, addr = item.partition('=')
+            host, _, port = addr.partition(':')
+            self.add_device(dev_id.strip(), host.strip(), int(port or ESP_PORT))
+
+    def add_device(self, dev_id, host, port=ESP_PORT):
+        # Alta o cambio de dirección: (re)arranca solo la tarea de ese equipo
         with self.lock:
-            if not self.data_buffer:
-                return [], self.latest_vals
-            chunk = list(self.data_buffer)
-            self.data_buffer.clear()
-            return chunk, self.latest_vals
+            dev = self.devices.get(dev_id)
+            if dev is None:
+                dev = self.devices[dev_id] = DeviceConnection(self, dev_id, host, port)
+            elif (dev.host, dev.port) == (host, port):
+                return dev
+            else:
+                dev.host, dev.port = host, port
+        self.loop.call_soon_threadsafe(self._restart, dev)
+        return dev
 
-    def get_single_data(self):
+    def _restart(self, dev):
+        if dev.task: dev.task.cancel()
+        dev.failures = 0
+        dev.task = self.loop.create_task(dev.run())
+
+    def remove_device(self, dev_id):
         with self.lock:
-            return self.latest_vals
+            dev = self.devices.pop(dev_id, None)
+        if dev and dev.task: self.loop.call_soon_threadsafe(dev.task.cancel)
+
+    def device(self, dev_id=None):
+        return self.devices[dev_id or DEFAULT_DEVICE]
+
+    # Interfaz de un solo equipo (fanout, funciones puente): el equipo por defecto
+    @property
+    def stream(self): return self.device().stream
+
+    @property
+    def connected(self): return self.device().connected
+
+    @property
+    def commands(self): return self.device().commands
 
-    def clear_internal_buffer(self):
+    @property
+    def setpoints(self): return self.device().setpoints
+
+    def set_ip(self, ip):
+        global ESP_IP
+        ESP_IP = ip
+        self.add_device(DEFAULT_DEVICE, ip, ESP_PORT)
+
+    async def _shutdown(self):
         with self.lock:
-            self.data_buffer.clear() 
+            devs, self.devices = list(self.devices.values()), {}
+        tasks = [d.task for d in devs if d.task]
+        for task in tasks: task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for dev in devs: dev._close()
+        self.loop.stop()
 
-    def send_command(self, message):
-        if not self.connected or not self.sock: return False
-        try:
-            msg = f"{message}\n"
-            self.sock.sendall(msg.encode())
-            return True
-        except:
-            self.disconnect()
-            return False
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop)
+        self.thread.join(WRITE_TIMEOUT)
+
+# Igual que mqtt_manager: nada se conecta al importar; start() en el primer
+# uso (o desde gunicorn.conf.py), una vez por proceso.
+client_instance = None
+_owner_pid = None
+_start_lock = threading.Lock()
+
+def start():
+    global client_instance, _owner_pid
+    if client_instance is not None and _owner_pid == os.getpid(): return client_instance
+    with _start_lock:
+        if client_instance is None or _owner_pid != os.getpid():
+            # Con MCKIBBEN_INGEST_ADDR la conexión la tiene otro proceso (fanout.py)
+            engine = RemoteHandler(INGEST_ADDR) if INGEST_ADDR else TCPEngine()
+            if not INGEST_ADDR: engine.start()
+            client_instance, _owner_pid = engine, os.getpid()
+    return client_instance
+
+def stop():
+    global client_instance
+    if client_instance is not None and _owner_pid == os.getpid() and not INGEST_ADDR:
+        client_instance.stop()
+    client_instance = None
+
+def _streams():
+    c = client_instance
+    if c is None or _owner_pid != os.getpid(): return {}
+    if INGEST_ADDR: return {DEFAULT_DEVICE: c.stream}
+    return {k: d.stream for k, d in list(c.devices.items())}
+
+metrics.track_streams('ingest' if INGEST_ADDR else 'tcp', _streams)
 
-client_instance = ESP32Client()
+# FUNCIONES PUENTE (device=None: equipo por defecto)
+def _dev(device=None):
+    player = get_player(device)
+    if player: return player
+    c = start()
+    if device is None or INGEST_ADDR: return c
+    return c.device(None if device.startswith(REPLAY_PREFIX) else device)  # Reproductor ya liberado
 
-# FUNCIONES PUENTE
-def set_target_ip(ip): client_instance.set_ip(ip)
-def is_esp_connected(): return client_instance.connected
-def send_tcp_command(msg): return client_instance.send_command(msg)
-def get_sensor_buffer(): return client_instance.get_buffer()
-def get_sensor_data(): return client_instance.get_single_data()
+def set_target_ip(ip):
+    if not INGEST_ADDR: start().set_ip(ip)
+def add_device(dev_id, host, port=ESP_PORT):
+    if not INGEST_ADDR: start().add_device(dev_id, host, port)
+def remove_device(dev_id):
+    if not INGEST_ADDR: start().remove_device(dev_id)
+def list_devices():
+    c = start()
+    devs = {DEFAULT_DEVICE: c.connected} if INGEST_ADDR else {k: d.connected for k, d in list(c.devices.items())}
+    return {**devs, **{k: p.connected for k, p in list(replays.items())}}
+def is_esp_connected(device=None): return _dev(device).connected
+def send_tcp_command(msg, device=None): return _dev(device).commands.submit(msg) is not None
+def send_setpoint(msg, key='pwm', force=False, device=None): return _dev(device).setpoints.offer(key, msg, force)
+def submit_command(msg, device=None):
+    ticket = _dev(device).commands.submit(msg)
+    return ticket.id if ticket else None
+def command_status(cid, device=None): return _dev(device).commands.status(cid)
+def send_command_sync(msg, timeout=None, device=None): return _dev(device).commands.send_and_wait(msg, timeout)
+def get_sensor_buffer(consumer=None, device=None): return _dev(device).stream.get_buffer(consumer)
+def get_sensor_data(device=None): return _dev(device).stream.latest_vals
 
 # --- NUEVO PUENTE PARA APP.PY ---
-def purge_buffer(): client_instance.clear_internal_buffer()
\ No newline at end of file
+def purge_buffer(consumer=None, device=None): _dev(device).stream.purge(consumer)
+def wait_sensor_data(consumer, timeout=None, device=None): return _dev(device).stream.wait(consumer, timeout)
+def get_ingest_stats(device=None): return _dev(device).stream.stats()
+def get_sample_stream(device=None): return _dev(device).stream
+def get_phase_timeline(device=None): return getattr(_dev(device), 'phases', None)
+def get_command_channels(device=None):
+    dev = _dev(device)
+    return dev.commands, dev.setpoints
\ No newline at end of file
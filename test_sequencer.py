@@ -0,0 +1,50 @@
+import threading
+import time
+import unittest
+
+from commands import CommandDispatcher, SetpointCoalescer
+from sequencer import Protocol, Sequencer, SAFE_CMD, pid_steps
+
+
+class FakeLink:
+    # Registra lo que sale "por el cable", en orden
+    def __init__(self):
+        self.wire = []
+        self.lock = threading.Lock()
+
+    def transmit(self, msg):
+        with self.lock:
+            self.wire.append(msg)
+        return True
+
+
+def run_protocol(protocol):
+    link = FakeLink()
+    commands = CommandDispatcher(link.transmit, acks=False)
+    setpoints = SetpointCoalescer(commands, max_rate=0)
+    seq = Sequencer(protocol, commands, setpoints, tare=False).start()
+    seq.thread.join(protocol.duration + 5.0)
+    return link.wire, seq
+
+
+class SequencerWireOrderTest(unittest.TestCase):
+    def test_pid_steps_wire_matches_protocol(self):
+        protocol = pid_steps(targets=(10.0, 20.0, 30.0), hold=0.1, rest=0.1)
+        wire, seq = run_protocol(protocol)
+        expected = [cmd for _, cmd, _ in protocol.steps] + [SAFE_CMD]
+        self.assertEqual(wire, expected)
+        self.assertEqual(seq.state, 'terminado')
+        self.assertEqual(seq.failed, 0)
+
+    def test_phase_start_resends_current_setpoint(self):
+        protocol = Protocol("Misma consigna en dos fases")
+        protocol.begin("A")
+        protocol.add('128', 0.1)
+        protocol.begin("B")
+        protocol.add('128', 0.1)
+        wire, _ = run_protocol(protocol)
+        self.assertEqual(wire, ['128', '128', SAFE_CMD])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import json
+import struct
+
+import numpy as np
+
+# ======================================================
+# FORMATO DE TELEMETRÍA ESP32 (JSON + BINARIO COMPACTO)
+# ======================================================
+# Trama binaria (little-endian, sin relleno):
+#   cabecera  'MK' | versión u8 | n u16
+#   n x       seq u32 | t_us u64 | f f32 | l f32 | p f32 | a f32 | pwm f32
+# Varias muestras por mensaje MQTT o por lectura TCP. El JSON de una
+# muestra por línea sigue siendo válido para firmware anterior.
+MAGIC = b'MK'
+VERSION = 1
+HEADER = struct.Struct('<2sBH')
+FIELDS = ('f', 'l', 'p', 'a', 'pwm')
+MAX_PENDING = 1 << 20   # Basura sin salto de línea: se descarta al pasar 1 MB
+
+FRAME_DTYPE = np.dtype([('seq', '<u4'), ('t_us', '<u8'),
+                        ('f', '<f4'), ('l', '<f4'), ('p', '<f4'), ('a', '<f4'), ('pwm', '<f4')])
+
+# Registro interno que usan los gestores: t = tiempo de servidor (lo pone
+# ClockSync al recibir), t_dev = reloj del ESP32 en segundos (NaN si no llega).
+# DERIVED los calcula analytics.Analytics en la ingesta (NaN si no se calculan).
+# TAGS son marcas del servidor (fase del protocolo de sequencer.py; NaN fuera de protocolo).
+DERIVED = ('f_filt', 'p_filt', 'l_filt', 'dl_dt', 'contr', 'f_psi', 'hyst')
+TAGS = ('phase',)
+SAMPLE_DTYPE = np.dtype([('t', '<f8'), ('seq', '<u4'), ('t_dev', '<f8'),
+                         ('f', '<f8'), ('l', '<f8'), ('p', '<f8'), ('a', '<f8'), ('pwm', '<f8')]
+                        + [(k, '<f8') for k in DERIVED + TAGS])
+
+
+def empty_samples(n=0):
+    out = np.zeros(n, dtype=SAMPLE_DTYPE)
+    out['t'] = np.nan
+    out['t_dev'] = np.nan
+    for k in DERIVED + TAGS:
+        out[k] = np.nan
+    return out
+
+
+def latest_tuple(samples):
+    last = samples[-1]
+    return tuple(float(last[k]) for k in FIELDS)
+
+
+def frames_to_samples(frames):
+    out = empty_samples(len(frames))
+    out['seq'] = frames['seq']
+    out['t_dev'] = frames['t_us'] * 1e-6
+    for k in FIELDS:
+        out[k] = frames[k]
+    return out
+
+
+def encode_frames(samples, seq0=0):
+    # Útil para pruebas y simulación: muestras -> bytes en formato binario
+    frames = np.zeros(len(samples), dtype=FRAME_DTYPE)
+    names = samples.dtype.names or ()
+    frames['seq'] = samples['seq'] if 'seq' in names else np.arange(seq0, seq0 + len(samples))
+    if 't_dev' in names:
+        frames['t_us'] = np.nan_to_num(samples['t_dev'] * 1e6).astype(np.uint64)
+    for k in FIELDS:
+        frames[k] = samples[k]
+    return HEADER.pack(MAGIC, VERSION, len(frames)) + frames.tobytes()
+
+
+def decode_binary(payload):
+    magic, version, n = HEADER.unpack_from(payload)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("trama binaria desconocida")
+    frames = np.frombuffer(payload, dtype=FRAME_DTYPE, count=n, offset=HEADER.size)
+    return frames_to_samples(frames)
+
+
+def decode_json(text):
+    data = json.loads(text)
+    rows = data if isinstance(data, list) else [data]
+    if not all(isinstance(d, dict) for d in rows):
+        raise ValueError("cada muestra JSON debe ser un objeto")
+    out = empty_samples(len(rows))
+    out['seq'] = [int(d.get('seq', 0)) for d in rows]
+    out['t_dev'] = [float(d['ts']) * 1e-3 if 'ts' in d else np.nan for d in rows]
+    for k in FIELDS:
+        out[k] = [float(d.get(k, 0)) for d in rows]
+    return out
+
+
+def decode_payload(payload):
+    # Mensaje MQTT completo: binario si empieza con la firma, si no JSON
+    if payload[:2] == MAGIC:
+        return decode_binary(payload)
+    return decode_json(payload.decode())
+
+
+class StreamDecoder:
+    # Separa un flujo TCP en líneas JSON y tramas binarias; guarda el resto.
+    # Las demás líneas de texto (p. ej. "ACK:...") van a on_text si se da.
+    def __init__(self, on_text=None):
+        self.pending = bytearray()
+        self.on_text = on_text
+        self.errors = 0     # Líneas JSON descartadas (el gestor las cuenta y reinicia)
+
+    def feed(self, data):
+        self.pending += data
+        chunks = []
+        buf = self.pending
+        pos = 0
+        while pos < len(buf):
+            if buf[pos:pos + 2] == MAGIC:
+                if len(buf) - pos < HEADER.size: break
+                _, version, n = HEADER.unpack_from(buf, pos)
+                end = pos + HEADER.size + n * FRAME_DTYPE.itemsize
+                if len(buf) < end: break
+                if version == VERSION:
+                    frames = np.frombuffer(bytes(buf[pos + HEADER.size:end]), dtype=FRAME_DTYPE)
+                    chunks.append(frames_to_samples(frames))
+                pos = end
+                continue
+            nl = buf.find(b'\n', pos)
+            if nl < 0: break
+            line = buf[pos:nl].strip()
+            pos = nl + 1
+            if line.startswith(b'{') or line.startswith(b'['):
+                try: chunks.append(decode_json(line.decode('utf-8', errors='ignore')))
+                except (ValueError, KeyError, TypeError): self.errors += 1
+            elif line and self.on_text:
+                self.on_text(line.decode('utf-8', errors='ignore'))
+        del buf[:pos]
+        if len(buf) > MAX_PENDING: buf.clear()
+        if not chunks: return empty_samples()
+        return chunks[0] if len(chunks) == 1 else np.concatenate(chunks)